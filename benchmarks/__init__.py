@@ -0,0 +1,14 @@
+"""
+Benchmarks for the vanishing point dataset pipeline.
+Run from the repository root:
+
+    python -m benchmarks.synthetic --count 10000    # generate a dataset
+    python -m benchmarks.run --count 10000 --output before.json
+    python -m benchmarks.compare before.json after.json
+
+The synthetic images are rendered with known vanishing points, so they also
+check the adherence evaluator:
+
+    python -m benchmarks.synthetic --count 1000 --requests
+    python vp_adherence.py --requests /tmp/vp_benchmark_data/requests.jsonl
+"""
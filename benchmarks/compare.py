@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Compare two benchmark result files written by benchmarks/run.py.
+Prints the per-item time (micro-benchmarks) or total seconds (end-to-end
+stages) of both runs and the speedup of the second over the first.
+"""
+
+import json
+import argparse
+
+def load_results(path):
+    """
+    Flatten a results file into {section/name: seconds}.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        report = json.load(f)
+    results = {}
+    for name, result in report.get('micro', {}).items():
+        results[f"micro/{name}"] = result['per_item']
+    for name, result in report.get('end_to_end', {}).items():
+        if 'seconds' in result:
+            results[f"end_to_end/{name}"] = result['seconds']
+    return report.get('environment', {}), results
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('baseline',
+                       help='Results of the baseline run')
+    parser.add_argument('candidate',
+                       help='Results of the run to compare against the baseline')
+    parser.add_argument('--threshold', type=float, default=0.05,
+                       help='Relative change below which results are reported as unchanged')
+    
+    args = parser.parse_args()
+    
+    baseline_env, baseline = load_results(args.baseline)
+    candidate_env, candidate = load_results(args.candidate)
+    print(f"Baseline:  {baseline_env.get('commit')}  {baseline_env.get('timestamp')}")
+    print(f"Candidate: {candidate_env.get('commit')}  {candidate_env.get('timestamp')}")
+    
+    for name in sorted(set(baseline) | set(candidate)):
+        before, after = baseline.get(name), candidate.get(name)
+        if before is None or after is None:
+            print(f"{name:45s} {'only in ' + ('candidate' if before is None else 'baseline')}")
+            continue
+        speedup = before / after if after else float('inf')
+        change = "unchanged" if abs(speedup - 1) < args.threshold else "faster" if speedup > 1 else "slower"
+        print(f"{name:45s} {before * 1e3:12.3f} ms {after * 1e3:12.3f} ms  {speedup:6.2f}x  {change}")
+
+if __name__ == "__main__":
+    main()
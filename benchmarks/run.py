@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks and end-to-end stage timings on a synthetic dataset.
+Micro-benchmarks time the hot functions (vanishing point solve, label
+parsing, ray rasterization, JPEG decode and encode, the two renderers, the
+vanishing point adherence evaluator) on a sample of the dataset; the end-to-end run times every stage of the original
+pipeline and the streaming pipeline, with captions served by the local stub
+API. Results are written as JSON together with the commit and library
+versions, so runs can be compared with benchmarks/compare.py.
+"""
+
+import io
+import os
+import json
+import time
+import shutil
+import asyncio
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+import contextlib
+from datetime import datetime, timezone
+from pathlib import Path
+import numpy as np
+import cv2
+
+import caption
+import process_vanishing_points as pvp
+from vp_index import compile_vp_index, VPIndex, load_vp_index
+from vp_rasterizer import ray_endpoints, render_control_image, clear_cache
+from reorganize_images import reorganize_images
+from organize_final import organize_final_files
+from stream_pipeline import stream_dataset
+from stub_api_server import start_stub_server
+import vp_adherence
+from benchmarks.synthetic import generate_dataset, write_adherence_requests
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+def measure(fn, repeat=5, number=1, items=1):
+    """
+    Call fn number times per round for repeat rounds.
+    Returns the timings in seconds per call, and per item when one call
+    handles items items.
+    """
+    fn()
+    rounds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - started) / number)
+    return {
+        'min': min(rounds),
+        'median': statistics.median(rounds),
+        'mean': statistics.fmean(rounds),
+        'repeat': repeat,
+        'number': number,
+        'items': items,
+        'per_item': min(rounds) / items,
+    }
+
+def environment_info():
+    """
+    Describe the machine, library versions and the commit being measured.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+    }
+
+def _sample(dataset, sample):
+    labels_dir = Path(dataset['labels_dir'])
+    images_dir = Path(dataset['images_dir'])
+    image_ids = sorted(path.stem for path in images_dir.glob("*.jpg"))[:sample]
+    return ([str(images_dir / f"{image_id}.jpg") for image_id in image_ids],
+            [str(labels_dir / f"{image_id}.txt") for image_id in image_ids])
+
+def micro_benchmarks(dataset, work_dir, sample=500, repeat=5):
+    """
+    Time the hot functions on up to sample images of the dataset.
+    """
+    image_files, label_files = _sample(dataset, sample)
+    count = len(image_files)
+    results = {}
+    
+    labels = [pvp.read_vp_data(label_file) for label_file in label_files]
+    sizes = [pvp.read_jpeg_size(image_file) for image_file in image_files]
+    line_pairs = np.array([[line1, line2] for _, _, line1, line2 in labels])
+    label_sizes = np.array([[width, height] for width, height, _, _ in labels])
+    
+    results['label_parse'] = measure(lambda: [pvp.read_vp_data(f) for f in label_files], repeat, items=count)
+    index_path = Path(work_dir) / "labels.vpidx"
+    results['label_index_compile'] = measure(lambda: compile_vp_index(dataset['labels_dir'], index_path), repeat,
+                                             items=dataset['count'])
+    index = VPIndex(index_path)
+    image_ids = [Path(f).stem for f in label_files]
+    results['label_index_lookup'] = measure(lambda: [index.lookup(image_id) for image_id in image_ids], repeat,
+                                            items=count)
+    
+    results['vp_solve'] = measure(lambda: [pvp.calculate_vanishing_point(line1, line2)
+                                           for _, _, line1, line2 in labels], repeat, items=count)
+    results['vp_solve_vectorized'] = measure(lambda: pvp.calculate_vanishing_points(line_pairs, label_sizes), repeat,
+                                             items=count)
+    results['prefilter_labels'] = measure(
+        lambda: pvp.prefilter_labels([(i, l, label) for i, l, label in zip(image_files, label_files, labels)]),
+        repeat, items=count)
+    
+    # Ray rasterization at the image sizes, with the vanishing point at the image center
+    results['ray_endpoints'] = measure(lambda: [ray_endpoints(w, h, w // 2, h // 2) for w, h in sizes], repeat,
+                                       items=count)
+
+    def render_uncached():
+        for width, height in sizes:
+            clear_cache()
+            render_control_image(width, height, width // 2, height // 3)
+    results['ray_rasterization'] = measure(render_uncached, repeat, items=count)
+    
+    encoded = [Path(image_file).read_bytes() for image_file in image_files]
+    buffers = [np.frombuffer(data, dtype=np.uint8) for data in encoded]
+    results['jpeg_header_probe'] = measure(lambda: [pvp.read_jpeg_size(f) for f in image_files], repeat, items=count)
+    results['jpeg_decode'] = measure(lambda: [cv2.imdecode(b, cv2.IMREAD_COLOR) for b in buffers], repeat,
+                                     items=count)
+    results['jpeg_decode_reduced_4'] = measure(lambda: [cv2.imdecode(b, cv2.IMREAD_REDUCED_COLOR_4) for b in buffers],
+                                               repeat, items=count)
+    decoded = [cv2.imdecode(b, cv2.IMREAD_COLOR) for b in buffers[:min(count, 100)]]
+    results['jpeg_encode_q95'] = measure(
+        lambda: [cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 95]) for image in decoded], repeat,
+        items=len(decoded))
+    
+    # The two renderers as the pipeline calls them, decoding from disk
+    render_dir = Path(work_dir) / "render"
+    render_dir.mkdir(exist_ok=True)
+    subset = list(zip(image_files, label_files))[:min(count, 100)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        results['create_vanishing_point_only'] = measure(
+            lambda: [pvp.create_vanishing_point_only(i, l, str(render_dir / f"{Path(i).stem}_vp_only.jpg"))
+                     for i, l in subset], repeat, items=len(subset))
+        results['create_overlay_image'] = measure(
+            lambda: [pvp.create_overlay_image(i, l, str(render_dir / f"{Path(i).stem}_overlay.jpg"))
+                     for i, l in subset], repeat, items=len(subset))
+    
+    # Vanishing point adherence of the synthetic images, which are rendered with known vanishing points
+    requests = vp_adherence.load_requests(write_adherence_requests(dataset, Path(work_dir) / "requests.jsonl"))
+    requests = requests[:min(count, 100)]
+    results['vp_adherence'] = measure(lambda: [vp_adherence.evaluate_image(*request) for request in requests],
+                                      repeat, items=len(requests))
+    results['vp_adherence']['summary'] = vp_adherence.summarize(vp_adherence.evaluate_requests(requests, workers=1))
+    return results
+
+def _timed(results, name, fn, items=None):
+    started = time.perf_counter()
+    value = fn()
+    seconds = time.perf_counter() - started
+    results[name] = {'seconds': seconds, 'items': items, 'per_item': seconds / items if items else None}
+    return value
+
+def end_to_end(dataset, work_dir, max_images=None, workers=4, stub_latency=0.05, concurrency=8, verbose=False):
+    """
+    Time every stage of the original pipeline (copy, render, reorganize,
+    caption, organize) and the single-pass streaming pipeline on the
+    dataset, with captions from a local stub API server.
+    """
+    work_dir = Path(work_dir)
+    server, url = start_stub_server(latency=stub_latency)
+    results = {}
+    try:
+        with contextlib.ExitStack() as stack:
+            if not verbose:
+                # The stages print a line per image and show progress bars
+                stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+                stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+            vp_index = _timed(results, 'load_vp_index',
+                              lambda: load_vp_index(dataset['labels_dir'], work_dir / "labels.vpidx", rebuild=True),
+                              dataset['count'])
+            processed = work_dir / "processed_images"
+            images_dir = processed / "images"
+            for directory in (images_dir, processed / "overlays", processed / "vanishing_points_only"):
+                directory.mkdir(parents=True, exist_ok=True)
+            max_images = max_images or dataset['count']
+            
+            copied = _timed(results, 'copy_relevant_images',
+                            lambda: pvp.copy_relevant_images(dataset['images_dir'], dataset['labels_dir'],
+                                                             str(images_dir), max_images, vp_index=vp_index))
+            results['copy_relevant_images']['items'] = copied
+            rendered = _timed(results, 'process_all_images',
+                              lambda: pvp.process_all_images(str(images_dir), dataset['labels_dir'],
+                                                             str(processed / "overlays"),
+                                                             str(processed / "vanishing_points_only"),
+                                                             workers=workers, vp_index=vp_index), copied)
+            _timed(results, 'reorganize_images',
+                   lambda: reorganize_images(str(images_dir), str(processed / "vanishing_points_only"),
+                                             str(work_dir / "train")), rendered)
+            _timed(results, 'caption',
+                   lambda: asyncio.run(caption.process_images_async(str(work_dir / "train"), 'stub',
+                                                                    concurrency=concurrency,
+                                                                    requests_per_minute=1000000, base_url=url)),
+                   rendered)
+            _timed(results, 'organize_final_files',
+                   lambda: organize_final_files(str(work_dir / "train"), str(work_dir)), rendered)
+            counts = _timed(results, 'stream_dataset',
+                            lambda: stream_dataset(dataset['images_dir'], dataset['labels_dir'],
+                                                   str(work_dir / "stream"), vp_index=vp_index,
+                                                   max_images=max_images, workers=workers, api_key='stub',
+                                                   base_url=url, concurrency=concurrency,
+                                                   requests_per_minute=1000000))
+            results['stream_dataset']['items'] = counts['written']
+            results['stream_dataset']['per_item'] = results['stream_dataset']['seconds'] / max(1, counts['written'])
+    finally:
+        server.shutdown()
+        server.server_close()
+    results['pipeline_total'] = {'seconds': sum(results[name]['seconds'] for name in (
+        'copy_relevant_images', 'process_all_images', 'reorganize_images', 'caption', 'organize_final_files'))}
+    results['stub_api'] = server.state.stats()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the benchmark suite on a synthetic AVA-like dataset')
+    parser.add_argument('--data-dir', default='/tmp/vp_benchmark_data',
+                       help='Directory of the synthetic dataset (generated if missing or different)')
+    parser.add_argument('--count', type=int, default=1000,
+                       help='Number of synthetic labels (1k-100k)')
+    parser.add_argument('--seed', type=int, default=0,
+                       help='Seed of the synthetic dataset')
+    parser.add_argument('--sample', type=int, default=500,
+                       help='Number of images used by the micro-benchmarks')
+    parser.add_argument('--repeat', type=int, default=5,
+                       help='Rounds per micro-benchmark; the fastest round is reported as per_item')
+    parser.add_argument('--max-images', type=int,
+                       help='Images processed by the end-to-end run (default: all)')
+    parser.add_argument('--workers', type=int, default=4,
+                       help='Worker processes or threads for generation and rendering')
+    parser.add_argument('--stub-latency', type=float, default=0.05,
+                       help='Seconds the stub caption API waits per request')
+    parser.add_argument('--concurrency', type=int, default=8,
+                       help='Concurrent caption requests')
+    parser.add_argument('--skip-micro', action='store_true',
+                       help='Skip the micro-benchmarks')
+    parser.add_argument('--skip-e2e', action='store_true',
+                       help='Skip the end-to-end stage timings')
+    parser.add_argument('--output', default='benchmark_results.json',
+                       help='Where to write the JSON results')
+    parser.add_argument('--verbose', action='store_true',
+                       help='Show the output of the pipeline stages')
+    
+    args = parser.parse_args()
+    
+    print(f"Preparing {args.count} synthetic items in {args.data_dir}...")
+    dataset = generate_dataset(args.data_dir, args.count, args.seed, args.workers)
+    report = {'environment': environment_info(),
+              'dataset': {key: dataset[key] for key in ('version', 'count', 'seed', 'config')},
+              'settings': {'sample': args.sample, 'repeat': args.repeat, 'max_images': args.max_images,
+                           'workers': args.workers, 'stub_latency': args.stub_latency,
+                           'concurrency': args.concurrency}}
+    
+    work_dir = Path(tempfile.mkdtemp(prefix='vp_benchmark_'))
+    try:
+        if not args.skip_micro:
+            print("Running micro-benchmarks...")
+            report['micro'] = micro_benchmarks(dataset, work_dir, args.sample, args.repeat)
+            for name, result in report['micro'].items():
+                print(f"- {name}: {result['per_item'] * 1e6:.1f} us/item")
+        if not args.skip_e2e:
+            print("Running end-to-end stages...")
+            report['end_to_end'] = end_to_end(dataset, work_dir / "e2e", args.max_images, args.workers,
+                                              args.stub_latency, args.concurrency, args.verbose)
+            for name, result in report['end_to_end'].items():
+                if 'seconds' in result:
+                    print(f"- {name}: {result['seconds']:.2f}s")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Synthetic AVA-like dataset for benchmarks.
+Writes images/{image_id}.jpg and labels/{image_id}.txt with the sizes and
+label mix of the AVA landscape subset: most vanishing points inside the
+frame, some outside it, a few parallel (degenerate) line pairs, labels at
+full or half resolution and a few labels without a source image. Images are
+rendered in a process pool and a dataset.json records the settings, so an
+existing dataset with the same settings is reused instead of regenerated.
+"""
+
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import cv2
+
+# Bump when the generated content changes, so existing datasets are regenerated
+GENERATOR_VERSION = 1
+
+# Common AVA image sizes (the longest side is usually 500-800 pixels)
+AVA_SIZES = ((800, 533), (800, 600), (640, 427), (750, 500), (800, 450), (500, 333), (533, 800), (600, 800),
+             (800, 800))
+
+DEFAULT_CONFIG = {
+    'outside_fraction': 0.15,
+    'degenerate_fraction': 0.03,
+    'missing_fraction': 0.05,
+    'half_label_fraction': 0.5,
+    'quality': 90,
+}
+
+def synthetic_label(rng, width, height, config):
+    """
+    Draw (label_width, label_height, line1, line2, vp) for one image; vp is
+    the vanishing point in image coordinates.
+    """
+    kind = rng.random()
+    if kind < config['outside_fraction']:
+        vp = (rng.uniform(-0.5, 1.5) * width, rng.choice([-0.4, 1.4]) * height)
+    else:
+        vp = (rng.uniform(0.05, 0.95) * width, rng.uniform(0.2, 0.8) * height)
+    
+    scale = 0.5 if rng.random() < config['half_label_fraction'] else 1.0
+    label_vp = np.array(vp) * scale
+    lines = []
+    for angle in rng.uniform(0, np.pi, 2):
+        direction = np.array([np.cos(angle), np.sin(angle)])
+        near, far = rng.uniform(40, 120), rng.uniform(200, 400)
+        lines.append([*(label_vp + direction * near * scale), *(label_vp + direction * far * scale)])
+    if kind > 1 - config['degenerate_fraction']:
+        # Parallel second line: no vanishing point
+        offset = np.array([0, 10 * scale, 0, 10 * scale])
+        lines[1] = list(np.array(lines[0]) + offset)
+    return round(width * scale), round(height * scale), lines[0], lines[1], vp
+
+def synthetic_image(rng, width, height, vp):
+    """
+    Render a perspective-like scene: a sky/ground gradient, a low-frequency
+    texture and lines converging on the vanishing point.
+    """
+    horizon = int(np.clip(vp[1], 0, height - 1))
+    rows = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    sky = np.array(rng.uniform(120, 230, 3), dtype=np.float32)
+    ground = np.array(rng.uniform(30, 140, 3), dtype=np.float32)
+    gradient = np.where(np.arange(height)[:, None, None] < horizon,
+                        sky * (0.7 + 0.3 * rows), ground * (1.2 - 0.4 * rows))
+    
+    texture = rng.normal(0, 18, (height // 8 + 1, width // 8 + 1, 3)).astype(np.float32)
+    image = cv2.resize(texture, (width, height), interpolation=cv2.INTER_CUBIC)
+    image += gradient
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    
+    center = (int(np.clip(vp[0], -4 * width, 5 * width)), int(np.clip(vp[1], -4 * height, 5 * height)))
+    for angle in rng.uniform(0, 2 * np.pi, 12):
+        end = (int(center[0] + np.cos(angle) * 3 * width), int(center[1] + np.sin(angle) * 3 * height))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv2.line(image, center, end, color, int(rng.integers(1, 5)), cv2.LINE_AA)
+    return image
+
+def _generate_chunk(work):
+    output_dir, seed, config, start, count = work
+    images_dir = Path(output_dir) / "images"
+    labels_dir = Path(output_dir) / "labels"
+    for number in range(start, start + count):
+        rng = np.random.default_rng([seed, number])
+        image_id = str(100000 + number)
+        width, height = AVA_SIZES[int(rng.integers(len(AVA_SIZES)))]
+        label_width, label_height, line1, line2, vp = synthetic_label(rng, width, height, config)
+        with open(labels_dir / f"{image_id}.txt", 'w') as f:
+            f.write(f"{label_width} {label_height}\n")
+            f.write(" ".join(f"{v:.3f}" for v in line1) + "\n")
+            f.write(" ".join(f"{v:.3f}" for v in line2) + "\n")
+        if rng.random() >= config['missing_fraction']:
+            image = synthetic_image(rng, width, height, vp)
+            cv2.imwrite(str(images_dir / f"{image_id}.jpg"), image, [cv2.IMWRITE_JPEG_QUALITY, config['quality']])
+    return count
+
+def generate_dataset(output_dir, count=1000, seed=0, workers=4, config=None, force=False):
+    """
+    Generate (or reuse) a synthetic dataset of count labels under output_dir.
+    Returns a dict with the images and labels directories and the settings.
+    """
+    output_dir = Path(output_dir)
+    config = {**DEFAULT_CONFIG, **(config or {})}
+    settings = {'version': GENERATOR_VERSION, 'count': count, 'seed': seed, 'config': config}
+    dataset = {'images_dir': str(output_dir / "images"), 'labels_dir': str(output_dir / "labels"), **settings}
+    
+    settings_path = output_dir / "dataset.json"
+    if not force and settings_path.exists():
+        with open(settings_path, 'r', encoding='utf-8') as f:
+            if json.load(f) == settings:
+                return dataset
+    
+    for name in ("images", "labels"):
+        directory = output_dir / name
+        directory.mkdir(parents=True, exist_ok=True)
+        for path in directory.iterdir():
+            path.unlink()
+    
+    chunk_size = 256
+    work = [(str(output_dir), seed, config, start, min(chunk_size, count - start))
+            for start in range(0, count, chunk_size)]
+    if workers <= 1:
+        for item in work:
+            _generate_chunk(item)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_generate_chunk, work))
+    
+    with open(settings_path, 'w', encoding='utf-8') as f:
+        json.dump(settings, f, indent=2)
+    return dataset
+
+def write_adherence_requests(dataset, path=None):
+    """
+    Write a vp_adherence request file for the dataset images: the vanishing
+    points they were rendered with, solved from the labels, with image paths
+    relative to the file. Labels with (nearly) parallel lines are left out,
+    since the rendered rays cannot converge on their point. Returns the path
+    of the request file.
+    """
+    import process_vanishing_points as pvp
+    images_dir = Path(dataset['images_dir'])
+    path = Path(path) if path else Path(dataset['images_dir']).parent / "requests.jsonl"
+    image_files = sorted(images_dir.glob("*.jpg"))
+    labels = [pvp.read_vp_data(Path(dataset['labels_dir']) / f"{image_file.stem}.txt") for image_file in image_files]
+    sizes = np.array([pvp.read_jpeg_size(str(image_file)) for image_file in image_files], dtype=np.float64)
+    scale = sizes / np.array([[width, height] for width, height, _, _ in labels], dtype=np.float64)
+    line_pairs = np.array([[line1, line2] for _, _, line1, line2 in labels]) * np.tile(scale, 2)[:, None, :]
+    points, degenerate, _ = pvp.calculate_vanishing_points(line_pairs, sizes)
+    # synthetic_image clips the ray origin to this range, so only points inside it are rendered faithfully
+    rendered = ~degenerate & (points >= -4 * sizes).all(axis=1) & (points <= 5 * sizes).all(axis=1)
+    with open(path, 'w', encoding='utf-8') as f:
+        for image_file, point, size, keep in zip(image_files, points, sizes, rendered):
+            if keep:
+                f.write(json.dumps({'image': os.path.relpath(image_file, path.parent),
+                                    'vanishing_point': point.tolist(), 'size': size.astype(int).tolist()}) + '\n')
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic AVA-like dataset of images and vanishing point labels')
+    parser.add_argument('--output-dir', default='/tmp/vp_benchmark_data',
+                       help='Directory for images/, labels/ and dataset.json')
+    parser.add_argument('--count', type=int, default=1000,
+                       help='Number of labels to generate')
+    parser.add_argument('--seed', type=int, default=0,
+                       help='Random seed')
+    parser.add_argument('--workers', type=int, default=4,
+                       help='Number of worker processes')
+    parser.add_argument('--force', action='store_true',
+                       help='Regenerate even if a dataset with the same settings exists')
+    parser.add_argument('--requests', action='store_true',
+                       help='Also write images/../requests.jsonl with the known vanishing points, for vp_adherence')
+    
+    args = parser.parse_args()
+    
+    dataset = generate_dataset(args.output_dir, args.count, args.seed, args.workers, force=args.force)
+    images = len(list(Path(dataset['images_dir']).glob("*.jpg")))
+    print(f"Dataset with {args.count} labels and {images} images in {args.output_dir}")
+    if args.requests:
+        print(f"Requests written to {write_adherence_requests(dataset)}")
+
+if __name__ == "__main__":
+    main()
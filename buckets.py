@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Aspect-ratio buckets for multi-resolution training.
+Every image is assigned to the nearest (width, height) bucket, its target is
+resized and cropped to that bucket ahead of time and its control image
+is rasterized directly at the bucket resolution, so lines stay crisp and the
+data loader does no resizing. A JSON lines bucket manifest records the bucket
+and crop of every sample. The crop is centered, but shifted where needed so
+the vanishing point stays inside it.
+"""
+
+import json
+import math
+import argparse
+from pathlib import Path
+import numpy as np
+import cv2
+
+DEFAULT_RESOLUTIONS = (512, 768, 1024)
+DEFAULT_ASPECT_RATIOS = ('1:1', '4:3', '3:4', '3:2', '2:3', '16:9', '9:16')
+DEFAULT_MULTIPLE = 64
+
+def parse_aspect_ratio(text):
+    """
+    Parse '4:3' or '1.333' into a float width / height ratio.
+    """
+    if ':' in text:
+        width, height = text.split(':')
+        return float(width) / float(height)
+    return float(text)
+
+def make_buckets(resolutions=DEFAULT_RESOLUTIONS, aspect_ratios=DEFAULT_ASPECT_RATIOS, multiple=DEFAULT_MULTIPLE):
+    """
+    Return sorted (width, height) buckets with about resolution**2 pixels for
+    every resolution and aspect ratio, with sides rounded to multiple.
+    """
+    buckets = set()
+    for resolution in resolutions:
+        for aspect_ratio in aspect_ratios:
+            ratio = parse_aspect_ratio(aspect_ratio) if isinstance(aspect_ratio, str) else aspect_ratio
+            width = max(multiple, round(resolution * math.sqrt(ratio) / multiple) * multiple)
+            height = max(multiple, round(resolution / math.sqrt(ratio) / multiple) * multiple)
+            buckets.add((width, height))
+    return sorted(buckets, key=lambda bucket: (bucket[0] * bucket[1], bucket))
+
+def assign_bucket(width, height, buckets):
+    """
+    Pick the bucket for an image: the closest aspect ratio (in log space),
+    then the largest such bucket that does not need upscaling, or the
+    smallest one if every bucket is larger than the image.
+    """
+    log_ratio = math.log(width / height)
+    distances = [abs(math.log(bucket[0] / bucket[1]) - log_ratio) for bucket in buckets]
+    best = min(distances)
+    candidates = [bucket for bucket, distance in zip(buckets, distances) if distance - best < 1e-9]
+    fitting = [bucket for bucket in candidates if bucket[0] <= width and bucket[1] <= height]
+    if fitting:
+        return max(fitting, key=lambda bucket: bucket[0] * bucket[1])
+    return min(candidates, key=lambda bucket: bucket[0] * bucket[1])
+
+def _crop_offset(resized, size, focus):
+    """
+    Centered crop offset along one axis, moved the least needed to keep the
+    focus position (in resized pixels) inside the crop.
+    """
+    offset = (resized - size) // 2
+    if focus is not None:
+        offset = min(max(offset, math.floor(focus) - size + 1), math.floor(focus))
+    return min(max(offset, 0), resized - size)
+
+def crop_geometry(width, height, bucket, focus=None):
+    """
+    Scale and center-crop that make a width x height image cover the bucket.
+    With focus, an (x, y) source pixel position, the crop is shifted just
+    enough to keep that point inside it.
+    Returns (scale, resized_width, resized_height, crop_x, crop_y).
+    """
+    bucket_width, bucket_height = bucket
+    scale = max(bucket_width / width, bucket_height / height)
+    resized_width = max(bucket_width, round(width * scale))
+    resized_height = max(bucket_height, round(height * scale))
+    focus_x, focus_y = (focus[0] * scale, focus[1] * scale) if focus is not None else (None, None)
+    return (scale, resized_width, resized_height, _crop_offset(resized_width, bucket_width, focus_x),
+            _crop_offset(resized_height, bucket_height, focus_y))
+
+def resize_to_bucket(image, bucket, focus=None):
+    """
+    Resize and crop an image to exactly fill the bucket, as crop_geometry.
+    """
+    height, width = image.shape[:2]
+    scale, resized_width, resized_height, crop_x, crop_y = crop_geometry(width, height, bucket, focus)
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    resized = cv2.resize(image, (resized_width, resized_height), interpolation=interpolation)
+    return np.ascontiguousarray(resized[crop_y:crop_y + bucket[1], crop_x:crop_x + bucket[0]])
+
+def map_point(x, y, width, height, bucket, focus=None):
+    """
+    Map a pixel position in the source image into the bucket crop.
+    """
+    scale, _, _, crop_x, crop_y = crop_geometry(width, height, bucket, focus)
+    return int(x * scale - crop_x), int(y * scale - crop_y)
+
+class BucketManifestWriter:
+    """
+    Append one JSON line per sample: key, image id, bucket, crop and the
+    vanishing point in bucket coordinates.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp_path = self.path.with_name(self.path.name + '.tmp')
+        self.file = open(self.tmp_path, 'w', encoding='utf-8')
+        self.counts = {}
+
+    def add(self, key, image_id, bucket, crop, vanishing_point):
+        self.file.write(json.dumps({'key': key, 'image_id': image_id, 'bucket': list(bucket), 'crop': list(crop),
+                                    'vanishing_point': list(vanishing_point)}) + '\n')
+        self.counts[tuple(bucket)] = self.counts.get(tuple(bucket), 0) + 1
+
+    def close(self):
+        self.file.close()
+        self.tmp_path.replace(self.path)
+
+def load_bucket_manifest(path):
+    """
+    Group the keys of a bucket manifest by bucket: {(width, height): [key, ...]}.
+    """
+    groups = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                groups.setdefault(tuple(record['bucket']), []).append(record['key'])
+    return groups
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the aspect-ratio buckets or summarize a bucket manifest')
+    parser.add_argument('--resolutions', default=','.join(map(str, DEFAULT_RESOLUTIONS)),
+                       help='Comma separated base resolutions')
+    parser.add_argument('--aspect-ratios', default=','.join(DEFAULT_ASPECT_RATIOS),
+                       help='Comma separated aspect ratios, e.g. 1:1,4:3,3:4')
+    parser.add_argument('--multiple', type=int, default=DEFAULT_MULTIPLE,
+                       help='Round bucket sides to a multiple of this')
+    parser.add_argument('--manifest',
+                       help='Bucket manifest to summarize')
+    
+    args = parser.parse_args()
+    
+    if args.manifest:
+        for bucket, keys in sorted(load_bucket_manifest(args.manifest).items()):
+            print(f"{bucket[0]}x{bucket[1]}: {len(keys)} samples")
+        return
+    
+    buckets = make_buckets([int(r) for r in args.resolutions.split(',')], args.aspect_ratios.split(','), args.multiple)
+    for width, height in buckets:
+        print(f"{width}x{height}  aspect {width / height:.3f}")
+
+if __name__ == "__main__":
+    main()
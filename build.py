@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+Incremental build of the training dataset.
+Models the four pipeline scripts as a DAG of stages over image ids:
+
+    collect -> render -> pair -> caption -> organize
+
+(copy_relevant_images, process_all_images, reorganize_images, caption.py and
+organize_final_files). Every item gets a fingerprint per stage from its
+inputs, its settings and its upstream fingerprints. Fingerprints are stored in
+a local state file, so `build.py --changed-only` only rerenders, recaptions
+and relinks the items whose inputs or settings changed.
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from pathlib import Path
+from types import SimpleNamespace
+from dotenv import load_dotenv
+import process_vanishing_points as pvp
+import caption
+from vp_index import load_vp_index
+from source_index import SAMPLING_STRATEGIES
+from caption_store import CaptionStore
+from file_sync import place_file, LINK_MODES
+from vp_rasterizer import DEFAULT_ANGLE_STEP, DEFAULT_LINE_WIDTH, DEFAULT_DOT_RADIUS
+
+STATE_VERSION = 1
+
+OK = 'ok'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+def fingerprint(*parts):
+    """
+    Stable hash of JSON-serializable build inputs.
+    """
+    encoded = json.dumps(parts, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()[:32]
+
+class BuildState:
+    """
+    Per-stage item fingerprints and statuses, persisted as JSON.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.stages = {}
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == STATE_VERSION:
+                self.stages = data.get('stages', {})
+
+    def get(self, stage_name):
+        return self.stages.get(stage_name, {})
+
+    def set(self, stage_name, items):
+        self.stages[stage_name] = items
+
+    def save(self):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': STATE_VERSION, 'stages': self.stages}, f)
+        os.replace(tmp_path, self.path)
+
+class Stage:
+    """
+    One node of the build graph.
+    plan(ctx) returns an ordered {item_id: fingerprint} dict of the items the
+    stage should produce. run(ctx, changed, removed) builds the changed items,
+    cleans up the removed ones and returns {item_id: status}. outputs(ctx,
+    item_id) lists the files an OK item must have on disk.
+    """
+
+    def __init__(self, name, deps, plan, run, outputs):
+        self.name = name
+        self.deps = deps
+        self.plan = plan
+        self.run = run
+        self.outputs = outputs
+
+def topological_order(stages):
+    """
+    Order stages so that every stage comes after its dependencies.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    ordered, visiting, done = [], set(), set()
+
+    def visit(stage):
+        if stage.name in done:
+            return
+        if stage.name in visiting:
+            raise ValueError(f"Cycle in build graph at stage {stage.name}")
+        visiting.add(stage.name)
+        for dep in stage.deps:
+            visit(by_name[dep])
+        visiting.discard(stage.name)
+        done.add(stage.name)
+        ordered.append(stage)
+    
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+def run_build(stages, ctx, state, changed_only=False):
+    """
+    Run every stage in dependency order. With changed_only, items whose
+    fingerprint matches the state file and whose outputs exist are skipped.
+    Only items that ended OK are passed on to downstream stages.
+    """
+    ctx.ok = {}
+    for stage in topological_order(stages):
+        started = time.perf_counter()
+        planned = stage.plan(ctx)
+        previous = state.get(stage.name)
+        
+        changed = []
+        for item_id, item_fingerprint in planned.items():
+            record = previous.get(item_id)
+            if (changed_only and record and record['fp'] == item_fingerprint
+                    and (record['status'] != OK or all(path.exists() for path in stage.outputs(ctx, item_id)))):
+                continue
+            changed.append(item_id)
+        removed = [item_id for item_id in previous if item_id not in planned]
+        
+        results = stage.run(ctx, changed, removed) if changed or removed else {}
+        
+        items = {}
+        changed_set = set(changed)
+        for item_id, item_fingerprint in planned.items():
+            if item_id not in changed_set:
+                items[item_id] = previous[item_id]
+            elif results.get(item_id, FAILED) != FAILED:
+                items[item_id] = {'fp': item_fingerprint, 'status': results[item_id]}
+        state.set(stage.name, items)
+        state.save()
+        
+        ctx.ok[stage.name] = {item_id: record['fp'] for item_id, record in items.items() if record['status'] == OK}
+        failed = sum(1 for item_id in changed if results.get(item_id, FAILED) == FAILED)
+        print(f"[{stage.name}] {len(planned)} items: {len(changed)} rebuilt, {len(planned) - len(changed)} unchanged, "
+              f"{len(removed)} removed, {failed} failed ({time.perf_counter() - started:.2f}s)")
+
+def _unlink(*paths):
+    for path in paths:
+        if path.exists() or path.is_symlink():
+            path.unlink()
+
+# collect: copy_relevant_images
+
+def plan_collect(ctx):
+    # Only the selected images are stat-ed, the directory listing comes from the source index
+    distinct = None
+    if ctx.dedup_threshold is not None:
+        distinct = pvp.distinct_images(ctx.source_dir, ctx.dedup_threshold, max(1, ctx.workers),
+                                       ctx.output_dir / ".dedup_hashes", ctx.output_dir / "dedup_report.jsonl")
+    image_ids = pvp.select_relevant_images(ctx.source_dir, ctx.vp_labels_dir, ctx.max_images, ctx.vp_index,
+                                           ctx.sampling, ctx.sample_seed, distinct=distinct)
+    planned = {}
+    for image_id in image_ids:
+        stat = os.stat(ctx.source_dir / f"{image_id}.jpg")
+        planned[image_id] = fingerprint((stat.st_size, stat.st_mtime_ns), ctx.vp_index.lookup(image_id))
+    return planned
+
+def run_collect(ctx, changed, removed):
+    ctx.images_dir.mkdir(parents=True, exist_ok=True)
+    for image_id in removed:
+        _unlink(ctx.images_dir / f"{image_id}.jpg")
+    for image_id in changed:
+        place_file(ctx.source_dir / f"{image_id}.jpg", ctx.images_dir / f"{image_id}.jpg", ctx.link_mode)
+    return {image_id: OK for image_id in changed}
+
+def outputs_collect(ctx, image_id):
+    return [ctx.images_dir / f"{image_id}.jpg"]
+
+# render: process_all_images
+
+def plan_render(ctx):
+    return {image_id: fingerprint(upstream, ctx.render_options) for image_id, upstream in ctx.ok['collect'].items()}
+
+def run_render(ctx, changed, removed):
+    ctx.overlays_dir.mkdir(parents=True, exist_ok=True)
+    ctx.vp_only_dir.mkdir(parents=True, exist_ok=True)
+    for image_id in removed:
+        _unlink(*outputs_render(ctx, image_id))
+    
+    candidates = [(str(ctx.images_dir / f"{image_id}.jpg"), str(ctx.vp_labels_dir / f"{image_id}.txt"),
+                   ctx.vp_index.lookup(image_id)) for image_id in changed]
+    results = {}
+    statuses = {'processed': OK, 'rejected': SKIPPED, 'failed': FAILED}
+    for image_id, status, messages in pvp.render_candidates(candidates, ctx.overlays_dir, ctx.vp_only_dir,
+                                                            ctx.workers, render_options=ctx.render_options):
+        results[image_id] = statuses[status]
+        if status == 'failed':
+            print(f"- {image_id}: {'; '.join(messages) or 'unknown error'}")
+    return results
+
+def outputs_render(ctx, image_id):
+    return [ctx.overlays_dir / f"{image_id}_overlay.jpg", ctx.vp_only_dir / f"{image_id}_vp_only.jpg"]
+
+# pair: reorganize_images
+
+def plan_pair(ctx):
+    ctx.numbers = {image_id: n for n, image_id in enumerate(sorted(ctx.ok['render']), 1)}
+    return {image_id: fingerprint(ctx.ok['render'][image_id], n) for image_id, n in ctx.numbers.items()}
+
+def run_pair(ctx, changed, removed):
+    ctx.train_dir.mkdir(parents=True, exist_ok=True)
+    for image_id in changed:
+        end_path, start_path = outputs_pair(ctx, image_id)
+        place_file(ctx.images_dir / f"{image_id}.jpg", end_path, ctx.link_mode)
+        place_file(ctx.vp_only_dir / f"{image_id}_vp_only.jpg", start_path, ctx.link_mode)
+    
+    # Numbers beyond the current pair count belong to removed images
+    wanted = {path.name for image_id in ctx.numbers for path in outputs_pair(ctx, image_id)}
+    for pattern in ("*_start.jpg", "*_end.jpg"):
+        for path in ctx.train_dir.glob(pattern):
+            if path.name not in wanted:
+                path.unlink()
+    return {image_id: OK for image_id in changed}
+
+def outputs_pair(ctx, image_id):
+    n = ctx.numbers[image_id]
+    return [ctx.train_dir / f"{n}_end.jpg", ctx.train_dir / f"{n}_start.jpg"]
+
+# caption: caption.py
+
+def plan_caption(ctx):
+    return {image_id: fingerprint(ctx.ok['collect'][image_id], ctx.numbers[image_id],
+                                  caption.PROMPT, caption.MODEL, caption.MAX_TOKENS)
+            for image_id in ctx.ok['pair']}
+
+def run_caption(ctx, changed, removed):
+    results = {}
+    pending = []
+    for image_id in changed:
+        n = ctx.numbers[image_id]
+        image_path = ctx.train_dir / f"{n}_end.jpg"
+        caption_path = ctx.train_dir / f"{n}_caption.txt"
+        # The store finds captions by content, so renumbered pairs cost no API calls
+        digest, done = caption._resolve_image(image_path, caption_path, ctx.store)
+        if done:
+            results[image_id] = OK
+        else:
+            pending.append((image_id, (image_path, caption_path, digest)))
+    
+    if pending and not ctx.api_key:
+        print(f"No API key: {len(pending)} captions left to generate on a later build")
+    elif pending:
+        counts = asyncio.run(caption.caption_items_async(
+            [item for _, item in pending], ctx.api_key, ctx.concurrency, ctx.requests_per_minute,
+            base_url=ctx.base_url, store=ctx.store))
+        succeeded = set(counts['succeeded'])
+        for image_id, (image_path, _, _) in pending:
+            if image_path in succeeded:
+                results[image_id] = OK
+    
+    wanted = {path.name for image_id in ctx.numbers for path in outputs_caption(ctx, image_id)}
+    for path in ctx.train_dir.glob("*_caption.txt"):
+        if path.name not in wanted:
+            path.unlink()
+    return results
+
+def outputs_caption(ctx, image_id):
+    return [ctx.train_dir / f"{ctx.numbers[image_id]}_caption.txt"]
+
+# organize: organize_final_files
+
+def plan_organize(ctx):
+    return {image_id: fingerprint(upstream, ctx.ok['caption'].get(image_id))
+            for image_id, upstream in ctx.ok['pair'].items()}
+
+def run_organize(ctx, changed, removed):
+    ctx.control_dir.mkdir(parents=True, exist_ok=True)
+    ctx.end_dir.mkdir(parents=True, exist_ok=True)
+    for image_id in changed:
+        n = ctx.numbers[image_id]
+        place_file(ctx.train_dir / f"{n}_start.jpg", ctx.control_dir / f"{n}.jpg", ctx.link_mode)
+        place_file(ctx.train_dir / f"{n}_end.jpg", ctx.end_dir / f"{n}.jpg", ctx.link_mode)
+        caption_file = ctx.train_dir / f"{n}_caption.txt"
+        if image_id in ctx.ok['caption'] and caption_file.exists():
+            place_file(caption_file, ctx.end_dir / f"{n}.txt", ctx.link_mode)
+        else:
+            _unlink(ctx.end_dir / f"{n}.txt")
+    
+    wanted = {f"{ctx.numbers[image_id]}.{ext}" for image_id in ctx.numbers for ext in ('jpg', 'txt')}
+    for directory in (ctx.control_dir, ctx.end_dir):
+        for path in directory.iterdir():
+            if path.name not in wanted and (path.is_file() or path.is_symlink()):
+                path.unlink()
+    return {image_id: OK for image_id in changed}
+
+def outputs_organize(ctx, image_id):
+    n = ctx.numbers[image_id]
+    return [ctx.control_dir / f"{n}.jpg", ctx.end_dir / f"{n}.jpg"]
+
+STAGES = [
+    Stage('collect', [], plan_collect, run_collect, outputs_collect),
+    Stage('render', ['collect'], plan_render, run_render, outputs_render),
+    Stage('pair', ['render'], plan_pair, run_pair, outputs_pair),
+    Stage('caption', ['pair'], plan_caption, run_caption, outputs_caption),
+    Stage('organize', ['pair', 'caption'], plan_organize, run_organize, outputs_organize),
+]
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Incrementally build the vanishing point training dataset')
+    parser.add_argument('--source-dir', default='/Users/Jasper/Downloads/archive (2)/images',
+                       help='Source directory containing original images')
+    parser.add_argument('--vp-labels-dir', default='/Users/Jasper/Projects/kontext_hack/exp/download_ava/vp-labels/AVA_landscape',
+                       help='Directory containing vanishing point label files')
+    parser.add_argument('--verify-labels', action='store_true',
+                       help='Also stat every label file to catch labels edited in place since the index was compiled')
+    parser.add_argument('--output-dir', default='/Users/Jasper/Projects/kontext_hack',
+                       help='Base directory for processed_images, train, train_control and train_end')
+    parser.add_argument('--max-images', type=int,
+                       help='Maximum number of source images to include')
+    parser.add_argument('--sampling', choices=SAMPLING_STRATEGIES, default='first',
+                       help='How to pick max-images of the labeled images: first, random or stratified by vanishing point position')
+    parser.add_argument('--sample-seed', type=int, default=0,
+                       help='Seed for random and stratified sampling')
+    parser.add_argument('--dedup-threshold', type=int,
+                       help='Drop near-duplicate images within this perceptual hash distance (of 64 bits) before rendering')
+    parser.add_argument('--changed-only', action='store_true',
+                       help='Only rebuild items whose inputs or settings changed since the last build')
+    parser.add_argument('--state-file',
+                       help='Build state file (default: <output-dir>/.build_state.json)')
+    parser.add_argument('--link-mode', choices=LINK_MODES, default='copy',
+                       help='How to place collected and organized files')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Number of worker processes used for rendering')
+    parser.add_argument('--angle-step', type=float, default=DEFAULT_ANGLE_STEP,
+                       help='Angle in degrees between the rays of the vanishing point images')
+    parser.add_argument('--line-width', type=int, default=DEFAULT_LINE_WIDTH,
+                       help='Stroke width of the rays in the vanishing point images')
+    parser.add_argument('--dot-radius', type=int, default=DEFAULT_DOT_RADIUS,
+                       help='Radius of the vanishing point dot')
+    parser.add_argument('--api-key',
+                       help='Anthropic API key (or set ANTHROPIC_API_KEY); without it captions are only taken from the store')
+    parser.add_argument('--base-url',
+                       help='Alternative API base URL, e.g. a local stub server')
+    parser.add_argument('--concurrency', type=int, default=8,
+                       help='Maximum number of caption requests in flight')
+    parser.add_argument('--rpm', type=int, default=50,
+                       help='Caption requests per minute limit')
+    
+    args = parser.parse_args()
+    
+    output_dir = Path(args.output_dir)
+    ctx = SimpleNamespace(
+        source_dir=Path(args.source_dir),
+        vp_labels_dir=Path(args.vp_labels_dir),
+        vp_index=load_vp_index(args.vp_labels_dir, verify=args.verify_labels),
+        max_images=args.max_images,
+        sampling=args.sampling,
+        sample_seed=args.sample_seed,
+        dedup_threshold=args.dedup_threshold,
+        output_dir=output_dir,
+        images_dir=output_dir / "processed_images" / "images",
+        overlays_dir=output_dir / "processed_images" / "overlays",
+        vp_only_dir=output_dir / "processed_images" / "vanishing_points_only",
+        train_dir=output_dir / "train",
+        control_dir=output_dir / "train_control",
+        end_dir=output_dir / "train_end",
+        link_mode=args.link_mode,
+        workers=args.workers,
+        render_options={'angle_step': args.angle_step, 'line_width': args.line_width, 'dot_radius': args.dot_radius},
+        api_key=args.api_key or os.getenv('ANTHROPIC_API_KEY'),
+        base_url=args.base_url,
+        concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+    )
+    if ctx.vp_index is None:
+        print("Error: could not build the label index")
+        return
+    
+    output_dir.mkdir(parents=True, exist_ok=True)
+    state = BuildState(args.state_file or output_dir / ".build_state.json")
+    ctx.store = CaptionStore(ctx.train_dir / ".caption_store.sqlite")
+    
+    started = time.perf_counter()
+    try:
+        run_build(STAGES, ctx, state, changed_only=args.changed_only)
+    finally:
+        ctx.store.close()
+    print(f"\nBuild finished in {time.perf_counter() - started:.2f}s")
+
+if __name__ == "__main__":
+    main()
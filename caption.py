@@ -6,16 +6,48 @@ Creates N_caption.txt files for each N_start.jpg image.
 
 import os
 import base64
+import hashlib
 from pathlib import Path
 import argparse
 import time
+import asyncio
 from dotenv import load_dotenv
 import anthropic
+import numpy as np
+import cv2
 from tqdm import tqdm
+from process_vanishing_points import read_jpeg_size
+from rate_limit import RateLimiter, backoff_delay, parse_retry_after
+from caption_store import CaptionStore, file_sha256
+from caption_manifest import CaptionManifest, custom_id_for, IN_PROGRESS, SUBMITTED, DONE, FAILED
+import metrics
+from metrics import stage, increment, observe
 
 # Load environment variables from .env file
 load_dotenv()
 
+MODEL = "claude-3-5-sonnet-20240620"
+MAX_TOKENS = 300
+PROMPT = "Describe this image in two sentences."
+
+# Rate limits, overload and server errors are retried; other API errors are final
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+_clients = {}
+
+def get_client(api_key, base_url=None, max_retries=0):
+    """
+    Return a shared Anthropic client, created once per (api_key, base_url, max_retries).
+    The client keeps a pool of keep-alive connections, so reusing it saves a
+    connection setup and TLS handshake per request.
+    SDK retries are off by default, since request_caption retries with its own
+    backoff and rate limiter.
+    """
+    key = (api_key, base_url, max_retries)
+    if key not in _clients:
+        _clients[key] = anthropic.Anthropic(api_key=api_key, base_url=base_url, max_retries=max_retries)
+    return _clients[key]
+
 def encode_image(image_path):
     """
     Encode image to base64 for Anthropic API.
@@ -23,56 +55,206 @@ def encode_image(image_path):
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
 
-def generate_caption(image_path, api_key, max_retries=3):
+def _scaled_size(width, height, max_edge):
     """
-    Generate caption for an image using Anthropic's Claude API.
+    Return the size of an image after downscaling its longest edge to max_edge.
+    """
+    if not max_edge or max(width, height) <= max_edge:
+        return width, height
+    scale = max_edge / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def prepare_image_payload(image_path, max_edge=None, quality=90, cache_dir=None):
     """
-    base64_image = encode_image(image_path)
+    Return the base64 JPEG payload for an image.
+    With max_edge the image is downscaled so its longest edge is at most
+    max_edge pixels and re-encoded at the given JPEG quality. With cache_dir
+    the encoded payload is stored on disk, keyed by a hash of the file
+    contents and the encoding settings, so re-runs skip re-encoding.
+    """
+    with stage('payload'):
+        with open(image_path, "rb") as image_file:
+            data = image_file.read()
+        increment('bytes_read', len(data))
+        return encode_payload(data, max_edge, quality, cache_dir)
+
+def encode_payload(data, max_edge=None, quality=90, cache_dir=None):
+    """
+    prepare_image_payload for JPEG bytes that are already in memory.
+    """
+    if not max_edge:
+        return base64.b64encode(data).decode('utf-8')
     
-    client = anthropic.Anthropic(api_key=api_key)
+    cache_path = None
+    if cache_dir:
+        digest = hashlib.sha256(data).hexdigest()
+        cache_path = Path(cache_dir) / f"{digest}_{max_edge}_{quality}.b64"
+        if cache_path.exists():
+            return cache_path.read_text(encoding='ascii')
+    
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        # Not decodable here; let the API see the original bytes
+        return base64.b64encode(data).decode('utf-8')
+    
+    height, width = image.shape[:2]
+    new_width, new_height = _scaled_size(width, height, max_edge)
+    if (new_width, new_height) != (width, height):
+        image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    # Keep the original if re-encoding would not make the upload smaller
+    payload_bytes = encoded.tobytes() if ok and encoded.size < len(data) else data
+    payload = base64.b64encode(payload_bytes).decode('utf-8')
+    
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix('.tmp')
+        tmp_path.write_text(payload, encoding='ascii')
+        os.replace(tmp_path, cache_path)
+    return payload
+
+def build_messages(base64_image):
+    """
+    Build the message list asking for a caption of one base64 encoded JPEG.
+    """
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": PROMPT
+                },
+                {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": "image/jpeg",
+                        "data": base64_image
+                    }
+                }
+            ]
+        }
+    ]
+
+def estimate_input_tokens(image_path, max_edge=None):
+    """
+    Estimate the input tokens of a caption request for the token rate limit.
+    Images cost about width * height / 750 tokens and are downscaled by the
+    API beyond roughly 1600 tokens.
+    """
+    size = read_jpeg_size(image_path)
+    if size is not None:
+        size = _scaled_size(size[0], size[1], max_edge)
+    image_tokens = 1600 if size is None else min(1600, size[0] * size[1] // 750)
+    return image_tokens + 20
+
+def _error_headers(error):
+    """
+    Return the HTTP response headers attached to an API error, if any.
+    """
+    response = getattr(error, 'response', None)
+    return getattr(response, 'headers', None)
+
+def _is_retryable(error):
+    """
+    Whether an API error is worth retrying.
+    """
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, anthropic.APIConnectionError)
+
+def generate_caption(image_path, api_key, max_retries=3, base_url=None, payload_options=None):
+    """
+    Generate caption for an image using Anthropic's Claude API.
+    payload_options are passed to prepare_image_payload (max_edge, quality, cache_dir).
+    """
+    base64_image = prepare_image_payload(image_path, **(payload_options or {}))
+    return request_caption(base64_image, api_key, max_retries, base_url)
+
+def request_caption(base64_image, api_key, max_retries=3, base_url=None, limiter=None):
+    """
+    Request a caption for a base64 encoded JPEG with the shared client.
+    With a rate_limit.BlockingRateLimiter every attempt waits for the limiter,
+    so the function can be called from several threads at once.
+    """
+    client = get_client(api_key, base_url)
     
     for attempt in range(max_retries):
+        if limiter is not None:
+            limiter.acquire()
+        started = time.perf_counter()
         try:
             response = client.messages.create(
-                model="claude-3-5-sonnet-20240620",
-                max_tokens=300,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "Describe this image in two sentences."
-                            },
-                            {
-                                "type": "image",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": "image/jpeg",
-                                    "data": base64_image
-                                }
-                            }
-                        ]
-                    }
-                ]
+                model=MODEL,
+                max_tokens=MAX_TOKENS,
+                messages=build_messages(base64_image)
             )
+            observe('api_latency_seconds', time.perf_counter() - started)
+            increment('api_requests', status='ok')
             
             caption = response.content[0].text
             return caption.strip()
-            
+        
         except Exception as e:
+            observe('api_latency_seconds', time.perf_counter() - started)
+            increment('api_requests', status='error')
             print(f"API Error (attempt {attempt + 1}): {e}")
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)  # Exponential backoff
+            if attempt < max_retries - 1 and _is_retryable(e):
+                increment('retries')
+                headers = _error_headers(e)
+                delay = backoff_delay(attempt, headers)
+                if limiter is not None and parse_retry_after(headers) is not None:
+                    limiter.pause(delay)
+                time.sleep(delay)
+            else:
+                break
     
     return None
 
-def process_images(train_dir, api_key, start_from=1, max_images=None):
+async def generate_caption_async(client, image_path, limiter, max_retries=3, payload_options=None):
     """
-    Process all vanishing point images and generate captions.
+    Generate caption for an image with an AsyncAnthropic client.
+    Every attempt waits for the shared rate limiter; a Retry-After from the
+    server pauses the limiter for all concurrent requests.
     """
-    train_path = Path(train_dir)
+    payload_options = payload_options or {}
+    base64_image = await asyncio.to_thread(prepare_image_payload, image_path, **payload_options)
+    estimated_tokens = estimate_input_tokens(image_path, payload_options.get('max_edge'))
     
+    for attempt in range(max_retries):
+        await limiter.acquire(estimated_tokens)
+        started = time.perf_counter()
+        try:
+            response = await client.messages.create(
+                model=MODEL,
+                max_tokens=MAX_TOKENS,
+                messages=build_messages(base64_image)
+            )
+            observe('api_latency_seconds', time.perf_counter() - started)
+            increment('api_requests', status='ok')
+            limiter.adjust(response.usage.input_tokens - estimated_tokens)
+            return response.content[0].text.strip()
+        
+        except Exception as e:
+            observe('api_latency_seconds', time.perf_counter() - started)
+            increment('api_requests', status='error')
+            print(f"API Error for {Path(image_path).name} (attempt {attempt + 1}): {e}")
+            if attempt >= max_retries - 1 or not _is_retryable(e):
+                break
+            increment('retries')
+            headers = _error_headers(e)
+            delay = backoff_delay(attempt, headers)
+            if parse_retry_after(headers) is not None:
+                limiter.pause(delay)
+            await asyncio.sleep(delay)
+    
+    return None
+
+def _select_images(train_path, start_from=1, max_images=None):
+    """
+    Return the sorted N_end.jpg images to caption.
+    """
     # Find all start images
     start_images = list(train_path.glob("*_end.jpg"))
     start_images.sort(key=lambda x: int(x.stem.split('_')[0]))
@@ -81,12 +263,94 @@ def process_images(train_dir, api_key, start_from=1, max_images=None):
         start_images = start_images[:max_images]
     
     # Filter to start from specific number
-    start_images = [img for img in start_images if int(img.stem.split('_')[0]) >= start_from]
+    return [img for img in start_images if int(img.stem.split('_')[0]) >= start_from]
+
+def lookup_caption(store, image_path, caption_path):
+    """
+    Look up the caption of an image in the caption store by content hash.
+    A stored caption is (re)written to caption_path, which fixes captions
+    left behind by renumbering. A caption file without a store entry is a
+    miss: its number does not prove it belongs to the image now at that
+    number (see import_caption_files).
+    Returns (image_sha256, caption or None).
+    """
+    digest = file_sha256(image_path)
+    caption = store.get(digest, PROMPT, MODEL, MAX_TOKENS)
+    if caption is not None:
+        if not caption_path.exists() or caption_path.read_text(encoding='utf-8') != caption:
+            caption_path.write_text(caption, encoding='utf-8')
+    return digest, caption
+
+def import_caption_files(train_dir, store, start_from=1, max_images=None):
+    """
+    Add existing N_caption.txt files without a store entry to the caption
+    store under the hash of the image now at N. Only correct for a train
+    folder that has not been renumbered since it was captioned, so this runs
+    only on request (--import-caption-files). Texts already stored for
+    another image are left out as stale. Returns the number imported.
+    """
+    train_path = Path(train_dir)
+    imported = 0
+    for image_path in _select_images(train_path, start_from, max_images):
+        caption_path = train_path / f"{image_path.stem.split('_')[0]}_caption.txt"
+        if not caption_path.exists():
+            continue
+        digest = file_sha256(image_path)
+        existing = caption_path.read_text(encoding='utf-8')
+        if (existing and store.get(digest, PROMPT, MODEL, MAX_TOKENS) is None
+                and not store.contains_caption(existing)):
+            store.put(digest, PROMPT, MODEL, MAX_TOKENS, existing, source_path=image_path)
+            imported += 1
+    return imported
+
+def _resolve_image(image_path, caption_path, store=None, need_digest=False):
+    """
+    Decide whether an image still needs a caption.
+    Returns (image_sha256 or None, done). The hash is computed when a store
+    is used or need_digest is set (e.g. for the manifest).
+    """
+    with stage('caption_lookup'):
+        if store is not None:
+            digest, cached = lookup_caption(store, image_path, caption_path)
+            return digest, cached is not None
+        digest = file_sha256(image_path) if need_digest else None
+        return digest, caption_path.exists()
+
+def _save_caption(caption, caption_path, image_path, digest, store=None, manifest=None):
+    """
+    Write a caption file and record it in the caption store and manifest.
+    """
+    with open(caption_path, 'w', encoding='utf-8') as f:
+        f.write(caption)
+    if store is not None:
+        store.put(digest, PROMPT, MODEL, MAX_TOKENS, caption, source_path=image_path)
+    if manifest is not None:
+        manifest.update(custom_id_for(digest), image=str(image_path), sha256=digest, state=DONE)
+
+def _mark_done(manifest, image_path, digest):
+    """
+    Record an image that needed no request as done in the manifest.
+    """
+    custom_id = custom_id_for(digest)
+    if manifest.state(custom_id) != DONE:
+        manifest.update(custom_id, image=str(image_path), sha256=digest, state=DONE)
+
+def process_images(train_dir, api_key, start_from=1, max_images=None, base_url=None, payload_options=None, store=None,
+                   manifest=None):
+    """
+    Process all vanishing point images and generate captions.
+    With a CaptionStore, images are matched to captions by content hash
+    instead of by the existence of N_caption.txt. With a CaptionManifest,
+    each request is recorded so an interrupted run resumes where it stopped.
+    """
+    train_path = Path(train_dir)
+    start_images = _select_images(train_path, start_from, max_images)
     
     print(f"Found {len(start_images)} images to process")
     
     processed = 0
     failed = 0
+    reused = 0
     
     # Create progress bar
     pbar = tqdm(start_images, desc="Generating captions", unit="image")
@@ -96,31 +360,260 @@ def process_images(train_dir, api_key, start_from=1, max_images=None):
         caption_path = train_path / f"{image_id}_caption.txt"
         
         # Skip if caption already exists
-        if caption_path.exists():
+        digest, done = _resolve_image(image_path, caption_path, store, need_digest=manifest is not None)
+        if done:
+            if manifest is not None:
+                _mark_done(manifest, image_path, digest)
             pbar.set_postfix({"Status": f"Skipped {image_id}"})
+            increment('skipped', reason='already_captioned')
+            reused += 1
             continue
         
         pbar.set_postfix({"Status": f"Processing {image_id}"})
+        if manifest is not None:
+            manifest.update(custom_id_for(digest), image=str(image_path), sha256=digest, state=IN_PROGRESS)
         
-        caption = generate_caption(image_path, api_key)
+        caption = generate_caption(image_path, api_key, base_url=base_url, payload_options=payload_options)
         
         if caption:
             # Save caption to file
-            with open(caption_path, 'w', encoding='utf-8') as f:
-                f.write(caption)
+            _save_caption(caption, caption_path, image_path, digest, store, manifest)
             pbar.set_postfix({"Status": f"✓ {image_id}", "Processed": processed + 1, "Failed": failed})
+            increment('captions', result='generated')
             processed += 1
         else:
+            if manifest is not None:
+                manifest.update(custom_id_for(digest), state=FAILED)
             pbar.set_postfix({"Status": f"✗ {image_id}", "Processed": processed, "Failed": failed + 1})
+            increment('captions', result='failed')
             failed += 1
         
         # Rate limiting - wait between requests
         time.sleep(1)
     
     print(f"\nProcessing complete!")
+    print(f"Skipped (already captioned): {reused}")
     print(f"Successfully processed: {processed}")
     print(f"Failed: {failed}")
 
+async def process_images_async(train_dir, api_key, start_from=1, max_images=None, concurrency=8,
+                               requests_per_minute=50, tokens_per_minute=None, base_url=None, payload_options=None,
+                               store=None, manifest=None):
+    """
+    Generate captions concurrently with asyncio.
+    At most concurrency requests are in flight, limited further by a token
+    bucket for requests and input tokens per minute. Each caption is written
+    as soon as its request completes. With a CaptionStore, already captioned
+    images are found by content hash; a CaptionManifest records progress.
+    """
+    train_path = Path(train_dir)
+    start_images = _select_images(train_path, start_from, max_images)
+    
+    print(f"Found {len(start_images)} images to process")
+    
+    pending = []
+    for img in start_images:
+        caption_path = train_path / f"{img.stem.split('_')[0]}_caption.txt"
+        digest, done = _resolve_image(img, caption_path, store, need_digest=manifest is not None)
+        if not done:
+            pending.append((img, caption_path, digest))
+        elif manifest is not None:
+            _mark_done(manifest, img, digest)
+    skipped = len(start_images) - len(pending)
+    increment('skipped', skipped, reason='already_captioned')
+    
+    counts = await caption_items_async(pending, api_key, concurrency, requests_per_minute, tokens_per_minute,
+                                       base_url, payload_options, store, manifest)
+    increment('captions', counts['processed'], result='generated')
+    increment('captions', counts['failed'], result='failed')
+    
+    print(f"\nProcessing complete!")
+    print(f"Skipped (already captioned): {skipped}")
+    print(f"Successfully processed: {counts['processed']}")
+    print(f"Failed: {counts['failed']}")
+
+async def caption_items_async(pending, api_key, concurrency=8, requests_per_minute=50, tokens_per_minute=None,
+                              base_url=None, payload_options=None, store=None, manifest=None):
+    """
+    Caption (image_path, caption_path, image_sha256) items concurrently.
+    The hash may be None when neither a store nor a manifest is used.
+    Returns a dict with processed/failed counts and the list of succeeded image paths.
+    """
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    client = anthropic.AsyncAnthropic(api_key=api_key, base_url=base_url, max_retries=0)
+    queue = iter(pending)
+    counts = {"processed": 0, "failed": 0, "succeeded": []}
+    
+    pbar = tqdm(total=len(pending), desc="Generating captions", unit="image")
+
+    async def worker():
+        for image_path, caption_path, digest in queue:
+            if manifest is not None:
+                manifest.update(custom_id_for(digest), image=str(image_path), sha256=digest, state=IN_PROGRESS)
+            caption = await generate_caption_async(client, image_path, limiter, payload_options=payload_options)
+            if caption:
+                await asyncio.to_thread(_save_caption, caption, caption_path, image_path, digest)
+                # SQLite and the manifest log are only touched from the event loop thread
+                if store is not None:
+                    store.put(digest, PROMPT, MODEL, MAX_TOKENS, caption, source_path=image_path)
+                if manifest is not None:
+                    manifest.update(custom_id_for(digest), state=DONE)
+                counts["processed"] += 1
+                counts["succeeded"].append(image_path)
+            else:
+                if manifest is not None:
+                    manifest.update(custom_id_for(digest), state=FAILED)
+                counts["failed"] += 1
+            pbar.update(1)
+            pbar.set_postfix({"Processed": counts["processed"], "Failed": counts["failed"]})
+    
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    finally:
+        pbar.close()
+        await client.close()
+    return counts
+
+def _submit_batches(client, requests, manifest, max_batch_requests, max_batch_bytes):
+    """
+    Submit (custom_id, image_path, digest, payload) requests in batches that
+    stay under the request count and payload size limits, recording every
+    submitted item in the manifest.
+    """
+    chunk, chunk_bytes = [], 0
+    batch_ids = []
+
+    def flush():
+        batch = client.messages.batches.create(requests=[
+            {
+                "custom_id": custom_id,
+                "params": {"model": MODEL, "max_tokens": MAX_TOKENS, "messages": build_messages(payload)},
+            }
+            for custom_id, _, _, payload in chunk
+        ])
+        for custom_id, image_path, digest, _ in chunk:
+            manifest.update(custom_id, image=str(image_path), sha256=digest, state=SUBMITTED, batch_id=batch.id)
+        batch_ids.append(batch.id)
+        print(f"Submitted batch {batch.id} with {len(chunk)} requests")
+    
+    for request in requests:
+        payload_bytes = len(request[3])
+        if chunk and (len(chunk) >= max_batch_requests or chunk_bytes + payload_bytes > max_batch_bytes):
+            flush()
+            chunk, chunk_bytes = [], 0
+        chunk.append(request)
+        chunk_bytes += payload_bytes
+    if chunk:
+        flush()
+    return batch_ids
+
+def _collect_batch_results(client, batch_id, manifest, targets, store=None):
+    """
+    Download the results of an ended batch and save every caption.
+    targets maps custom_id to the (image_path, caption_path) pairs of this run.
+    Returns (succeeded, failed) counts.
+    """
+    succeeded = failed = 0
+    for entry in client.messages.batches.results(batch_id):
+        custom_id = entry.custom_id
+        item = manifest.get(custom_id) or {}
+        if entry.result.type != 'succeeded':
+            manifest.update(custom_id, state=FAILED, error=entry.result.type)
+            failed += 1
+            continue
+        
+        caption = entry.result.message.content[0].text.strip()
+        digest = item.get('sha256')
+        if store is not None and digest:
+            store.put(digest, PROMPT, MODEL, MAX_TOKENS, caption, source_path=item.get('image'))
+        for image_path, caption_path in targets.get(custom_id, []):
+            with open(caption_path, 'w', encoding='utf-8') as f:
+                f.write(caption)
+        manifest.update(custom_id, state=DONE)
+        succeeded += 1
+    return succeeded, failed
+
+def process_images_batch(train_dir, api_key, manifest, start_from=1, max_images=None, base_url=None,
+                         payload_options=None, store=None, poll_interval=60, max_batch_requests=10000,
+                         max_batch_bytes=200 * 1024 * 1024):
+    """
+    Caption all pending images through the Message Batches API.
+    Pending requests are submitted in as few batches as the size limits
+    allow, then the open batches are polled until they end. The manifest
+    records every submitted item with its batch id, so an interrupted run
+    picks up the open batches again instead of resubmitting them; failed,
+    expired or never-submitted items are submitted on the next run.
+    """
+    train_path = Path(train_dir)
+    start_images = _select_images(train_path, start_from, max_images)
+    
+    print(f"Found {len(start_images)} images to process")
+    
+    targets = {}
+    to_submit = []
+    skipped = 0
+    for image_path in start_images:
+        caption_path = train_path / f"{image_path.stem.split('_')[0]}_caption.txt"
+        digest, done = _resolve_image(image_path, caption_path, store, need_digest=True)
+        custom_id = custom_id_for(digest)
+        if done:
+            _mark_done(manifest, image_path, digest)
+            skipped += 1
+            continue
+        # Identical images share one request and receive the same caption
+        if custom_id not in targets:
+            targets[custom_id] = []
+            if manifest.state(custom_id) != SUBMITTED:
+                to_submit.append((custom_id, image_path, digest))
+        targets[custom_id].append((image_path, caption_path))
+    
+    print(f"Skipped (already captioned): {skipped}")
+    print(f"Waiting on previously submitted requests: {len(targets) - len(to_submit)}")
+    
+    # Batch calls have no retry loop of their own, so keep the SDK's retries
+    client = get_client(api_key, base_url, max_retries=anthropic.DEFAULT_MAX_RETRIES)
+    
+    if to_submit:
+        print(f"Encoding {len(to_submit)} images for submission...")
+        requests = ((custom_id, image_path, digest, prepare_image_payload(image_path, **(payload_options or {})))
+                    for custom_id, image_path, digest in to_submit)
+        _submit_batches(client, requests, manifest, max_batch_requests, max_batch_bytes)
+    
+    open_batches = sorted({item['batch_id'] for item in manifest.with_state(SUBMITTED)})
+    succeeded = failed = 0
+    
+    while open_batches:
+        still_open = []
+        for batch_id in open_batches:
+            try:
+                batch = client.messages.batches.retrieve(batch_id)
+            except anthropic.NotFoundError:
+                # The batch is gone; its items are resubmitted on the next run
+                for item in manifest.with_state(SUBMITTED):
+                    if item.get('batch_id') == batch_id:
+                        manifest.update(item['custom_id'], state=FAILED, error='batch_not_found')
+                print(f"Batch {batch_id} not found")
+                continue
+            
+            if batch.processing_status == 'ended':
+                batch_succeeded, batch_failed = _collect_batch_results(client, batch_id, manifest, targets, store)
+                succeeded += batch_succeeded
+                failed += batch_failed
+                print(f"Batch {batch_id} ended: {batch_succeeded} succeeded, {batch_failed} failed")
+            else:
+                counts = batch.request_counts
+                print(f"Batch {batch_id} {batch.processing_status}: {counts.processing} processing, "
+                      f"{counts.succeeded} succeeded, {counts.errored} errored")
+                still_open.append(batch_id)
+        
+        open_batches = still_open
+        if open_batches:
+            time.sleep(poll_interval)
+    
+    print(f"\nProcessing complete!")
+    print(f"Successfully processed: {succeeded}")
+    print(f"Failed: {failed}")
+
 def main():
     parser = argparse.ArgumentParser(description='Generate captions for vanishing point images using Anthropic Claude')
     parser.add_argument('--train-dir', default='/Users/Jasper/Projects/kontext_hack/train',
@@ -131,8 +624,40 @@ def main():
                        help='Start processing from image number N')
     parser.add_argument('--max-images', type=int,
                        help='Maximum number of images to process')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                       help='Send requests concurrently with asyncio instead of one at a time')
+    parser.add_argument('--batch', action='store_true',
+                       help='Submit all pending images through the Message Batches API and poll until done')
+    parser.add_argument('--poll-interval', type=float, default=60,
+                       help='Seconds between batch status checks in --batch mode')
+    parser.add_argument('--concurrency', type=int, default=8,
+                       help='Maximum number of requests in flight in --async mode')
+    parser.add_argument('--rpm', type=int, default=50,
+                       help='Requests per minute limit in --async mode')
+    parser.add_argument('--tpm', type=int,
+                       help='Input tokens per minute limit in --async mode')
+    parser.add_argument('--base-url',
+                       help='Alternative API base URL, e.g. a local stub server')
+    parser.add_argument('--caption-store',
+                       help='SQLite caption store keyed by image content (default: <train-dir>/.caption_store.sqlite)')
+    parser.add_argument('--no-caption-store', action='store_true',
+                       help='Only skip images whose N_caption.txt exists, without the caption store')
+    parser.add_argument('--import-caption-files', action='store_true',
+                       help='First add existing N_caption.txt files to the caption store (only if the folder was not renumbered since captioning)')
+    parser.add_argument('--manifest',
+                       help='Resumable request manifest (default: <train-dir>/.caption_manifest.jsonl)')
+    parser.add_argument('--no-manifest', action='store_true',
+                       help='Do not record progress in the manifest (not allowed with --batch)')
+    parser.add_argument('--max-edge', type=int,
+                       help='Downscale images so the longest edge is at most this many pixels before upload')
+    parser.add_argument('--jpeg-quality', type=int, default=90,
+                       help='JPEG quality used when re-encoding downscaled images')
+    parser.add_argument('--payload-cache-dir',
+                       help='Directory for cached encoded payloads (default: <train-dir>/.payload_cache with --max-edge)')
+    metrics.add_arguments(parser)
     
     args = parser.parse_args()
+    metrics.setup(args)
     
     # Get API key
     api_key = args.api_key or os.getenv('ANTHROPIC_API_KEY')
@@ -147,7 +672,54 @@ def main():
         print(f"Error: Train directory {args.train_dir} does not exist")
         return
     
-    process_images(args.train_dir, api_key, args.start_from, args.max_images)
+    payload_options = {}
+    if args.max_edge:
+        payload_options = {
+            'max_edge': args.max_edge,
+            'quality': args.jpeg_quality,
+            'cache_dir': args.payload_cache_dir or str(Path(args.train_dir) / ".payload_cache"),
+        }
+    
+    if args.batch and args.no_manifest:
+        print("Error: --batch needs the manifest to track submitted requests")
+        return
+    
+    if args.import_caption_files and args.no_caption_store:
+        print("Error: --import-caption-files needs the caption store")
+        return
+    
+    store = None
+    if not args.no_caption_store:
+        store = CaptionStore(args.caption_store or Path(args.train_dir) / ".caption_store.sqlite")
+        if args.import_caption_files:
+            imported = import_caption_files(args.train_dir, store, args.start_from, args.max_images)
+            print(f"Imported {imported} existing caption files into the caption store")
+    
+    manifest = None
+    if not args.no_manifest:
+        manifest = CaptionManifest(args.manifest or Path(args.train_dir) / ".caption_manifest.jsonl")
+        if manifest.items:
+            print(f"Resuming from manifest: {manifest.summary()}")
+    
+    try:
+        with stage('caption'):
+            if args.batch:
+                process_images_batch(args.train_dir, api_key, manifest, args.start_from, args.max_images,
+                                     base_url=args.base_url, payload_options=payload_options, store=store,
+                                     poll_interval=args.poll_interval)
+            elif args.use_async:
+                asyncio.run(process_images_async(args.train_dir, api_key, args.start_from, args.max_images,
+                                                 concurrency=args.concurrency, requests_per_minute=args.rpm,
+                                                 tokens_per_minute=args.tpm, base_url=args.base_url,
+                                                 payload_options=payload_options, store=store, manifest=manifest))
+            else:
+                process_images(args.train_dir, api_key, args.start_from, args.max_images, base_url=args.base_url,
+                               payload_options=payload_options, store=store, manifest=manifest)
+    finally:
+        if store is not None:
+            store.close()
+        if manifest is not None:
+            manifest.close()
 
 if __name__ == "__main__":
     main()
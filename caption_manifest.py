@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Resumable manifest for caption jobs.
+Tracks custom_id -> image path -> state for every caption request in an
+append-only JSON lines log, so an interrupted run (synchronous, async or
+batch) resumes without repeating finished or already submitted work.
+"""
+
+import os
+import json
+from pathlib import Path
+
+PENDING = 'pending'
+IN_PROGRESS = 'in_progress'
+SUBMITTED = 'submitted'
+DONE = 'done'
+FAILED = 'failed'
+
+def custom_id_for(image_sha256):
+    """
+    Batch custom_id for an image, derived from its content hash so it stays
+    valid when the train folder is renumbered.
+    """
+    return f"img_{image_sha256[:48]}"
+
+class CaptionManifest:
+    """
+    Append-only log of manifest updates. The latest record per custom_id wins.
+    The log is compacted to one line per item when it is opened.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.items = {}
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A crash can leave a truncated last line
+                        continue
+                    self.items.setdefault(record['custom_id'], {}).update(record)
+            self._compact()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._log = open(self.path, 'a', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _compact(self):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for item in self.items.values():
+                f.write(json.dumps(item) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def get(self, custom_id):
+        return self.items.get(custom_id)
+
+    def state(self, custom_id):
+        item = self.items.get(custom_id)
+        return item['state'] if item else None
+
+    def update(self, custom_id, **fields):
+        """
+        Record new fields (at least state) for an item and flush them to disk.
+        """
+        item = self.items.setdefault(custom_id, {'custom_id': custom_id})
+        item.update(fields)
+        self._log.write(json.dumps({'custom_id': custom_id, **fields}) + '\n')
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    def with_state(self, *states):
+        """
+        Return the items currently in one of the given states.
+        """
+        return [item for item in self.items.values() if item.get('state') in states]
+
+    def summary(self):
+        """
+        Return a count of items per state.
+        """
+        counts = {}
+        for item in self.items.values():
+            counts[item.get('state')] = counts.get(item.get('state'), 0) + 1
+        return counts
+
+    def close(self):
+        self._log.close()
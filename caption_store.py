@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Persistent caption store keyed by image content instead of file numbering.
+Captions are stored in SQLite under (SHA-256 of the image bytes, prompt,
+model, max_tokens), so renumbering the train folder does not invalidate them.
+"""
+
+import time
+import sqlite3
+import hashlib
+from pathlib import Path
+
+def file_sha256(path, block_size=1 << 20):
+    """
+    Return the hex SHA-256 digest of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class CaptionStore:
+    """
+    SQLite-backed mapping of (image hash, prompt, model, max_tokens) -> caption.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.db_path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS captions (
+                image_sha256 TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                model TEXT NOT NULL,
+                max_tokens INTEGER NOT NULL,
+                caption TEXT NOT NULL,
+                source_path TEXT,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (image_sha256, prompt, model, max_tokens)
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS captions_by_text ON captions (caption)")
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+
+    def get(self, image_sha256, prompt, model, max_tokens):
+        """
+        Return the stored caption, or None.
+        """
+        row = self.conn.execute(
+            "SELECT caption FROM captions WHERE image_sha256 = ? AND prompt = ? AND model = ? AND max_tokens = ?",
+            (image_sha256, prompt, model, max_tokens)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, image_sha256, prompt, model, max_tokens, caption, source_path=None):
+        """
+        Store or replace a caption.
+        """
+        self.conn.execute(
+            "INSERT OR REPLACE INTO captions VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (image_sha256, prompt, model, max_tokens, caption,
+             str(source_path) if source_path else None, time.time())
+        )
+        self.conn.commit()
+
+    def contains_caption(self, caption):
+        """
+        Whether this exact caption text is stored for any image.
+        """
+        return self.conn.execute("SELECT 1 FROM captions WHERE caption = ? LIMIT 1", (caption,)).fetchone() is not None
+
+    def close(self):
+        self.conn.close()
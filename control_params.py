@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Vector storage for vanishing point control images.
+Instead of full-size JPEGs, each control image is stored as the parameters it
+is drawn from (size, vanishing point, angle step and offset, stroke widths,
+color) in a compact columnar file, and rasterized on demand at any resolution
+through the cached vp_rasterizer. When pixels must be written, encode_palette_png stores
+them losslessly as a 1-bit (or small palette) PNG.
+
+Layout: a 32-byte header followed by one contiguous, 8-byte aligned array per
+column, in COLUMNS order. Rows are sorted by key.
+"""
+
+import os
+import zlib
+import struct
+import argparse
+from pathlib import Path
+import numpy as np
+import cv2
+from vp_rasterizer import (render_control_image, DEFAULT_ANGLE_STEP, DEFAULT_LINE_WIDTH, DEFAULT_DOT_RADIUS,
+                           DEFAULT_RING_RADIUS, DEFAULT_RING_WIDTH, DEFAULT_COLOR)
+
+PARAMS_MAGIC = b'VPCTL\x00\x00\x01'
+PARAMS_VERSION = 2
+HEADER_FORMAT = '<8sIIq'
+HEADER_SIZE = 32
+MAX_KEY_LENGTH = 32
+
+COLUMNS = [
+    ('key', f'S{MAX_KEY_LENGTH}'),
+    ('image_id', f'S{MAX_KEY_LENGTH}'),
+    ('width', '<i4'),
+    ('height', '<i4'),
+    ('vp_x', '<i4'),
+    ('vp_y', '<i4'),
+    ('angle_step', '<f8'),
+    ('line_width', '<i2'),
+    ('dot_radius', '<i2'),
+    ('ring_radius', '<i2'),
+    ('ring_width', '<i2'),
+    ('color', 'u1', (3,)),
+    ('angle_offset', '<f8'),
+]
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def _column_dtype(column):
+    return np.dtype(column[1]) if len(column) == 2 else np.dtype((column[1], column[2]))
+
+def _aligned(size):
+    return (size + 7) // 8 * 8
+
+def make_params(key, image_id, width, height, vp_x, vp_y, angle_step=DEFAULT_ANGLE_STEP,
+                line_width=DEFAULT_LINE_WIDTH, dot_radius=DEFAULT_DOT_RADIUS, ring_radius=DEFAULT_RING_RADIUS,
+                ring_width=DEFAULT_RING_WIDTH, color=DEFAULT_COLOR, angle_offset=0.0):
+    """
+    Build one row for write_control_params from render_control_image arguments.
+    """
+    return {
+        'key': str(key), 'image_id': str(image_id), 'width': int(width), 'height': int(height),
+        'vp_x': int(vp_x), 'vp_y': int(vp_y), 'angle_step': float(angle_step), 'line_width': int(line_width),
+        'dot_radius': int(dot_radius), 'ring_radius': int(ring_radius), 'ring_width': int(ring_width),
+        'color': tuple(int(c) for c in color), 'angle_offset': float(angle_offset),
+    }
+
+def write_control_params(path, rows):
+    """
+    Write parameter rows (dicts as returned by make_params) to a columnar file.
+    Returns the number of rows written.
+    """
+    rows = sorted(rows, key=lambda row: row['key'])
+    for row in rows:
+        if len(row['key'].encode('utf-8')) > MAX_KEY_LENGTH or len(row['image_id'].encode('utf-8')) > MAX_KEY_LENGTH:
+            raise ValueError(f"Key or image id longer than {MAX_KEY_LENGTH} bytes: {row['key']}")
+    
+    path = Path(path)
+    header = struct.pack(HEADER_FORMAT, PARAMS_MAGIC, PARAMS_VERSION, len(COLUMNS), len(rows))
+    
+    # Write to a temporary file and swap it in, so readers never see a partial file
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\x00'))
+        for column in COLUMNS:
+            name = column[0]
+            values = [row[name].encode('utf-8') if isinstance(row[name], str) else row[name] for row in rows]
+            data = np.array(values, dtype=_column_dtype(column)).tobytes()
+            f.write(data.ljust(_aligned(len(data)), b'\x00'))
+    os.replace(tmp_path, path)
+    return len(rows)
+
+class ControlParams:
+    """
+    Memory-mapped columnar control parameters with on-demand rasterization.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            raw = f.read(HEADER_SIZE)
+        if len(raw) < HEADER_SIZE:
+            raise ValueError(f"Not a control parameter file: {path}")
+        magic, version, column_count, count = struct.unpack_from(HEADER_FORMAT, raw)
+        if magic != PARAMS_MAGIC or version != PARAMS_VERSION or column_count != len(COLUMNS):
+            raise ValueError(f"Not a control parameter file: {path}")
+        
+        self.columns = {}
+        offset = HEADER_SIZE
+        for column in COLUMNS:
+            dtype = _column_dtype(column)
+            if count:
+                self.columns[column[0]] = np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+            else:
+                self.columns[column[0]] = np.zeros(0, dtype=dtype)
+            offset += _aligned(dtype.itemsize * count)
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def _position(self, key):
+        keys = self.columns['key']
+        encoded = np.array(str(key).encode('utf-8'), dtype=keys.dtype)
+        pos = int(np.searchsorted(keys, encoded))
+        if pos < len(keys) and keys[pos] == encoded:
+            return pos
+        return None
+
+    def __contains__(self, key):
+        return self._position(key) is not None
+
+    def keys(self):
+        """
+        Return all keys in sorted order.
+        """
+        return [key.decode('utf-8') for key in self.columns['key']]
+
+    def params(self, key):
+        """
+        Return the row for key as a dict like make_params. Raises KeyError for unknown keys.
+        """
+        pos = self._position(key)
+        if pos is None:
+            raise KeyError(key)
+        row = {}
+        for name, column in self.columns.items():
+            value = column[pos]
+            if name in ('key', 'image_id'):
+                row[name] = value.decode('utf-8')
+            elif name == 'color':
+                row[name] = tuple(int(c) for c in value)
+            elif name in ('angle_step', 'angle_offset'):
+                row[name] = float(value)
+            else:
+                row[name] = int(value)
+        return row
+
+    def render(self, key, width=None, height=None):
+        """
+        Rasterize the control image for key, at its stored size or scaled to
+        width x height. Stroke widths and radii are scaled with the smaller
+        axis scale. Renders are cached; the returned array is read-only.
+        """
+        row = self.params(key)
+        width = width or row['width']
+        height = height or row['height']
+        scale_x = width / row['width']
+        scale_y = height / row['height']
+        scale = min(scale_x, scale_y)
+
+        def stroke(value):
+            return max(1, round(value * scale)) if value > 0 else 0
+        
+        return render_control_image(width, height, int(row['vp_x'] * scale_x), int(row['vp_y'] * scale_y),
+                                    row['angle_step'], stroke(row['line_width']), stroke(row['dot_radius']),
+                                    stroke(row['ring_radius']), stroke(row['ring_width']), row['color'],
+                                    row['angle_offset'])
+
+    def __getitem__(self, key):
+        return self.render(key)
+
+class ControlParamsWriter:
+    """
+    Collect parameter rows and write them to a columnar file on close.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+
+    def close(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        write_control_params(self.path, self.rows)
+
+def _png_chunk(chunk_type, data):
+    return (struct.pack('>I', len(data)) + chunk_type + data
+            + struct.pack('>I', zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+def encode_palette_png(image, compression=9):
+    """
+    Losslessly encode a BGR image with at most 256 colors as a palette PNG.
+    Control images (black plus one color) become 1-bit PNGs. Returns the PNG
+    bytes, or None if the image has more than 256 colors.
+    """
+    height, width = image.shape[:2]
+    channels = image.shape[2] if image.ndim == 3 else 1
+    pixels = np.ascontiguousarray(image).reshape(-1, channels)
+    # Pack every pixel into one integer, so np.unique sorts scalars instead of rows (same order)
+    codes = np.zeros(len(pixels), dtype=np.uint32)
+    for channel in range(channels):
+        codes = (codes << np.uint32(8)) | pixels[:, channel]
+    # Control images have a handful of colors: peel them off in linear passes and only sort busier images
+    found = []
+    remaining = codes
+    while len(remaining) and len(found) < 16:
+        found.append(remaining[0])
+        remaining = remaining[remaining != remaining[0]]
+    if len(remaining):
+        unique_codes, indices = np.unique(codes, return_inverse=True)
+    else:
+        unique_codes = np.sort(np.array(found, dtype=np.uint32))
+        indices = np.searchsorted(unique_codes, codes)
+    if len(unique_codes) > 256:
+        return None
+    shifts = np.arange(channels - 1, -1, -1, dtype=np.uint32) * np.uint32(8)
+    colors = ((unique_codes[:, None] >> shifts) & np.uint32(255)).astype(np.uint8)
+    indices = indices.reshape(height, width).astype(np.uint8)
+    
+    bit_depth = 1 if len(colors) <= 2 else 2 if len(colors) <= 4 else 4 if len(colors) <= 16 else 8
+    if bit_depth < 8:
+        # Pack 8 // bit_depth pixels per byte, leftmost pixel in the high bits
+        per_byte = 8 // bit_depth
+        padded = np.zeros((height, -(-width // per_byte) * per_byte), dtype=np.uint8)
+        padded[:, :width] = indices
+        groups = padded.reshape(height, -1, per_byte)
+        shifts = np.arange(per_byte - 1, -1, -1, dtype=np.uint8) * bit_depth
+        rows = np.bitwise_or.reduce(groups << shifts, axis=2).astype(np.uint8)
+    else:
+        rows = indices
+    # Filter type 0 (None) in front of every scanline
+    scanlines = np.hstack([np.zeros((height, 1), dtype=np.uint8), rows])
+    
+    if colors.shape[1] == 1:
+        palette = np.repeat(colors, 3, axis=1)
+    else:
+        palette = colors[:, 2::-1]
+    
+    return (PNG_SIGNATURE
+            + _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bit_depth, 3, 0, 0, 0))
+            + _png_chunk(b'PLTE', palette.astype(np.uint8).tobytes())
+            + _png_chunk(b'IDAT', zlib.compress(scanlines.tobytes(), compression))
+            + _png_chunk(b'IEND', b''))
+
+def control_png_bytes(image):
+    """
+    Encode a control image as a palette PNG, falling back to cv2 for images
+    with too many colors.
+    """
+    data = encode_palette_png(image)
+    if data is None:
+        ok, encoded = cv2.imencode('.png', image)
+        data = encoded.tobytes()
+    return data
+
+def write_control_png(path, image):
+    """
+    Write a control image as a palette PNG (see control_png_bytes).
+    """
+    data = control_png_bytes(image)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or rasterize stored control image parameters')
+    parser.add_argument('params_file',
+                       help='Columnar control parameter file')
+    parser.add_argument('--key',
+                       help='Key to rasterize (default: list all keys)')
+    parser.add_argument('--output',
+                       help='Write the rasterized control image here (.png gives a palette PNG)')
+    parser.add_argument('--width', type=int,
+                       help='Rasterize at this width instead of the stored one')
+    parser.add_argument('--height', type=int,
+                       help='Rasterize at this height instead of the stored one')
+    
+    args = parser.parse_args()
+    
+    params = ControlParams(args.params_file)
+    if not args.key:
+        for key in params.keys():
+            row = params.params(key)
+            print(f"{key}  {row['image_id']}  {row['width']}x{row['height']}  vp=({row['vp_x']}, {row['vp_y']})")
+        print(f"{len(params)} control images, {os.path.getsize(args.params_file)} bytes")
+        return
+    
+    image = params.render(args.key, args.width, args.height)
+    if not args.output:
+        print(params.params(args.key))
+    elif args.output.lower().endswith('.png'):
+        write_control_png(args.output, image)
+    else:
+        cv2.imwrite(args.output, image)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+HTTP service for vanishing point control images.
+GET /control?w=&h=&vx=&vy=&step= returns the control image as the 1-bit
+palette PNG that process_vanishing_points writes for training, drawn by the
+same vp_rasterizer, so the web app's inference control images are pixel
+identical to the training data. Encoded PNGs are kept in an LRU cache bounded
+by total bytes; responses carry a content ETag and If-None-Match requests get
+a 304 without a body. With --quantize the vanishing point is snapped to a
+grid, so nearby clicks share cache entries.
+
+Built on asyncio streams (standard library only); rendering and encoding run
+in a thread pool. Concurrent requests for the same image render it once.
+/stats returns the cache counters as JSON and /metrics in Prometheus text.
+"""
+
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+from vp_rasterizer import draw_control_image, DEFAULT_ANGLE_STEP
+from control_params import control_png_bytes
+from metrics import METRICS, stage, increment, observe
+
+MAX_SIZE = 4096
+# Vanishing points may lie outside the frame, but not arbitrarily far
+MAX_VP_FACTOR = 8
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+class PngCache:
+    """
+    LRU cache of encoded control images, bounded by total bytes and entries.
+    Values are (etag, png) pairs.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entries=4096):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        if len(entry[1]) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old[1])
+        self.entries[key] = entry
+        self.bytes += len(entry[1])
+        while self.bytes > self.max_bytes or len(self.entries) > self.max_entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= len(evicted[1])
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+def parse_control_query(query, quantize=1):
+    """
+    Parse and validate the /control query string into a cache key
+    (width, height, vp_x, vp_y, angle_step). The vanishing point is truncated
+    to whole pixels like render_control_image does, after snapping to a
+    multiple of quantize. Raises ValueError with a message for the client.
+    """
+    values = parse_qs(query)
+
+    def number(name, default=None):
+        if name not in values:
+            if default is None:
+                raise ValueError(f"Missing parameter: {name}")
+            return default
+        try:
+            value = float(values[name][-1])
+        except ValueError:
+            raise ValueError(f"Parameter {name} is not a number") from None
+        if not np.isfinite(value):
+            raise ValueError(f"Parameter {name} is not finite")
+        return value
+    
+    width, height = int(number('w')), int(number('h'))
+    if not (0 < width <= MAX_SIZE and 0 < height <= MAX_SIZE):
+        raise ValueError(f"Image size must be between 1 and {MAX_SIZE} pixels")
+    vp_x, vp_y = number('vx'), number('vy')
+    if quantize > 1:
+        vp_x, vp_y = round(vp_x / quantize) * quantize, round(vp_y / quantize) * quantize
+    vp_x, vp_y = int(vp_x), int(vp_y)
+    if abs(vp_x) > MAX_VP_FACTOR * width or abs(vp_y) > MAX_VP_FACTOR * height:
+        raise ValueError("Vanishing point is too far outside the image")
+    angle_step = number('step', DEFAULT_ANGLE_STEP)
+    if not 0 < angle_step <= 360:
+        raise ValueError("Angle step must be between 0 and 360 degrees")
+    return width, height, vp_x, vp_y, angle_step
+
+def render_png(key):
+    """
+    Render and encode the control image for a cache key. Returns (etag, png).
+    Drawn on a fresh array rather than through render_control_image, so the
+    rasterizer's array cache does not hold a second copy of every image.
+    """
+    width, height, vp_x, vp_y, angle_step = key
+    with stage('control_render'):
+        image = np.zeros((height, width, 3), dtype=np.uint8)
+        draw_control_image(image, vp_x, vp_y, angle_step)
+        png = control_png_bytes(image)
+    etag = '"' + hashlib.blake2b(png, digest_size=12).hexdigest() + '"'
+    return etag, png
+
+def _etag_matches(header, etag):
+    if not header:
+        return False
+    return header.strip() == '*' or etag in (tag.strip().removeprefix('W/') for tag in header.split(','))
+
+class ControlServer:
+    """
+    Serves control images from a PngCache, rendering misses in a thread pool.
+    """
+
+    def __init__(self, cache_bytes=64 * 1024 * 1024, cache_entries=4096, quantize=1, workers=4, max_age=86400):
+        self.cache = PngCache(cache_bytes, cache_entries)
+        self.quantize = quantize
+        self.max_age = max_age
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Renders in progress, so concurrent requests for one image share a single render
+        self.pending = {}
+
+    async def control_image(self, key):
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry
+        future = self.pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self.pending[key] = loop.run_in_executor(self.executor, render_png, key)
+            future.add_done_callback(lambda done: self._rendered(key, done))
+        # Shielded, so a client hanging up does not cancel a render other requests wait for
+        return await asyncio.shield(future)
+
+    def _rendered(self, key, future):
+        del self.pending[key]
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(key, future.result())
+
+    async def respond(self, method, target, headers):
+        """
+        Return (status, headers, body) for one request.
+        """
+        url = urlsplit(target)
+        if method not in ('GET', 'HEAD'):
+            return self._json(405, {'error': f"Method not allowed: {method}"}, {'Allow': 'GET, HEAD'})
+        if url.path == '/stats':
+            return self._json(200, self.cache.stats())
+        if url.path == '/metrics':
+            return 200, {'Content-Type': 'text/plain; version=0.0.4'}, METRICS.to_prometheus().encode('utf-8')
+        if url.path != '/control':
+            return self._json(404, {'error': f"Not found: {url.path}"})
+        
+        try:
+            key = parse_control_query(url.query, self.quantize)
+        except ValueError as e:
+            return self._json(400, {'error': str(e)})
+        etag, png = await self.control_image(key)
+        response_headers = {
+            'ETag': etag,
+            'Cache-Control': f'public, max-age={self.max_age}',
+            'X-Vanishing-Point': f'{key[2]},{key[3]}',
+        }
+        if _etag_matches(headers.get('if-none-match'), etag):
+            return 304, response_headers, b''
+        return 200, {'Content-Type': 'image/png', **response_headers}, png
+
+    @staticmethod
+    def _json(status, payload, headers=None):
+        return status, {'Content-Type': 'application/json', **(headers or {})}, json.dumps(payload).encode('utf-8')
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve HTTP/1.1 requests on one connection until the client closes it
+        or asks for Connection: close.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    await self._write(writer, 'GET', *self._json(400, {'error': 'Malformed request line'}), False)
+                    break
+                method, target, version = parts
+                # Request bodies are not used, but must be consumed to keep the connection in sync
+                length = int(headers.get('content-length', 0) or 0)
+                if length:
+                    await reader.readexactly(length)
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+                
+                started = time.perf_counter()
+                status, response_headers, body = await self.respond(method, target, headers)
+                observe('control_request_seconds', time.perf_counter() - started)
+                increment('control_requests', status=str(status))
+                await self._write(writer, method, status, response_headers, body, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # Dropped connections, truncated bodies and oversized header lines end the connection
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _write(writer, method, status, headers, body, keep_alive):
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+                f"Content-Length: {len(body)}",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}",
+                "Access-Control-Allow-Origin: *",
+                "Access-Control-Expose-Headers: ETag, X-Vanishing-Point"]
+        head += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        if method != 'HEAD' and status != 304:
+            writer.write(body)
+        await writer.drain()
+
+async def serve(host='127.0.0.1', port=8765, **options):
+    """
+    Run a ControlServer until cancelled.
+    """
+    server = ControlServer(**options)
+    listener = await asyncio.start_server(server.handle_connection, host, port)
+    addresses = ', '.join(f"{sock.getsockname()[0]}:{sock.getsockname()[1]}" for sock in listener.sockets)
+    print(f"Control image service listening on {addresses}")
+    async with listener:
+        await listener.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve vanishing point control images over HTTP')
+    parser.add_argument('--host', default='127.0.0.1',
+                       help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765,
+                       help='Port to listen on')
+    parser.add_argument('--cache-mb', type=float, default=64,
+                       help='Maximum total size of the cached PNGs in MB')
+    parser.add_argument('--cache-entries', type=int, default=4096,
+                       help='Maximum number of cached PNGs')
+    parser.add_argument('--quantize', type=int, default=1,
+                       help='Snap vanishing points to multiples of this many pixels')
+    parser.add_argument('--workers', type=int, default=4,
+                       help='Number of render threads')
+    parser.add_argument('--max-age', type=int, default=86400,
+                       help='Cache-Control max-age of control images in seconds')
+    
+    args = parser.parse_args()
+    
+    try:
+        asyncio.run(serve(args.host, args.port, cache_bytes=int(args.cache_mb * 1024 * 1024),
+                          cache_entries=args.cache_entries, quantize=args.quantize, workers=args.workers,
+                          max_age=args.max_age))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
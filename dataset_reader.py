@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+"""
+Prefetching reader for training pairs.
+Opens an organized layout (train_control/N.jpg, train_end/N.jpg and
+train_end/N.txt) or a directory of dataset_shards tar shards once, decodes the
+control/end JPEG pairs on a thread pool with a bounded number of samples in
+flight, and yields them in a deterministic, seeded order that is split across
+ranks (data loader workers times nodes). Sample keys and captions are kept in
+one memory-mapped sample table next to the data, rebuilt when the data
+changes, so opening a large layout takes a directory listing and one stat per
+caption instead of reading every caption.
+Controls stored as parameters (stream_pipeline --control-format params) are
+rasterized from train_control.vpctl. report() gives the samples per second and
+how long the consumer waited on the reader.
+
+Table layout: a 32-byte header, the sample keys as fixed-size records, one
+control kind byte per sample (padded to 8 bytes), count + 1 caption offsets
+and the concatenated UTF-8 captions.
+"""
+
+import os
+import time
+import struct
+import hashlib
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import cv2
+import metrics
+from metrics import stage, increment
+from dataset_shards import ShardReader, INDEX_SUFFIX
+from control_params import ControlParams, control_png_bytes
+
+TABLE_MAGIC = b'VPTAB\x00\x00\x01'
+TABLE_VERSION = 1
+HEADER_FORMAT = '<8sIIqq'
+HEADER_SIZE = 32
+MAX_KEY_LENGTH = 32
+KEY_DTYPE = np.dtype(f'S{MAX_KEY_LENGTH}')
+
+# Control kinds: where the control image of a sample comes from
+CONTROL_PARAMS, CONTROL_JPG, CONTROL_PNG = 0, 1, 2
+CONTROL_EXTENSIONS = {CONTROL_JPG: 'jpg', CONTROL_PNG: 'png'}
+
+def _aligned(size):
+    return (size + 7) // 8 * 8
+
+def source_stamp(paths, caption_dir=None):
+    """
+    Fingerprint of the name, size and mtime of paths, stored in the table
+    header. Layouts stamp their directories (written files are renamed into
+    place, which updates the directory mtime), shard dirs every shard and index.
+    With caption_dir, the count, total size and newest mtime of its .txt files
+    are included too, since captions rewritten in place leave the directory
+    mtime unchanged.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{Path(path).name}:{stat.st_size}:{stat.st_mtime_ns};".encode('utf-8'))
+    if caption_dir is not None:
+        count = total_size = newest = 0
+        with os.scandir(caption_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.txt') and entry.is_file():
+                    stat = entry.stat()
+                    count += 1
+                    total_size += stat.st_size
+                    newest = max(newest, stat.st_mtime_ns)
+        digest.update(f"captions:{count}:{total_size}:{newest};".encode('utf-8'))
+    return int.from_bytes(digest.digest(), 'little', signed=True)
+
+def write_sample_table(path, keys, control_kinds, captions, stamp):
+    """
+    Write a sample table with keys, control kinds and captions (str or None).
+    """
+    encoded = [(caption or '').encode('utf-8') for caption in captions]
+    offsets = np.zeros(len(encoded) + 1, dtype='<u8')
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    kinds = np.zeros(_aligned(len(keys)), dtype=np.uint8)
+    kinds[:len(keys)] = control_kinds
+    
+    header = struct.pack(HEADER_FORMAT, TABLE_MAGIC, TABLE_VERSION, KEY_DTYPE.itemsize, len(keys), stamp)
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\x00'))
+        f.write(np.array([key.encode('utf-8') for key in keys], dtype=KEY_DTYPE).tobytes())
+        f.write(kinds.tobytes())
+        f.write(offsets.tobytes())
+        f.write(b''.join(encoded))
+    os.replace(tmp_path, path)
+
+class SampleTable:
+    """
+    Memory-mapped sample keys, control kinds and captions.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            raw = f.read(HEADER_SIZE)
+        if len(raw) < HEADER_SIZE:
+            raise ValueError(f"Not a sample table: {path}")
+        magic, version, key_size, count, self.stamp = struct.unpack_from(HEADER_FORMAT, raw)
+        if magic != TABLE_MAGIC or version != TABLE_VERSION or key_size != KEY_DTYPE.itemsize:
+            raise ValueError(f"Not a sample table: {path}")
+        
+        self.count = count
+        self.data = np.memmap(self.path, dtype=np.uint8, mode='r')
+        offset = HEADER_SIZE
+        self.keys = self.data[offset:offset + count * key_size].view(KEY_DTYPE)
+        offset += count * key_size
+        self.control_kinds = self.data[offset:offset + count]
+        offset += _aligned(count)
+        self.offsets = self.data[offset:offset + (count + 1) * 8].view('<u8')
+        offset += (count + 1) * 8
+        self.captions = self.data[offset:]
+        if len(self.offsets) != count + 1 or len(self.captions) != (int(self.offsets[-1]) if count else 0):
+            raise ValueError(f"Truncated sample table: {path}")
+
+    def __len__(self):
+        return self.count
+
+    def key(self, index):
+        return self.keys[index].decode('utf-8')
+
+    def caption(self, index):
+        return bytes(self.captions[self.offsets[index]:self.offsets[index + 1]]).decode('utf-8')
+
+def _layout_samples(layout_dir, has_params):
+    """
+    Scan an organized layout once. Returns (keys, control_kinds, captions) of
+    the samples with a target image and a control image (or parameters).
+    """
+    control_dir = Path(layout_dir) / "train_control"
+    end_dir = Path(layout_dir) / "train_end"
+    controls = {}
+    if control_dir.is_dir():
+        with os.scandir(control_dir) as entries:
+            for entry in entries:
+                stem, _, ext = entry.name.partition('.')
+                if ext in ('jpg', 'png') and stem.isdigit():
+                    controls[stem] = CONTROL_JPG if ext == 'jpg' else CONTROL_PNG
+    targets, caption_ids = set(), set()
+    with os.scandir(end_dir) as entries:
+        for entry in entries:
+            stem, _, ext = entry.name.partition('.')
+            if stem.isdigit():
+                if ext == 'jpg':
+                    targets.add(stem)
+                elif ext == 'txt':
+                    caption_ids.add(stem)
+    
+    keys = sorted((key for key in targets if key in controls or has_params), key=int)
+    captions = [(end_dir / f"{key}.txt").read_text(encoding='utf-8') if key in caption_ids else None
+                for key in keys]
+    return keys, [controls.get(key, CONTROL_PARAMS) for key in keys], captions
+
+def _shard_samples(shard_reader):
+    """
+    Read keys, control kinds and captions from the shard indexes and txt members.
+    """
+    keys, kinds, captions = [], [], []
+    for key in sorted(shard_reader.keys()):
+        members = shard_reader.locations[key][1]
+        if 'end.jpg' not in members:
+            continue
+        keys.append(key)
+        kinds.append(CONTROL_JPG if 'control.jpg' in members else CONTROL_PNG if 'control.png' in members
+                     else CONTROL_PARAMS)
+        text = shard_reader.get(key, ('txt',)).get('txt')
+        captions.append(text.decode('utf-8') if text is not None else None)
+    return keys, kinds, captions
+
+class DatasetReader:
+    """
+    Iterable over the training pairs of a layout or shard directory.
+    Each sample is a dict with 'key', 'control' and 'end' (BGR uint8 arrays,
+    or the encoded bytes with decode=False) and 'caption' ('' if missing).
+    
+    Every epoch visits the samples in a permutation seeded by (seed, epoch)
+    and this reader yields every world_size-th of them starting at rank, so
+    readers with the same seed and epoch split the data without overlap. Like
+    torch's DistributedSampler the order is padded so every rank gets the same
+    number of samples, and set_epoch must be called to reshuffle. With data
+    loader workers on several nodes, use rank = node_rank * workers + worker_id.
+    """
+
+    def __init__(self, data_dir, prefix="train", shuffle=True, seed=0, rank=0, world_size=1, workers=4, prefetch=16,
+                 decode=True, transform=None, control_params=None, table_path=None, rebuild=False):
+        if not 0 <= rank < world_size:
+            raise ValueError(f"rank must be in [0, {world_size}), got {rank}")
+        self.data_dir = Path(data_dir)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.workers = workers
+        self.prefetch = max(1, prefetch)
+        self.decode = decode
+        self.transform = transform
+        self.epoch = 0
+        
+        self.shards = None
+        caption_dir = None
+        if (self.data_dir / "train_end").is_dir():
+            caption_dir = self.data_dir / "train_end"
+            stamp_paths = [path for path in (self.data_dir / "train_control", self.data_dir / "train_end")
+                           if path.exists()]
+            default_table = self.data_dir / "train.vptab"
+            default_params = self.data_dir / "train_control.vpctl"
+        else:
+            self.shards = ShardReader(self.data_dir, prefix)
+            if not self.shards.shards:
+                raise FileNotFoundError(f"No train_end folder or {prefix}-*.tar shards in {data_dir}")
+            stamp_paths = [path for shard in self.shards.shards
+                           for path in (shard, shard.with_name(shard.name + INDEX_SUFFIX)) if path.exists()]
+            default_table = self.data_dir / f"{prefix}.vptab"
+            default_params = self.data_dir / f"{prefix}_control.vpctl"
+        
+        params_path = Path(control_params) if control_params else default_params
+        self.control_params = ControlParams(params_path) if params_path.exists() else None
+        self.table = self._open_table(Path(table_path) if table_path else default_table,
+                                      source_stamp(stamp_paths, caption_dir), rebuild)
+        if self.shards is not None:
+            self._shard_fds = [os.open(shard, os.O_RDONLY) for shard in self.shards.shards]
+        
+        self.executor = None
+        self.samples = 0
+        self.wait_seconds = 0.0
+        self.elapsed_seconds = 0.0
+
+    def _open_table(self, path, stamp, rebuild):
+        if not rebuild and path.exists():
+            try:
+                table = SampleTable(path)
+            except ValueError:
+                table = None
+            if table is not None and table.stamp == stamp:
+                return table
+        if self.shards is not None:
+            keys, kinds, captions = _shard_samples(self.shards)
+        else:
+            keys, kinds, captions = _layout_samples(self.data_dir, self.control_params is not None)
+        write_sample_table(path, keys, kinds, captions, stamp)
+        print(f"Indexed {len(keys)} samples: {path}")
+        return SampleTable(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        """
+        Number of samples this rank yields per epoch.
+        """
+        return -(-len(self.table) // self.world_size)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def indices(self, epoch=None):
+        """
+        Table positions this rank visits in the given (default: current) epoch.
+        """
+        count = len(self.table)
+        epoch = self.epoch if epoch is None else epoch
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, epoch]).permutation(count)
+        else:
+            order = np.arange(count)
+        if count:
+            # Wrap around (repeatedly when there are fewer samples than ranks) so every rank gets len(self)
+            order = np.resize(order, len(self) * self.world_size)
+        return order[self.rank::self.world_size]
+
+    def _read(self, index, kind):
+        key = self.table.key(index)
+        if self.shards is None:
+            end_dir = self.data_dir / "train_end"
+            with open(end_dir / f"{key}.jpg", 'rb') as f:
+                end = f.read()
+            control = None
+            if kind != CONTROL_PARAMS:
+                with open(self.data_dir / "train_control" / f"{key}.{CONTROL_EXTENSIONS[kind]}", 'rb') as f:
+                    control = f.read()
+            return end, control
+        
+        shard_number, members = self.shards.locations[key]
+        fd = self._shard_fds[shard_number]
+        # os.pread does not move a shared file position, so threads can read the same shard
+        end = os.pread(fd, members['end.jpg'][1], members['end.jpg'][0])
+        control = None
+        if kind != CONTROL_PARAMS:
+            offset, size = members[f"control.{CONTROL_EXTENSIONS[kind]}"]
+            control = os.pread(fd, size, offset)
+        return end, control
+
+    def load(self, index):
+        """
+        Read and decode the sample at a table position. Runs on the thread pool.
+        """
+        kind = int(self.table.control_kinds[index])
+        key = self.table.key(index)
+        with stage('dataset_read'):
+            end, control = self._read(index, kind)
+            increment('bytes_read', len(end) + (len(control) if control is not None else 0))
+        
+        sample = {'key': key, 'caption': self.table.caption(index)}
+        if self.decode:
+            with stage('dataset_decode'):
+                sample['end'] = cv2.imdecode(np.frombuffer(end, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if control is not None:
+                    sample['control'] = cv2.imdecode(np.frombuffer(control, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if sample['end'] is None or (control is not None and sample['control'] is None):
+                raise ValueError(f"Could not decode sample {key}")
+        else:
+            sample['end'] = end
+            sample['control'] = control
+        
+        if kind == CONTROL_PARAMS:
+            if self.control_params is None:
+                raise ValueError(f"Sample {key} has no control image and no control parameters")
+            with stage('dataset_decode'):
+                control = np.array(self.control_params.render(f"{int(key):06d}"))
+            sample['control'] = control if self.decode else control_png_bytes(control)
+        
+        if self.transform is not None:
+            sample = self.transform(sample)
+        return sample
+
+    def __iter__(self):
+        """
+        Yield this rank's samples for the current epoch, keeping up to
+        prefetch samples read and decoded ahead of the consumer.
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        positions = iter(self.indices())
+        self.samples = 0
+        self.wait_seconds = 0.0
+        self.elapsed_seconds = 0.0
+        pending = deque(self.executor.submit(self.load, int(index))
+                        for _, index in zip(range(self.prefetch), positions))
+        last = time.perf_counter()
+        try:
+            while pending:
+                future = pending.popleft()
+                waited = time.perf_counter()
+                with stage('dataset_wait'):
+                    sample = future.result()
+                now = time.perf_counter()
+                self.wait_seconds += now - waited
+                index = next(positions, None)
+                if index is not None:
+                    pending.append(self.executor.submit(self.load, int(index)))
+                self.samples += 1
+                increment('samples_loaded')
+                self.elapsed_seconds += now - last
+                last = now
+                yield sample
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def stats(self):
+        """
+        Samples yielded in the current (or last) epoch, wall-clock seconds
+        until the last of them was ready, how many of those the consumer spent
+        waiting on the reader, and the resulting samples per second.
+        """
+        return {
+            'samples': self.samples,
+            'seconds': self.elapsed_seconds,
+            'wait_seconds': self.wait_seconds,
+            'samples_per_second': self.samples / self.elapsed_seconds if self.elapsed_seconds else 0.0,
+        }
+
+    def report(self):
+        """
+        One-line throughput summary. If the consumer waited for only a small
+        fraction of the time, data loading is not the bottleneck.
+        """
+        stats = self.stats()
+        waited = stats['wait_seconds'] / stats['seconds'] if stats['seconds'] else 0.0
+        return (f"{stats['samples']} samples in {stats['seconds']:.1f}s ({stats['samples_per_second']:.1f} samples/s), "
+                f"waited on the reader {waited:.0%} of the time")
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+        if self.shards is not None:
+            for fd in self._shard_fds:
+                os.close(fd)
+            self._shard_fds = []
+            self.shards.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Read training pairs with prefetching and report the throughput')
+    parser.add_argument('--data-dir', default='/Users/Jasper/Projects/kontext_hack',
+                       help='Directory with train_control and train_end, or with tar shards')
+    parser.add_argument('--prefix', default='train',
+                       help='Shard file name prefix')
+    parser.add_argument('--workers', type=int, default=4,
+                       help='Number of decode threads')
+    parser.add_argument('--prefetch', type=int, default=16,
+                       help='Maximum number of samples read ahead of the consumer')
+    parser.add_argument('--no-shuffle', action='store_true',
+                       help='Visit the samples in key order')
+    parser.add_argument('--seed', type=int, default=0,
+                       help='Shuffle seed, shared by all ranks')
+    parser.add_argument('--epochs', type=int, default=1,
+                       help='Number of epochs to read')
+    parser.add_argument('--rank', type=int, default=0,
+                       help='Rank of this reader')
+    parser.add_argument('--world-size', type=int, default=1,
+                       help='Total number of readers the data is split across')
+    parser.add_argument('--step-ms', type=float, default=0,
+                       help='Simulated training step time per sample in milliseconds')
+    parser.add_argument('--control-params',
+                       help='Control parameter file for samples without control images (default: train_control.vpctl in data-dir)')
+    parser.add_argument('--rebuild', action='store_true',
+                       help='Rebuild the sample table even if it is up to date')
+    metrics.add_arguments(parser)
+    
+    args = parser.parse_args()
+    metrics.setup(args)
+    
+    with DatasetReader(args.data_dir, args.prefix, shuffle=not args.no_shuffle, seed=args.seed, rank=args.rank,
+                       world_size=args.world_size, workers=args.workers, prefetch=args.prefetch,
+                       control_params=args.control_params, rebuild=args.rebuild) as reader:
+        print(f"Reading {len(reader)} samples per epoch (rank {args.rank} of {args.world_size})")
+        for epoch in range(args.epochs):
+            reader.set_epoch(epoch)
+            for sample in reader:
+                if args.step_ms:
+                    time.sleep(args.step_ms / 1000)
+            print(f"Epoch {epoch}: {reader.report()}")
+
+if __name__ == "__main__":
+    main()
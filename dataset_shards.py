@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+WebDataset-style tar shards for training pairs.
+Each sample is stored as consecutive tar members sharing a key, e.g.
+000001.control.jpg, 000001.end.jpg, 000001.txt and 000001.json, and shards
+are cut at a configurable size so a dataset is a few large files instead of
+tens of thousands of small ones. Every shard has a sidecar .idx file (JSON
+lines with the data offset and size of each member) for random access.
+"""
+
+import io
+import os
+import json
+import shutil
+import tarfile
+import argparse
+from pathlib import Path
+
+SHARD_PATTERN = "{prefix}-{number:06d}.tar"
+INDEX_SUFFIX = ".idx"
+
+def _padded(size):
+    return (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+class ShardWriter:
+    """
+    Write samples (dicts of extension -> bytes plus a '__key__') into tar
+    shards of at most max_size bytes and optionally max_samples samples.
+    A sample is never split across shards. Shards and their indexes are
+    staged in a hidden directory under output_dir and only moved into place by
+    commit(), which also removes shards left over from earlier runs; abort()
+    discards them, so an interrupted run leaves the previous shards intact.
+    Used as a context manager, the block commits when it finishes without an
+    exception and aborts otherwise.
+    """
+
+    def __init__(self, output_dir, prefix="train", max_size=512 * 1024 * 1024, max_samples=None):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+        self.max_size = max_size
+        self.max_samples = max_samples
+        self.shard_number = 0
+        self.shards = []
+        self.tar = None
+        self.samples = 0
+        self.staging_dir = self.output_dir / f".{prefix}-staging"
+        # Left over from an aborted run
+        if self.staging_dir.exists():
+            shutil.rmtree(self.staging_dir)
+        self.staging_dir.mkdir()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+            self.commit()
+        else:
+            self.abort()
+
+    def _open_shard(self):
+        self.shard_path = self.output_dir / SHARD_PATTERN.format(prefix=self.prefix, number=self.shard_number)
+        self.tmp_path = self.staging_dir / f".{self.shard_path.name}.tmp"
+        self.tar = tarfile.open(self.tmp_path, 'w', format=tarfile.USTAR_FORMAT)
+        self.index = []
+        self.shard_number += 1
+
+    def _close_shard(self):
+        self.tar.close()
+        self.tar = None
+        with open(self.staging_dir / (self.shard_path.name + INDEX_SUFFIX), 'w', encoding='utf-8') as f:
+            for record in self.index:
+                f.write(json.dumps(record) + '\n')
+        os.replace(self.tmp_path, self.staging_dir / self.shard_path.name)
+        self.shards.append(self.shard_path)
+
+    def write(self, sample):
+        """
+        Append one sample. Values may be bytes or str (stored as UTF-8).
+        """
+        key = sample['__key__']
+        members = {ext: value.encode('utf-8') if isinstance(value, str) else value
+                   for ext, value in sample.items() if ext != '__key__' and value is not None}
+        sample_size = sum(tarfile.BLOCKSIZE + _padded(len(data)) for data in members.values())
+        
+        if self.tar is not None and self.index and (
+                self.tar.offset + sample_size > self.max_size
+                or (self.max_samples and len(self.index) >= self.max_samples)):
+            self._close_shard()
+        if self.tar is None:
+            self._open_shard()
+        
+        offsets = {}
+        for ext, data in members.items():
+            info = tarfile.TarInfo(f"{key}.{ext}")
+            info.size = len(data)
+            info.mode = 0o644
+            # Fixed mtime so rebuilding the same samples gives identical shards
+            info.mtime = 0
+            self.tar.addfile(info, io.BytesIO(data))
+            offsets[ext] = [self.tar.offset - _padded(len(data)), len(data)]
+        self.index.append({'key': key, 'members': offsets})
+        self.samples += 1
+
+    def close(self):
+        """
+        Finish the last shard (still staged until commit).
+        """
+        if self.tar is not None:
+            self._close_shard()
+
+    def commit(self):
+        """
+        Move the staged shards and indexes into output_dir and remove shards
+        with this prefix that the writer did not produce, e.g. left over from
+        a longer earlier run. Call after close() at the end of a complete run.
+        """
+        for shard_path in self.shards:
+            index_name = shard_path.name + INDEX_SUFFIX
+            os.replace(self.staging_dir / shard_path.name, shard_path)
+            os.replace(self.staging_dir / index_name, shard_path.with_name(index_name))
+        written = {path.name for path in self.shards}
+        for path in self.output_dir.glob(f"{self.prefix}-*.tar"):
+            if path.name not in written:
+                path.unlink()
+                index_path = path.with_name(path.name + INDEX_SUFFIX)
+                if index_path.exists():
+                    index_path.unlink()
+        shutil.rmtree(self.staging_dir)
+
+    def abort(self):
+        """
+        Discard everything this writer wrote, including a partial shard, and
+        leave the shards in output_dir as they were.
+        """
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+        self.shards = []
+
+def _scan_shard(shard_path):
+    """
+    Build the index records of a shard by reading its tar headers.
+    """
+    records = {}
+    with tarfile.open(shard_path, 'r') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, _, ext = member.name.partition('.')
+            records.setdefault(key, {'key': key, 'members': {}})['members'][ext] = [member.offset_data, member.size]
+    return list(records.values())
+
+def iter_shard(shard_path):
+    """
+    Stream the samples of one shard in order without seeking, as dicts of
+    extension -> bytes with the sample key under '__key__'.
+    """
+    sample = None
+    with tarfile.open(shard_path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, _, ext = member.name.partition('.')
+            if sample is not None and sample['__key__'] != key:
+                yield sample
+                sample = None
+            if sample is None:
+                sample = {'__key__': key}
+            sample[ext] = tar.extractfile(member).read()
+    if sample is not None:
+        yield sample
+
+class ShardReader:
+    """
+    Random and sequential access to a directory (or list) of shards.
+    Member offsets come from the .idx sidecars; shards without one are
+    scanned once when the reader is opened.
+    """
+
+    def __init__(self, shards, prefix="train"):
+        if isinstance(shards, (str, Path)) and Path(shards).is_dir():
+            shards = sorted(Path(shards).glob(f"{prefix}-*.tar"))
+        self.shards = [Path(shard) for shard in shards]
+        self.locations = {}
+        for shard_number, shard_path in enumerate(self.shards):
+            index_path = shard_path.with_name(shard_path.name + INDEX_SUFFIX)
+            if index_path.exists():
+                with open(index_path, 'r', encoding='utf-8') as f:
+                    records = [json.loads(line) for line in f if line.strip()]
+            else:
+                records = _scan_shard(shard_path)
+            for record in records:
+                self.locations[record['key']] = (shard_number, record['members'])
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, key):
+        return key in self.locations
+
+    def keys(self):
+        return list(self.locations)
+
+    def get(self, key, extensions=None):
+        """
+        Read one sample by key, optionally only the given extensions.
+        Raises KeyError for unknown keys.
+        """
+        shard_number, members = self.locations[key]
+        f = self._files.get(shard_number)
+        if f is None:
+            f = self._files[shard_number] = open(self.shards[shard_number], 'rb')
+        sample = {'__key__': key}
+        for ext, (offset, size) in members.items():
+            if extensions is None or ext in extensions:
+                f.seek(offset)
+                sample[ext] = f.read(size)
+        return sample
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __iter__(self):
+        for shard_path in self.shards:
+            yield from iter_shard(shard_path)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+def pack_train_dir(train_dir, output_dir, prefix="train", max_size=512 * 1024 * 1024, max_samples=None):
+    """
+    Pack an existing train folder (N_start.jpg, N_end.jpg, N_caption.txt)
+    into shards. Returns the list of written shard paths.
+    """
+    train_path = Path(train_dir)
+    start_images = sorted(train_path.glob("*_start.jpg"), key=lambda x: int(x.stem.split('_')[0]))
+    
+    with ShardWriter(output_dir, prefix, max_size, max_samples) as writer:
+        for start_image in start_images:
+            n = int(start_image.stem.split('_')[0])
+            end_image = train_path / f"{n}_end.jpg"
+            if not end_image.exists():
+                print(f"Warning: No end image found for {n}")
+                continue
+            caption_file = train_path / f"{n}_caption.txt"
+            writer.write({
+                '__key__': f"{n:06d}",
+                'control.jpg': start_image.read_bytes(),
+                'end.jpg': end_image.read_bytes(),
+                'txt': caption_file.read_bytes() if caption_file.exists() else None,
+            })
+    print(f"Packed {writer.samples} samples into {len(writer.shards)} shards in {output_dir}")
+    return writer.shards
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack training pairs into tar shards or inspect existing shards')
+    parser.add_argument('command', choices=('pack', 'list'),
+                       help='pack a train folder into shards, or list the samples of a shard folder')
+    parser.add_argument('--train-dir', default='/Users/Jasper/Projects/kontext_hack/train',
+                       help='Train folder with N_start.jpg, N_end.jpg and N_caption.txt files (pack)')
+    parser.add_argument('--shard-dir', default='/Users/Jasper/Projects/kontext_hack/shards',
+                       help='Directory containing the shards')
+    parser.add_argument('--prefix', default='train',
+                       help='Shard file name prefix')
+    parser.add_argument('--shard-size', type=int, default=512,
+                       help='Maximum shard size in MB')
+    parser.add_argument('--shard-samples', type=int,
+                       help='Maximum number of samples per shard')
+    
+    args = parser.parse_args()
+    
+    if args.command == 'pack':
+        pack_train_dir(args.train_dir, args.shard_dir, args.prefix, args.shard_size * 1024 * 1024, args.shard_samples)
+        return
+    
+    with ShardReader(args.shard_dir, args.prefix) as reader:
+        for key in reader.keys():
+            shard_number, members = reader.locations[key]
+            sizes = ', '.join(f"{ext} {size}" for ext, (_, size) in members.items())
+            print(f"{key}  {reader.shards[shard_number].name}  {sizes}")
+        print(f"{len(reader)} samples in {len(reader.shards)} shards")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Near-duplicate detection for source images, run before rendering and captioning.
+Every image gets a 64-bit DCT perceptual hash from a reduced-size JPEG decode.
+Hashes are kept in a uint64 array (and cached by file size and mtime), near
+duplicates are found with a multi-index Hamming search: the hash is split into
+threshold + 1 chunks, so every pair within the threshold shares at least one
+chunk exactly and only images in the same chunk bucket are compared. Each
+cluster of near duplicates keeps one representative, the largest file.
+"""
+
+import os
+import json
+import struct
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import cv2
+
+DEFAULT_THRESHOLD = 6
+HASH_SIZE = 8
+
+CACHE_MAGIC = b'VPHSH\x00\x00\x01'
+CACHE_VERSION = 1
+HEADER_FORMAT = '<8sIIq'
+HEADER_SIZE = 32
+MAX_ID_LENGTH = 32
+
+CACHE_DTYPE = np.dtype([
+    ('image_id', f'S{MAX_ID_LENGTH}'),
+    ('size', '<i8'),
+    ('mtime_ns', '<i8'),
+    ('hash', '<u8'),
+])
+
+# Number of set bits of every byte value
+POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+def perceptual_hash(gray):
+    """
+    DCT hash of a grayscale image: the 8x8 lowest frequencies of a 32x32
+    thumbnail, one bit per coefficient above their median.
+    """
+    thumbnail = cv2.resize(gray, (HASH_SIZE * 4, HASH_SIZE * 4), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(thumbnail)[:HASH_SIZE, :HASH_SIZE].ravel()
+    bits = low > np.median(low)
+    return int(np.packbits(bits).view('>u8')[0])
+
+def hash_file(image_path):
+    """
+    Hash one image from a 1/4 scale decode. Returns None if it cannot be read.
+    """
+    gray = cv2.imread(str(image_path), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if gray is None:
+        return None
+    return perceptual_hash(gray)
+
+def _hash_chunk(paths):
+    return [hash_file(path) for path in paths]
+
+def compute_hashes(paths, workers=4, chunk_size=64):
+    """
+    Hash image files, spread over a process pool with more than one worker.
+    Returns (hashes, ok): a uint64 array and a mask of the files that could be read.
+    """
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    if workers <= 1:
+        results = [_hash_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_hash_chunk, chunks))
+    values = [value for chunk in results for value in chunk]
+    ok = np.array([value is not None for value in values], dtype=bool)
+    hashes = np.array([value or 0 for value in values], dtype=np.uint64)
+    return hashes, ok
+
+def load_hash_cache(cache_path):
+    """
+    Read a hash cache as {image_id: (size, mtime_ns, hash)}; empty if missing or invalid.
+    """
+    try:
+        with open(cache_path, 'rb') as f:
+            raw = f.read()
+    except OSError:
+        return {}
+    if len(raw) < HEADER_SIZE:
+        return {}
+    magic, version, record_size, count = struct.unpack_from(HEADER_FORMAT, raw)
+    if (magic != CACHE_MAGIC or version != CACHE_VERSION or record_size != CACHE_DTYPE.itemsize
+            or len(raw) != HEADER_SIZE + count * record_size):
+        return {}
+    records = np.frombuffer(raw, dtype=CACHE_DTYPE, count=count, offset=HEADER_SIZE)
+    return {record['image_id'].decode('utf-8'): (int(record['size']), int(record['mtime_ns']), int(record['hash']))
+            for record in records}
+
+def write_hash_cache(cache_path, entries):
+    """
+    Write {image_id: (size, mtime_ns, hash)} to a hash cache file.
+    """
+    records = np.array([(image_id.encode('utf-8'), *entry) for image_id, entry in sorted(entries.items())
+                        if len(image_id.encode('utf-8')) <= MAX_ID_LENGTH], dtype=CACHE_DTYPE)
+    header = struct.pack(HEADER_FORMAT, CACHE_MAGIC, CACHE_VERSION, CACHE_DTYPE.itemsize, len(records))
+    cache_path = Path(cache_path)
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\x00'))
+        f.write(records.tobytes())
+    os.replace(tmp_path, cache_path)
+
+def hamming_distances(a, b):
+    """
+    Elementwise Hamming distance between two uint64 arrays.
+    """
+    xor = np.ascontiguousarray(np.bitwise_xor(a, b), dtype=np.uint64)
+    return POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+
+def _chunk_bounds(chunks):
+    widths = [64 // chunks + (1 if i < 64 % chunks else 0) for i in range(chunks)]
+    offsets = np.cumsum([0] + widths[:-1])
+    return list(zip(offsets.tolist(), widths))
+
+def find_near_duplicates(hashes, threshold=DEFAULT_THRESHOLD):
+    """
+    Find all pairs of hashes within threshold bits of each other.
+    Returns (first, second, distance) arrays with first < second.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    count = len(hashes)
+    found = []
+    for offset, width in _chunk_bounds(min(threshold + 1, 64)):
+        mask = np.uint64((1 << width) - 1)
+        keys = (hashes >> np.uint64(offset)) & mask
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        # Compare every item with the items k places further along while they share its bucket
+        active = np.arange(count - 1)
+        step = 1
+        while len(active):
+            active = active[active + step < count]
+            active = active[keys[active] == keys[active + step]]
+            first, second = order[active], order[active + step]
+            close = hamming_distances(hashes[first], hashes[second]) <= threshold
+            found.append(np.stack([np.minimum(first, second)[close], np.maximum(first, second)[close]], axis=1))
+            step += 1
+    
+    pairs = np.unique(np.concatenate(found), axis=0) if found else np.zeros((0, 2), dtype=np.int64)
+    if not len(pairs):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    return pairs[:, 0], pairs[:, 1], hamming_distances(hashes[pairs[:, 0]], hashes[pairs[:, 1]])
+
+def cluster_pairs(count, first, second):
+    """
+    Connected components of the duplicate graph: for every item the
+    smallest index of its cluster.
+    """
+    labels = np.arange(count)
+    while True:
+        merged = np.minimum(labels[first], labels[second])
+        previous = labels.copy()
+        np.minimum.at(labels, first, merged)
+        np.minimum.at(labels, second, merged)
+        # Pointer jumping so long chains converge in a few rounds
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+def deduplicate(hashes, priority=None, threshold=DEFAULT_THRESHOLD):
+    """
+    Choose one representative per cluster of near duplicates, the item with
+    the highest priority (earliest on ties).
+    Returns (keep, representative): a mask of kept items and, per item, the
+    index of the representative of its cluster.
+    """
+    count = len(hashes)
+    first, second, _ = find_near_duplicates(hashes, threshold)
+    labels = cluster_pairs(count, first, second)
+    priority = np.zeros(count) if priority is None else np.asarray(priority)
+    
+    order = np.lexsort((np.arange(count), -priority, labels))
+    is_head = np.ones(count, dtype=bool)
+    is_head[1:] = labels[order[1:]] != labels[order[:-1]]
+    heads = order[is_head]
+    representative_of_label = np.empty(count, dtype=np.int64)
+    representative_of_label[labels[heads]] = heads
+    representative = representative_of_label[labels]
+    return representative == np.arange(count), representative
+
+def dedup_image_ids(image_dir, image_ids, threshold=DEFAULT_THRESHOLD, workers=4, cache_path=None,
+                    report_path=None):
+    """
+    Drop near-duplicate {image_id}.jpg images from image_ids. Hashes are
+    reused from cache_path for files whose size and mtime are unchanged.
+    Unreadable images are kept, so later stages report them as before.
+    Writes a JSON lines report of the dropped images (with the kept image
+    and their Hamming distance) to report_path, and returns the kept ids in
+    their original order.
+    """
+    image_dir = Path(image_dir)
+    cache = load_hash_cache(cache_path) if cache_path else {}
+    stats = [os.stat(image_dir / f"{image_id}.jpg") for image_id in image_ids]
+    hashes = np.zeros(len(image_ids), dtype=np.uint64)
+    ok = np.ones(len(image_ids), dtype=bool)
+    missing = []
+    for i, (image_id, stat) in enumerate(zip(image_ids, stats)):
+        entry = cache.get(image_id)
+        if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            hashes[i] = entry[2]
+        else:
+            missing.append(i)
+    
+    if missing:
+        new_hashes, new_ok = compute_hashes([str(image_dir / f"{image_ids[i]}.jpg") for i in missing], workers)
+        hashes[missing] = new_hashes
+        ok[missing] = new_ok
+        if cache_path:
+            for i in np.asarray(missing)[new_ok]:
+                cache[image_ids[i]] = (stats[i].st_size, stats[i].st_mtime_ns, int(hashes[i]))
+            write_hash_cache(cache_path, cache)
+    
+    readable = np.flatnonzero(ok)
+    keep = np.ones(len(image_ids), dtype=bool)
+    sizes = np.array([stats[i].st_size for i in readable], dtype=np.int64)
+    kept, representative = deduplicate(hashes[readable], sizes, threshold)
+    keep[readable] = kept
+    
+    dropped = np.flatnonzero(~kept)
+    distances = hamming_distances(hashes[readable[dropped]], hashes[readable[representative[dropped]]])
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            for i, distance in zip(dropped, distances):
+                f.write(json.dumps({'image_id': image_ids[readable[i]],
+                                    'kept': image_ids[readable[representative[i]]],
+                                    'distance': int(distance)}) + '\n')
+    print(f"Dedup: kept {int(keep.sum())} of {len(image_ids)} images, dropped {len(dropped)} near duplicates"
+          f" (threshold {threshold}, {len(missing)} hashed)")
+    return [image_id for image_id, kept_id in zip(image_ids, keep) if kept_id]
+
+def main():
+    parser = argparse.ArgumentParser(description='Find near-duplicate images with perceptual hashes')
+    parser.add_argument('--images-dir', default='/Users/Jasper/Projects/kontext_hack/processed_images/images',
+                       help='Directory containing the .jpg images to check')
+    parser.add_argument('--threshold', type=int, default=DEFAULT_THRESHOLD,
+                       help='Maximum Hamming distance (of 64 bits) between near duplicates')
+    parser.add_argument('--workers', type=int, default=4,
+                       help='Number of worker processes used for hashing')
+    parser.add_argument('--cache',
+                       help='Hash cache file, reused for unchanged images')
+    parser.add_argument('--report', default='dedup_report.jsonl',
+                       help='Where to write the JSON lines report of dropped images')
+    parser.add_argument('--delete', action='store_true',
+                       help='Delete the dropped images from images-dir')
+    
+    args = parser.parse_args()
+    
+    image_ids = sorted(path.stem for path in Path(args.images_dir).glob("*.jpg"))
+    kept = set(dedup_image_ids(args.images_dir, image_ids, args.threshold, args.workers, args.cache, args.report))
+    if args.delete:
+        for image_id in image_ids:
+            if image_id not in kept:
+                (Path(args.images_dir) / f"{image_id}.jpg").unlink()
+    print(f"Report written to {args.report}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Shared instrumentation for the pipeline scripts.
+Stages are timed with `with stage('imread'):`, counters are incremented with
+labels (`increment('skipped', reason='outside')`), and latencies go into
+fixed-bucket histograms (`observe('api_latency_seconds', seconds)`). The
+registry is process-wide and thread-safe; worker processes send a snapshot
+back that is merged into the parent's. With --metrics the totals are written
+at exit as JSON or Prometheus text, and with --profile every stage gets its
+own cProfile profile or a folded stack sampling profile.
+"""
+
+import sys
+import json
+import time
+import atexit
+import pstats
+import cProfile
+import threading
+import contextlib
+from pathlib import Path
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PROFILE_MODES = ('cprofile', 'sample')
+SAMPLE_INTERVAL = 0.005
+
+class Metrics:
+    """
+    Registry of stage timers, labeled counters and histograms.
+    Stage timers are inclusive: a stage entered inside another counts
+    towards both.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # The main thread's stage stack is shared so the stack sampler can read it
+        self.main_stack = []
+        self.reset()
+        self.profile_mode = None
+        self.profiles = {}
+        self.sampler = None
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+            self.histograms = {}
+
+    def _stack(self):
+        if threading.current_thread() is threading.main_thread():
+            return self.main_stack
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def current_stage(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time a block as stage name. With cProfile profiling on the main
+        thread, the block is profiled into the stage's own profile.
+        """
+        stack = self._stack()
+        profile = self._switch_profile(stack[-1] if stack else None, name)
+        stack.append(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            stack.pop()
+            if profile:
+                self._switch_profile(name, stack[-1] if stack else None)
+            with self.lock:
+                timer = self.timers.setdefault(name, {'count': 0, 'seconds': 0.0, 'min': elapsed, 'max': elapsed})
+                timer['count'] += 1
+                timer['seconds'] += elapsed
+                timer['min'] = min(timer['min'], elapsed)
+                timer['max'] = max(timer['max'], elapsed)
+
+    def increment(self, name, value=1, **labels):
+        """
+        Add value to the counter name with the given labels.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        """
+        Record value in the histogram name.
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {'buckets': list(buckets), 'counts': [0] * (len(buckets) + 1),
+                                                     'sum': 0.0, 'count': 0}
+            position = next((i for i, bound in enumerate(histogram['buckets']) if value <= bound),
+                            len(histogram['buckets']))
+            histogram['counts'][position] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        """
+        Return all values as a JSON-serializable dict.
+        """
+        with self.lock:
+            return {
+                'stages': {name: dict(timer) for name, timer in self.timers.items()},
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'histograms': {name: {**histogram, 'counts': list(histogram['counts'])}
+                               for name, histogram in self.histograms.items()},
+            }
+
+    def merge(self, snapshot):
+        """
+        Add a snapshot, e.g. from a worker process, to this registry.
+        """
+        with self.lock:
+            for name, other in snapshot['stages'].items():
+                timer = self.timers.get(name)
+                if timer is None:
+                    self.timers[name] = dict(other)
+                    continue
+                timer['count'] += other['count']
+                timer['seconds'] += other['seconds']
+                timer['min'] = min(timer['min'], other['min'])
+                timer['max'] = max(timer['max'], other['max'])
+            for counter in snapshot['counters']:
+                key = (counter['name'], tuple(sorted(counter['labels'].items())))
+                self.counters[key] = self.counters.get(key, 0) + counter['value']
+            for name, other in snapshot['histograms'].items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    self.histograms[name] = {**other, 'counts': list(other['counts'])}
+                    continue
+                histogram['counts'] = [a + b for a, b in zip(histogram['counts'], other['counts'])]
+                histogram['sum'] += other['sum']
+                histogram['count'] += other['count']
+
+    def to_prometheus(self, prefix='vp_'):
+        """
+        Render the registry in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        if snapshot['stages']:
+            lines.append(f"# TYPE {prefix}stage_seconds_total counter")
+            for name, timer in sorted(snapshot['stages'].items()):
+                lines.append(f'{prefix}stage_seconds_total{{stage="{name}"}} {timer["seconds"]:.6f}')
+            lines.append(f"# TYPE {prefix}stage_calls_total counter")
+            for name, timer in sorted(snapshot['stages'].items()):
+                lines.append(f'{prefix}stage_calls_total{{stage="{name}"}} {timer["count"]}')
+        declared = set()
+        for counter in snapshot['counters']:
+            metric = f"{prefix}{counter['name']}_total"
+            if metric not in declared:
+                lines.append(f"# TYPE {metric} counter")
+                declared.add(metric)
+            labels = ','.join(f'{key}="{value}"' for key, value in counter['labels'].items())
+            lines.append(f"{metric}{{{labels}}} {counter['value']}" if labels else f"{metric} {counter['value']}")
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            metric = f"{prefix}{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'] + ['+Inf'], histogram['counts']):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum {histogram['sum']:.6f}")
+            lines.append(f"{metric}_count {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Write the registry to path: Prometheus text for .prom or .txt, JSON otherwise.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.suffix in ('.prom', '.txt'):
+            path.write_text(self.to_prometheus(), encoding='utf-8')
+        else:
+            path.write_text(json.dumps(self.snapshot(), indent=2), encoding='utf-8')
+
+    def summary(self):
+        """
+        Return a short human-readable table of the stage timers.
+        """
+        snapshot = self.snapshot()
+        lines = [f"{'stage':24s} {'calls':>8s} {'total s':>10s} {'mean ms':>10s}"]
+        for name, timer in sorted(snapshot['stages'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append(f"{name:24s} {timer['count']:8d} {timer['seconds']:10.3f} "
+                         f"{timer['seconds'] / timer['count'] * 1000:10.2f}")
+        return '\n'.join(lines)
+    
+    # Profiling
+
+    def enable_profiling(self, mode):
+        """
+        Profile every stage: 'cprofile' keeps one cProfile.Profile per stage
+        (main thread only), 'sample' samples the main thread's stack every
+        SAMPLE_INTERVAL seconds and attributes it to the current stage.
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.profile_mode = mode
+        if mode == 'sample':
+            self.sampler = StackSampler(self)
+            self.sampler.start()
+
+    def _switch_profile(self, old_stage, new_stage):
+        if self.profile_mode != 'cprofile' or threading.current_thread() is not threading.main_thread():
+            return False
+        # cProfile allows one active profiler, so the outer stage pauses while an inner one runs
+        if old_stage is not None:
+            self.profiles[old_stage].disable()
+        if new_stage is not None:
+            self.profiles.setdefault(new_stage, cProfile.Profile()).enable()
+        return True
+
+    def write_profiles(self, output_dir):
+        """
+        Write the collected profiles to output_dir: <stage>.prof files for
+        cProfile, samples.folded (flame graph input) for sampling.
+        Returns the written paths.
+        """
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        written = []
+        if self.sampler is not None:
+            self.sampler.stop()
+            path = output_dir / "samples.folded"
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in sorted(self.sampler.samples.items()):
+                    f.write(f"{stack} {count}\n")
+            written.append(path)
+        for name, profile in self.profiles.items():
+            path = output_dir / f"{name}.prof"
+            pstats.Stats(profile).dump_stats(str(path))
+            written.append(path)
+        return written
+
+class StackSampler(threading.Thread):
+    """
+    Background thread that samples the main thread's call stack into
+    folded 'stage;module:function;...' strings with counts.
+    """
+
+    def __init__(self, metrics, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.metrics = metrics
+        self.interval = interval
+        self.samples = {}
+        self.stopped = threading.Event()
+        self.main_id = threading.main_thread().ident
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.main_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(f"{Path(frame.f_code.co_filename).stem}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            main_stack = self.metrics.main_stack
+            stack.append(main_stack[-1] if main_stack else 'none')
+            key = ';'.join(reversed(stack))
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+METRICS = Metrics()
+stage = METRICS.stage
+increment = METRICS.increment
+observe = METRICS.observe
+
+def add_arguments(parser):
+    """
+    Add the --metrics, --profile and --profile-dir options to a script's parser.
+    """
+    parser.add_argument('--metrics',
+                       help='Write a metrics summary at exit (.json, or .prom for Prometheus text)')
+    parser.add_argument('--profile', choices=PROFILE_MODES,
+                       help='Profile every stage with cProfile or a stack sampler')
+    parser.add_argument('--profile-dir', default='profiles',
+                       help='Where to write the stage profiles')
+
+def setup(args):
+    """
+    Enable profiling and register the metrics and profile output at exit.
+    """
+    if args.profile:
+        METRICS.enable_profiling(args.profile)
+
+    def finish():
+        if args.metrics:
+            METRICS.write(args.metrics)
+            print(f"Metrics written to {args.metrics}")
+        if args.profile:
+            for path in METRICS.write_profiles(args.profile_dir):
+                print(f"Profile written to {path}")
+        if args.metrics or args.profile:
+            print(METRICS.summary())
+    atexit.register(finish)
@@ -4,29 +4,27 @@ Script to organize train files into three folders:
 - train_control: vanishing point images (N_start.jpg -> N.jpg)
 - train_end: original images (N_end.jpg -> N.jpg) 
 - train_captions: caption files (N_caption.txt -> N.txt)
+Re-runs only add, update or remove what changed; files can be linked instead of copied.
 """
 
-import shutil
+import argparse
 from pathlib import Path
+import metrics
+from file_sync import sync_files, LINK_MODES
 
-def organize_final_files(train_dir, output_base_dir):
+def organize_final_files(train_dir, output_base_dir, link_mode='copy', compare='mtime'):
     """
     Organize files from train directory into three separate folders.
+    link_mode is one of file_sync.LINK_MODES; compare is 'mtime' or 'hash'.
+    Files in the output folders that no longer have a source are removed.
     """
     train_path = Path(train_dir)
     output_base_path = Path(output_base_dir)
     
-    # Create output directories
+    # Output directories
     control_dir = output_base_path / "train_control"
     end_dir = output_base_path / "train_end"
     
-    for dir_path in [control_dir, end_dir]:
-        dir_path.mkdir(parents=True, exist_ok=True)
-        # Clear existing files
-        for f in dir_path.iterdir():
-            if f.is_file():
-                f.unlink()
-    
     print("Organizing files...")
     
     # Find all start images (vanishing points)
@@ -34,41 +32,60 @@ def organize_final_files(train_dir, output_base_dir):
     print(f"Found {len(start_images)} vanishing point images")
     
     processed = 0
+    control_pairs = []
+    end_pairs = []
     
     for start_image in start_images:
         image_id = start_image.stem.split('_')[0]
         
-        # Copy vanishing point image to train_control (N_start.jpg -> N.jpg)
-        control_dest = control_dir / f"{image_id}.jpg"
-        shutil.copy2(start_image, control_dest)
+        # Vanishing point image to train_control (N_start.jpg -> N.jpg)
+        control_pairs.append((start_image, f"{image_id}.jpg"))
         
-        # Copy original image to train_end (N_end.jpg -> N.jpg)
+        # Original image to train_end (N_end.jpg -> N.jpg)
         end_image = train_path / f"{image_id}_end.jpg"
         if end_image.exists():
-            end_dest = end_dir / f"{image_id}.jpg"
-            shutil.copy2(end_image, end_dest)
+            end_pairs.append((end_image, f"{image_id}.jpg"))
         else:
             print(f"Warning: No end image found for {image_id}")
         
-        # Copy caption to train_end (N_caption.txt -> N.txt)
+        # Caption to train_end (N_caption.txt -> N.txt)
         caption_file = train_path / f"{image_id}_caption.txt"
         if caption_file.exists():
-            caption_dest = end_dir / f"{image_id}.txt"
-            shutil.copy2(caption_file, caption_dest)
+            end_pairs.append((caption_file, f"{image_id}.txt"))
         else:
             print(f"Warning: No caption found for {image_id}")
         
         processed += 1
-        if processed % 100 == 0:
-            print(f"Processed {processed} files...")
+    
+    control_counts = sync_files(control_pairs, control_dir, mode=link_mode, compare=compare, prune_patterns=("*",))
+    end_counts = sync_files(end_pairs, end_dir, mode=link_mode, compare=compare, prune_patterns=("*",))
     
     print(f"\nOrganization complete!")
     print(f"Processed {processed} image sets")
+    for name, counts in (("train_control", control_counts), ("train_end", end_counts)):
+        print(f"  {name}: added {counts['added']}, updated {counts['updated']}, "
+              f"unchanged {counts['unchanged']}, removed {counts['removed']} ({link_mode} mode)")
     print(f"Files organized into:")
     print(f"  - train_control: {len(list(control_dir.glob('*.jpg')))} vanishing point images")
     print(f"  - train_end: {len(list(end_dir.glob('*.jpg')))} original images + {len(list(end_dir.glob('*.txt')))} caption files")
 
+def main():
+    parser = argparse.ArgumentParser(description='Organize train pairs into train_control and train_end folders')
+    parser.add_argument('--train-dir', default='/Users/Jasper/Projects/kontext_hack/train',
+                       help='Directory containing N_start.jpg, N_end.jpg and N_caption.txt files')
+    parser.add_argument('--output-dir', default='/Users/Jasper/Projects/kontext_hack',
+                       help='Directory in which train_control and train_end are created')
+    parser.add_argument('--link-mode', choices=LINK_MODES, default='copy',
+                       help='How to place files: auto tries reflink, hardlink, symlink, then copy')
+    parser.add_argument('--compare', choices=('mtime', 'hash'), default='mtime',
+                       help='How to detect changed files on re-runs')
+    metrics.add_arguments(parser)
+    
+    args = parser.parse_args()
+    metrics.setup(args)
+    
+    with metrics.stage('organize'):
+        organize_final_files(args.train_dir, args.output_dir, args.link_mode, args.compare)
+
 if __name__ == "__main__":
-    train_directory = "/Users/Jasper/Projects/kontext_hack/train"
-    output_directory = "/Users/Jasper/Projects/kontext_hack"
-    organize_final_files(train_directory, output_directory)
+    main()
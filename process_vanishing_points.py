@@ -5,11 +5,25 @@ Creates overlays with vanishing points and separate images with only vanishing p
 """
 
 import os
+import io
 import shutil
+import struct
+import contextlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import cv2
 from pathlib import Path
 import argparse
+from functools import partial
+from vp_index import load_vp_index
+from source_index import (load_source_ids, match_image_ids, rank_positions, vp_strata, ID_DTYPE, MAX_ID_LENGTH,
+                          SAMPLING_STRATEGIES)
+from vp_rasterizer import render_control_image, DEFAULT_ANGLE_STEP, DEFAULT_LINE_WIDTH, DEFAULT_DOT_RADIUS
+from control_params import write_control_png
+from dedup import dedup_image_ids
+import metrics
+from metrics import METRICS, stage, increment
 
 def calculate_vanishing_point(line1, line2):
     """
@@ -32,38 +46,143 @@ def calculate_vanishing_point(line1, line2):
     else:
         return None, None
 
+def homogeneous_lines(segments):
+    """
+    Lines through segments [x1, y1, x2, y2] in homogeneous coordinates: the
+    cross product of the endpoints [x, y, 1], as in calculate_vanishing_point.
+    segments is an (..., 4) array; returns an (..., 3) array.
+    """
+    segments = np.asarray(segments, dtype=np.float64)
+    ones = np.ones(segments.shape[:-1] + (2, 1))
+    endpoints = np.concatenate([segments.reshape(segments.shape[:-1] + (2, 2)), ones], axis=-1)
+    return np.cross(endpoints[..., 0, :], endpoints[..., 1, :])
+
+def calculate_vanishing_points(line_pairs, image_sizes):
+    """
+    Vectorized version of calculate_vanishing_point for many labels at once.
+    line_pairs is an (N, 2, 4) array of scaled lines [x1, y1, x2, y2] and
+    image_sizes an (N, 2) array of (width, height).
+    Returns (points, degenerate, in_bounds): an (N, 2) int array of vanishing
+    points truncated like calculate_vanishing_point, a mask of parallel or
+    degenerate line pairs, and a mask of points that lie inside the image.
+    """
+    line_pairs = np.asarray(line_pairs, dtype=np.float64).reshape(-1, 2, 4)
+    image_sizes = np.asarray(image_sizes, dtype=np.float64).reshape(-1, 2)
+    
+    lines_hom = homogeneous_lines(line_pairs)
+    vanishing_points = np.cross(lines_hom[:, 0], lines_hom[:, 1])
+    
+    w = vanishing_points[:, 2]
+    degenerate = w == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xy = np.trunc(vanishing_points[:, :2] / np.where(degenerate, 1.0, w)[:, None])
+    degenerate |= ~np.isfinite(xy).all(axis=1)
+    
+    in_bounds = ~degenerate & (xy >= 0).all(axis=1) & (xy < image_sizes).all(axis=1)
+    # Degenerate pairs get (0, 0); near-parallel lines are clipped to fit int64
+    points = np.clip(np.where(degenerate[:, None], 0, xy), -2**62, 2**62).astype(np.int64)
+    return points, degenerate, in_bounds
+
 def read_vp_data(vp_file):
     """
     Read vanishing point data from a .txt file.
     Returns image dimensions and two lines defining the vanishing point.
     """
-    with open(vp_file, 'r') as f:
-        lines = f.readlines()
-    
-    # First line: width height
-    width, height = map(int, lines[0].strip().split())
-    
-    # Second and third lines: the two lines
-    line1 = list(map(float, lines[1].strip().split()))
-    line2 = list(map(float, lines[2].strip().split()))
+    with stage('label_parse'):
+        with open(vp_file, 'r') as f:
+            lines = f.readlines()
+        
+        # First line: width height
+        width, height = map(int, lines[0].strip().split())
+        
+        # Second and third lines: the two lines
+        line1 = list(map(float, lines[1].strip().split()))
+        line2 = list(map(float, lines[2].strip().split()))
     
     return width, height, line1, line2
 
-def create_overlay_image(image_path, vp_file, output_path):
+# JPEG start-of-frame markers (baseline, progressive, lossless, arithmetic ...)
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def _exif_orientation(segment):
     """
-    Create an overlay image with vanishing point and lines marked.
+    Return the EXIF orientation tag from an APP1 segment payload, or 1.
+    """
+    if not segment.startswith(b'Exif\x00\x00'):
+        return 1
+    tiff = segment[6:]
+    if len(tiff) < 8 or tiff[:2] not in (b'II', b'MM'):
+        return 1
+    endian = '<' if tiff[:2] == b'II' else '>'
+    ifd_offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+    if ifd_offset + 2 > len(tiff):
+        return 1
+    entry_count = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+    for i in range(entry_count):
+        entry = tiff[ifd_offset + 2 + i * 12:ifd_offset + 14 + i * 12]
+        if len(entry) < 12:
+            break
+        tag, field_type = struct.unpack(endian + 'HH', entry[:4])
+        if tag == 0x0112 and field_type == 3:
+            return struct.unpack(endian + 'H', entry[8:10])[0]
+    return 1
+
+def read_jpeg_size(image_path):
+    """
+    Read the (width, height) of a JPEG from its SOF marker without decoding pixels.
+    Dimensions are reported as cv2.imread would return them, i.e. swapped when
+    the EXIF orientation rotates the image by 90 degrees.
+    Returns None if the file is not a JPEG or the header cannot be parsed.
+    image_path may also be an open binary file object, e.g. io.BytesIO.
+    """
+    orientation = 1
+    opened = contextlib.nullcontext(image_path) if hasattr(image_path, 'read') else open(image_path, 'rb')
+    with opened as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            byte = f.read(1)
+            while byte == b'\xff':
+                marker = f.read(1)
+                if marker != b'\xff':
+                    break
+            else:
+                return None
+            if not marker:
+                return None
+            marker = marker[0]
+            # Standalone markers carry no length field
+            if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+                continue
+            if marker in (0xD9, 0xDA):
+                return None
+            length_bytes = f.read(2)
+            if len(length_bytes) < 2:
+                return None
+            length = struct.unpack('>H', length_bytes)[0]
+            if marker in SOF_MARKERS:
+                header = f.read(5)
+                if len(header) < 5:
+                    return None
+                height, width = struct.unpack('>HH', header[1:5])
+                if orientation >= 5:
+                    width, height = height, width
+                return width, height
+            if marker == 0xE1 and orientation == 1:
+                orientation = _exif_orientation(f.read(length - 2))
+            else:
+                f.seek(length - 2, os.SEEK_CUR)
+
+def _scale_vp_data(vp_file, current_width, current_height, label=None):
+    """
+    Scale the label lines to the current image size and compute the vanishing point.
+    label is an already parsed (width, height, line1, line2) tuple, e.g. from
+    the label index; without it the label file is read.
+    Returns (vp_x, vp_y, scaled_line1, scaled_line2), or None if the vanishing
+    point cannot be computed or lies outside the image.
     """
     # Read vanishing point data first to get original dimensions
-    vp_width, vp_height, line1, line2 = read_vp_data(vp_file)
-    
-    # Read the original image
-    image = cv2.imread(image_path)
-    if image is None:
-        print(f"Could not read image: {image_path}")
-        return False
-    
-    # Get current image dimensions
-    current_height, current_width = image.shape[:2]
+    vp_width, vp_height, line1, line2 = label if label is not None else read_vp_data(vp_file)
     
     # Scale the line coordinates to match the current image size
     scale_x = current_width / vp_width
@@ -78,42 +197,24 @@ def create_overlay_image(image_path, vp_file, output_path):
     
     if vp_x is None or vp_y is None:
         print(f"Could not calculate vanishing point for {vp_file}")
-        return False
+        return None
     
     # Check if vanishing point is outside image boundaries
     if vp_x < 0 or vp_x >= current_width or vp_y < 0 or vp_y >= current_height:
         print(f"Vanishing point ({vp_x}, {vp_y}) is outside image boundaries ({current_width}x{current_height}) - skipping")
-        return False
+        return None
     
-    # Create a copy for overlay
-    overlay = image.copy()
-    
-    # Draw the two lines using scaled coordinates
-    cv2.line(overlay, (int(scaled_line1[0]), int(scaled_line1[1])), (int(scaled_line1[2]), int(scaled_line1[3])), (0, 255, 0), 3)
-    cv2.line(overlay, (int(scaled_line2[0]), int(scaled_line2[1])), (int(scaled_line2[2]), int(scaled_line2[3])), (0, 255, 0), 3)
-    
-    # Draw the vanishing point
-    cv2.circle(overlay, (vp_x, vp_y), 10, (0, 0, 255), -1)
-    cv2.circle(overlay, (vp_x, vp_y), 15, (255, 255, 255), 2)
-    
-    # Add text label
-    cv2.putText(overlay, f"VP: ({vp_x}, {vp_y})", (vp_x + 20, vp_y - 20), 
-                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-    
-    # Save the overlay
-    cv2.imwrite(output_path, overlay)
-    return True
+    return vp_x, vp_y, scaled_line1, scaled_line2
 
-def create_vanishing_point_only(image_path, vp_file, output_path):
+def create_overlay_image(image_path, vp_file, output_path, image=None, vp_data=None):
     """
-    Create an image with only the vanishing point marked on a black background.
-    Shows red dot with equi-angular grid lines radiating from it.
+    Create an overlay image with vanishing point and lines marked.
+    Pass an already decoded image to avoid reading image_path again, and
+    vp_data as returned by _scale_vp_data to skip re-reading the label.
     """
-    # Read vanishing point data first to get original dimensions
-    vp_width, vp_height, line1, line2 = read_vp_data(vp_file)
-    
-    # Read the original image to get its dimensions
-    image = cv2.imread(image_path)
+    # Read the original image
+    if image is None:
+        image = cv2.imread(image_path)
     if image is None:
         print(f"Could not read image: {image_path}")
         return False
@@ -121,145 +222,367 @@ def create_vanishing_point_only(image_path, vp_file, output_path):
     # Get current image dimensions
     current_height, current_width = image.shape[:2]
     
-    # Scale the line coordinates to match the current image size
-    scale_x = current_width / vp_width
-    scale_y = current_height / vp_height
-    
-    # Scale the line coordinates
-    scaled_line1 = [line1[0] * scale_x, line1[1] * scale_y, line1[2] * scale_x, line1[3] * scale_y]
-    scaled_line2 = [line2[0] * scale_x, line2[1] * scale_y, line2[2] * scale_x, line2[3] * scale_y]
-    
-    # Calculate vanishing point using scaled coordinates
-    vp_x, vp_y = calculate_vanishing_point(scaled_line1, scaled_line2)
+    if vp_data is None:
+        vp_data = _scale_vp_data(vp_file, current_width, current_height)
+        if vp_data is None:
+            return False
+    vp_x, vp_y, scaled_line1, scaled_line2 = vp_data
     
-    if vp_x is None or vp_y is None:
-        print(f"Could not calculate vanishing point for {vp_file}")
-        return False
-    
-    # Check if vanishing point is outside image boundaries
-    if vp_x < 0 or vp_x >= current_width or vp_y < 0 or vp_y >= current_height:
-        print(f"Vanishing point ({vp_x}, {vp_y}) is outside image boundaries ({current_width}x{current_height}) - skipping")
-        return False
-    
-    # Create black background with current image dimensions
-    vp_image = np.zeros((current_height, current_width, 3), dtype=np.uint8)
-    
-    # Draw equi-angular grid lines radiating from vanishing point (every 20 degrees)
-    import math
-    for angle in range(0, 360, 20):
-        # Convert angle to radians
-        angle_rad = math.radians(angle)
-        
-        # Calculate line endpoints - extend to image boundaries
-        # We'll draw lines that extend from the vanishing point to the image edges
-        cos_angle = math.cos(angle_rad)
-        sin_angle = math.sin(angle_rad)
-        
-        # Calculate intersections with image boundaries
-        intersections = []
-        
-        # Top edge (y = 0)
-        if sin_angle != 0:
-            t = -vp_y / sin_angle
-            if t > 0:
-                x = vp_x + t * cos_angle
-                if 0 <= x <= current_width:
-                    intersections.append((int(x), 0))
-        
-        # Bottom edge (y = current_height)
-        if sin_angle != 0:
-            t = (current_height - vp_y) / sin_angle
-            if t > 0:
-                x = vp_x + t * cos_angle
-                if 0 <= x <= current_width:
-                    intersections.append((int(x), current_height))
+    with stage('draw'):
+        # Create a copy for overlay
+        overlay = image.copy()
         
-        # Left edge (x = 0)
-        if cos_angle != 0:
-            t = -vp_x / cos_angle
-            if t > 0:
-                y = vp_y + t * sin_angle
-                if 0 <= y <= current_height:
-                    intersections.append((0, int(y)))
+        # Draw the two lines using scaled coordinates
+        cv2.line(overlay, (int(scaled_line1[0]), int(scaled_line1[1])), (int(scaled_line1[2]), int(scaled_line1[3])), (0, 255, 0), 3)
+        cv2.line(overlay, (int(scaled_line2[0]), int(scaled_line2[1])), (int(scaled_line2[2]), int(scaled_line2[3])), (0, 255, 0), 3)
         
-        # Right edge (x = current_width)
-        if cos_angle != 0:
-            t = (current_width - vp_x) / cos_angle
-            if t > 0:
-                y = vp_y + t * sin_angle
-                if 0 <= y <= current_height:
-                    intersections.append((current_width, int(y)))
+        # Draw the vanishing point
+        cv2.circle(overlay, (vp_x, vp_y), 10, (0, 0, 255), -1)
+        cv2.circle(overlay, (vp_x, vp_y), 15, (255, 255, 255), 2)
         
-        # Draw line from vanishing point to the intersection point
-        if intersections:
-            # Choose the closest intersection to avoid lines going outside the image
-            closest_intersection = min(intersections, 
-                                     key=lambda p: math.sqrt((p[0] - vp_x)**2 + (p[1] - vp_y)**2))
-            cv2.line(vp_image, (vp_x, vp_y), closest_intersection, (0, 0, 255), 2)
-    
-    # Draw the vanishing point as a red dot
-    cv2.circle(vp_image, (vp_x, vp_y), 8, (0, 0, 255), -1)
-    cv2.circle(vp_image, (vp_x, vp_y), 12, (0, 0, 255), 2)
-    
-    # Save the vanishing point only image
-    cv2.imwrite(output_path, vp_image)
+        # Add text label
+        cv2.putText(overlay, f"VP: ({vp_x}, {vp_y})", (vp_x + 20, vp_y - 20), 
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+    
+    # Save the overlay
+    with stage('imwrite'):
+        cv2.imwrite(output_path, overlay)
+        increment('bytes_written', os.path.getsize(output_path))
     return True
 
-def copy_relevant_images(source_dir, vp_labels_dir, target_dir, max_images=50):
+def create_vanishing_point_only(image_path, vp_file, output_path, image=None, vp_data=None, render_options=None):
+    """
+    Create an image with only the vanishing point marked on a black background.
+    Shows red dot with equi-angular grid lines radiating from it.
+    Only the image size is needed: it is taken from image if given, otherwise
+    from the JPEG header, and the file is only decoded as a last resort.
+    vp_data as returned by _scale_vp_data skips re-reading the label.
+    render_options are passed on to vp_rasterizer.render_control_image
+    (angle_step, line_width, dot_radius, ...).
+    """
+    if image is not None:
+        current_height, current_width = image.shape[:2]
+    else:
+        size = read_jpeg_size(image_path)
+        if size is None:
+            image = cv2.imread(image_path)
+            if image is None:
+                print(f"Could not read image: {image_path}")
+                return False
+            size = image.shape[1], image.shape[0]
+        current_width, current_height = size
+    
+    if vp_data is None:
+        vp_data = _scale_vp_data(vp_file, current_width, current_height)
+        if vp_data is None:
+            return False
+    vp_x, vp_y = vp_data[:2]
+    
+    # Render black background with equi-angular grid lines radiating from the vanishing point
+    with stage('draw'):
+        vp_image = render_control_image(current_width, current_height, vp_x, vp_y, **(render_options or {}))
+    
+    # Save the vanishing point only image; .png paths get a lossless 1-bit palette PNG
+    with stage('imwrite'):
+        if str(output_path).lower().endswith('.png'):
+            write_control_png(output_path, vp_image)
+        else:
+            cv2.imwrite(output_path, vp_image)
+        increment('bytes_written', os.path.getsize(output_path))
+    return True
+
+def select_relevant_images(source_dir, vp_labels_dir, max_images=50, vp_index=None, sampling='first', seed=0,
+                           source_ids=None, distinct=None):
+    """
+    Return the ids of up to max_images labeled images that exist in source_dir,
+    in label order. The source directory is matched through its cached id
+    listing (source_index.load_source_ids) instead of one stat per label.
+    sampling is 'first', 'random' (seeded) or 'stratified', which spreads the
+    selection over a grid of vanishing point positions and leaves out labels
+    whose vanishing point is outside the frame.
+    distinct, e.g. from distinct_images, filters a list of ids down to the ones
+    to keep; images it drops are replaced by the next ones in sampling order,
+    so max_images is still met when enough images remain.
+    """
+    if source_ids is None:
+        source_ids = load_source_ids(source_dir)
+    if vp_index is not None:
+        records = vp_index.records
+        label_ids = records['image_id']
+    else:
+        records = None
+        # Ids too long for ID_DTYPE are left out like in scan_source_ids, since truncating them could cause false matches
+        encoded_ids = (vp_file.name[:-4].encode('utf-8') for vp_file in Path(vp_labels_dir).glob("*.txt"))
+        label_ids = np.array([image_id for image_id in encoded_ids if len(image_id) <= MAX_ID_LENGTH],
+                             dtype=ID_DTYPE)
+    matched = np.flatnonzero(match_image_ids(label_ids, source_ids))
+    
+    strata = None
+    if sampling == 'stratified':
+        if records is not None:
+            sizes = np.stack([records['width'][matched], records['height'][matched]], axis=1)
+            line_pairs = np.stack([records['line1'][matched], records['line2'][matched]], axis=1)
+        else:
+            labels = [read_vp_data(Path(vp_labels_dir) / f"{label_ids[pos].decode('utf-8')}.txt") for pos in matched]
+            sizes = np.array([label[:2] for label in labels], dtype=np.float64).reshape(-1, 2)
+            line_pairs = np.array([label[2:] for label in labels], dtype=np.float64).reshape(-1, 2, 4)
+        points, _, in_bounds = calculate_vanishing_points(line_pairs, sizes)
+        strata = np.where(in_bounds, vp_strata(points, sizes), -1)
+    
+    ranked = matched[rank_positions(len(matched), sampling, seed, strata)]
+    limit = len(ranked) if max_images is None else min(max_images, len(ranked))
+    if distinct is None:
+        selected = np.sort(ranked[:limit])
+        return [image_id.decode('utf-8') for image_id in label_ids[selected]]
+    
+    # Grow the window of candidates until enough of them survive the filter
+    window = limit
+    while True:
+        candidates = [image_id.decode('utf-8') for image_id in label_ids[np.sort(ranked[:window])]]
+        kept = set(distinct(candidates))
+        if len(kept) >= limit or window >= len(ranked):
+            break
+        window = min(len(ranked), window + max(limit - len(kept), window // 4))
+    increment('skipped', window - len(kept), reason='duplicate')
+    
+    # Keep the earliest survivors in sampling order
+    selected = [pos for pos in ranked[:window] if label_ids[pos].decode('utf-8') in kept][:limit]
+    return [image_id.decode('utf-8') for image_id in label_ids[np.sort(selected)]]
+
+def distinct_images(source_dir, threshold, workers=4, cache_path=None, report_path=None):
+    """
+    Return a distinct filter for select_relevant_images that drops near
+    duplicate source images with dedup.dedup_image_ids.
+    """
+    return partial(dedup_image_ids, Path(source_dir), threshold=threshold, workers=workers, cache_path=cache_path,
+                   report_path=report_path)
+
+def copy_relevant_images(source_dir, vp_labels_dir, target_dir, max_images=50, vp_index=None, sampling='first',
+                         seed=0, distinct=None):
     """
     Copy images that have corresponding vanishing point labels.
+    With a label index the image ids are taken from it instead of globbing vp_labels_dir.
+    See select_relevant_images for the sampling strategies and distinct.
     """
     copied_count = 0
     
-    # Get list of available vanishing point files
-    vp_files = list(Path(vp_labels_dir).glob("*.txt"))
+    with stage('select'):
+        image_ids = select_relevant_images(source_dir, vp_labels_dir, max_images, vp_index, sampling, seed,
+                                           distinct=distinct)
     
-    for vp_file in vp_files:
-        if copied_count >= max_images:
-            break
-            
-        # Get the image ID from the filename
-        image_id = vp_file.stem
-        
-        # Look for corresponding image in source directory
+    for image_id in image_ids:
         source_image = Path(source_dir) / f"{image_id}.jpg"
-        
-        if source_image.exists():
-            target_image = Path(target_dir) / f"{image_id}.jpg"
+        target_image = Path(target_dir) / f"{image_id}.jpg"
+        with stage('copy'):
             shutil.copy2(source_image, target_image)
-            print(f"Copied: {source_image} -> {target_image}")
-            copied_count += 1
-        else:
-            print(f"Image not found: {source_image}")
+        size = os.path.getsize(target_image)
+        increment('bytes_read', size)
+        increment('bytes_written', size)
+        print(f"Copied: {source_image} -> {target_image}")
+        copied_count += 1
     
     print(f"Copied {copied_count} images")
     return copied_count
 
-def process_all_images(images_dir, vp_labels_dir, overlays_dir, vp_only_dir):
+def _process_work_item(item):
+    """
+    Render the overlay and VP-only images for one (image, label) work unit.
+    Returns (image_id, status, messages) instead of printing, so results from
+    worker processes can be reported by the parent in a deterministic order.
+    """
+    image_id, image_file, vp_file, overlay_path, vp_only_path, label, vp_data, render_options = item
+    log = io.StringIO()
+    try:
+        # Decode once and share the pixels between both renderers
+        with stage('imread'):
+            image = cv2.imread(image_file)
+        if image is not None:
+            increment('bytes_read', os.path.getsize(image_file))
+        if image is None:
+            return image_id, 'failed', [f"Could not read image: {image_file}"]
+        with contextlib.redirect_stdout(log):
+            if vp_data is None:
+                vp_data = _scale_vp_data(vp_file, image.shape[1], image.shape[0], label=label)
+            if vp_data is None:
+                overlay_ok = vp_only_ok = False
+            else:
+                overlay_ok = create_overlay_image(image_file, vp_file, overlay_path, image=image, vp_data=vp_data)
+                vp_only_ok = create_vanishing_point_only(image_file, vp_file, vp_only_path, image=image, vp_data=vp_data,
+                                                         render_options=render_options)
+    except Exception as e:
+        return image_id, 'failed', [f"{type(e).__name__}: {e}"]
+    
+    # Both renderers report the same label problems; keep each message once
+    messages = list(dict.fromkeys(line for line in log.getvalue().splitlines() if line))
+    if overlay_ok:
+        messages.insert(0, f"Created overlay: {overlay_path}")
+    if vp_only_ok:
+        messages.append(f"Created VP only: {vp_only_path}")
+        return image_id, 'processed', messages
+    return image_id, 'failed', messages
+
+def _process_chunk(chunk):
+    """
+    Process a list of work units inside a worker process.
+    Returns the results and a metrics snapshot for the parent to merge.
+    """
+    METRICS.reset()
+    return [_process_work_item(item) for item in chunk], METRICS.snapshot()
+
+def _merged_results(future):
+    results, snapshot = future.result()
+    METRICS.merge(snapshot)
+    return results
+
+def _iter_results(work_items, workers, chunk_size):
+    """
+    Yield work unit results in submission order.
+    With more than one worker, chunks are spread across a process pool while
+    keeping at most two chunks per worker in flight.
+    """
+    if workers <= 1:
+        for item in work_items:
+            yield _process_work_item(item)
+        return
+    
+    chunks = [work_items[i:i + chunk_size] for i in range(0, len(work_items), chunk_size)]
+    max_pending = workers * 2
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_process_chunk, chunk))
+            if len(pending) >= max_pending:
+                yield from _merged_results(pending.popleft())
+        while pending:
+            yield from _merged_results(pending.popleft())
+
+def prefilter_labels(candidates):
+    """
+    Solve the vanishing points of all candidates in one vectorized pass.
+    candidates is a list of (image_file, vp_file, label) tuples, where label is
+    a parsed label or None to read vp_file; image sizes are read from the JPEG
+    headers, so no image is decoded.
+    Returns a list with, per candidate, either ('ok', vp_data) or
+    ('rejected', message). Candidates whose size cannot be probed get
+    ('ok', None) and are checked after decoding.
+    """
+    with stage('prefilter'):
+        return _prefilter_labels(candidates)
+
+def _prefilter_labels(candidates):
+    results = [None] * len(candidates)
+    indices, line_pairs, label_sizes, image_sizes = [], [], [], []
+    
+    for i, (image_file, vp_file, label) in enumerate(candidates):
+        size = read_jpeg_size(image_file)
+        if size is None:
+            results[i] = ('ok', None)
+            continue
+        vp_width, vp_height, line1, line2 = label if label is not None else read_vp_data(vp_file)
+        indices.append(i)
+        line_pairs.append([line1[:4], line2[:4]])
+        label_sizes.append((vp_width, vp_height))
+        image_sizes.append(size)
+    
+    if not indices:
+        return results
+    
+    line_pairs = np.asarray(line_pairs, dtype=np.float64)
+    image_sizes = np.asarray(image_sizes, dtype=np.float64)
+    scale = image_sizes / np.asarray(label_sizes, dtype=np.float64)
+    scaled_pairs = line_pairs * np.tile(scale, 2)[:, None, :]
+    
+    points, degenerate, in_bounds = calculate_vanishing_points(scaled_pairs, image_sizes)
+    
+    for j, i in enumerate(indices):
+        vp_file = candidates[i][1]
+        vp_x, vp_y = int(points[j, 0]), int(points[j, 1])
+        width, height = int(image_sizes[j, 0]), int(image_sizes[j, 1])
+        if degenerate[j]:
+            results[i] = ('rejected', f"Could not calculate vanishing point for {vp_file}")
+            increment('skipped', reason='degenerate')
+        elif not in_bounds[j]:
+            results[i] = ('rejected', f"Vanishing point ({vp_x}, {vp_y}) is outside image boundaries ({width}x{height}) - skipping")
+            increment('skipped', reason='outside')
+        else:
+            results[i] = ('ok', (vp_x, vp_y, scaled_pairs[j, 0].tolist(), scaled_pairs[j, 1].tolist()))
+    return results
+
+def render_candidates(candidates, overlays_dir, vp_only_dir, workers=1, chunk_size=16, render_options=None):
+    """
+    Render overlays and VP-only images for (image_file, vp_file, label) candidates.
+    Yields (image_id, status, messages) with status 'processed', 'rejected'
+    (label rejected before decoding) or 'failed'. Rejections come first,
+    followed by the rendered items in candidate order.
+    """
+    work_items = []
+    for (image_file, vp_file, label), (status, value) in zip(candidates, prefilter_labels(candidates)):
+        image_id = Path(image_file).stem
+        if status == 'rejected':
+            yield image_id, 'rejected', [value]
+            continue
+        overlay_path = Path(overlays_dir) / f"{image_id}_overlay.jpg"
+        vp_only_path = Path(vp_only_dir) / f"{image_id}_vp_only.jpg"
+        work_items.append((image_id, image_file, vp_file, str(overlay_path), str(vp_only_path), label, value,
+                           render_options))
+    
+    yield from _iter_results(work_items, workers, max(1, chunk_size))
+
+def process_all_images(images_dir, vp_labels_dir, overlays_dir, vp_only_dir, workers=1, chunk_size=16, vp_index=None,
+                       render_options=None):
     """
     Process all images in the directory.
+    Images are handled in sorted order; with workers > 1 they are rendered in
+    a process pool and per-item failures are collected and reported at the end.
+    Labels whose vanishing point is degenerate or outside the frame are
+    rejected before any image is decoded. With a label index no label file
+    is opened.
     """
     processed_count = 0
+    skipped_count = 0
+    failures = []
+    candidates = []
     
-    for image_file in Path(images_dir).glob("*.jpg"):
+    for image_file in sorted(Path(images_dir).glob("*.jpg")):
         image_id = image_file.stem
         vp_file = Path(vp_labels_dir) / f"{image_id}.txt"
         
-        if vp_file.exists():
-            # Create overlay
-            overlay_path = Path(overlays_dir) / f"{image_id}_overlay.jpg"
-            if create_overlay_image(str(image_file), str(vp_file), str(overlay_path)):
-                print(f"Created overlay: {overlay_path}")
-            
-            # Create vanishing point only
-            vp_only_path = Path(vp_only_dir) / f"{image_id}_vp_only.jpg"
-            if create_vanishing_point_only(str(image_file), str(vp_file), str(vp_only_path)):
-                print(f"Created VP only: {vp_only_path}")
-                processed_count += 1
+        if vp_index is not None:
+            label = vp_index.lookup(image_id)
+            has_label = label is not None
+        else:
+            label = None
+            has_label = vp_file.exists()
+        
+        if has_label:
+            candidates.append((str(image_file), str(vp_file), label))
         else:
             print(f"No vanishing point data for: {image_file}")
+            increment('skipped', reason='no_label')
+            skipped_count += 1
+    
+    for image_id, status, messages in render_candidates(candidates, overlays_dir, vp_only_dir, workers, chunk_size,
+                                                        render_options):
+        if status == 'processed':
+            for message in messages:
+                print(message)
+            increment('items', stage='render')
+            processed_count += 1
+        else:
+            if status == 'failed':
+                increment('failed', stage='render')
+            failures.append((image_id, messages))
+    
+    if failures:
+        failures.sort()
+        print(f"\nFailed or skipped {len(failures)} images:")
+        for image_id, messages in failures:
+            print(f"- {image_id}: {'; '.join(messages) or 'unknown error'}")
     
     print(f"Processed {processed_count} images")
+    if skipped_count:
+        print(f"Skipped {skipped_count} images without vanishing point data")
     return processed_count
 
 def main():
@@ -272,8 +595,34 @@ def main():
                        help='Target directory for processed images')
     parser.add_argument('--max-images', type=int, default=50,
                        help='Maximum number of images to process')
+    parser.add_argument('--sampling', choices=SAMPLING_STRATEGIES, default='first',
+                       help='How to pick max-images of the labeled images: first, random or stratified by vanishing point position')
+    parser.add_argument('--sample-seed', type=int, default=0,
+                       help='Seed for random and stratified sampling')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Number of worker processes used for rendering (1 = run in this process)')
+    parser.add_argument('--chunk-size', type=int, default=16,
+                       help='Number of images handed to a worker process at a time')
+    parser.add_argument('--angle-step', type=float, default=DEFAULT_ANGLE_STEP,
+                       help='Angle in degrees between the rays of the vanishing point images')
+    parser.add_argument('--line-width', type=int, default=DEFAULT_LINE_WIDTH,
+                       help='Stroke width of the rays in the vanishing point images')
+    parser.add_argument('--dot-radius', type=int, default=DEFAULT_DOT_RADIUS,
+                       help='Radius of the vanishing point dot')
+    parser.add_argument('--dedup-threshold', type=int,
+                       help='Drop near-duplicate images within this perceptual hash distance (of 64 bits) before rendering')
+    parser.add_argument('--index-path',
+                       help='Label index file (default: <vp-labels-dir>.vpidx next to the labels directory)')
+    parser.add_argument('--rebuild-index', action='store_true',
+                       help='Recompile the label index even if it is up to date')
+    parser.add_argument('--verify-labels', action='store_true',
+                       help='Also stat every label file to catch labels edited in place since the index was compiled')
+    parser.add_argument('--no-index', action='store_true',
+                       help='Read label files directly instead of using the label index')
+    metrics.add_arguments(parser)
     
     args = parser.parse_args()
+    metrics.setup(args)
     
     # Create output directories
     overlays_dir = Path(args.target_dir) / "overlays"
@@ -284,12 +633,33 @@ def main():
     vp_only_dir.mkdir(parents=True, exist_ok=True)
     images_dir.mkdir(parents=True, exist_ok=True)
     
+    vp_index = None
+    if not args.no_index:
+        with stage('label_index'):
+            vp_index = load_vp_index(args.vp_labels_dir, args.index_path, rebuild=args.rebuild_index,
+                                     verify=args.verify_labels)
+    
+    render_options = {'angle_step': args.angle_step, 'line_width': args.line_width, 'dot_radius': args.dot_radius}
+    
+    distinct = None
+    if args.dedup_threshold is not None:
+        # Duplicates are dropped while selecting, so max-images distinct images are still copied
+        distinct = distinct_images(args.source_dir, args.dedup_threshold, max(1, args.workers),
+                                   cache_path=Path(args.target_dir) / ".dedup_hashes",
+                                   report_path=Path(args.target_dir) / "dedup_report.jsonl")
+    
     print("Step 1: Copying relevant images...")
-    copied_count = copy_relevant_images(args.source_dir, args.vp_labels_dir, str(images_dir), args.max_images)
+    with stage('collect'):
+        copied_count = copy_relevant_images(args.source_dir, args.vp_labels_dir, str(images_dir), args.max_images,
+                                            vp_index=vp_index, sampling=args.sampling, seed=args.sample_seed,
+                                            distinct=distinct)
     
     if copied_count > 0:
         print("\nStep 2: Processing images with vanishing points...")
-        processed_count = process_all_images(str(images_dir), args.vp_labels_dir, str(overlays_dir), str(vp_only_dir))
+        with stage('render'):
+            processed_count = process_all_images(str(images_dir), args.vp_labels_dir, str(overlays_dir),
+                                                 str(vp_only_dir), workers=args.workers, chunk_size=args.chunk_size,
+                                                 vp_index=vp_index, render_options=render_options)
         
         print(f"\nSummary:")
         print(f"- Copied {copied_count} images")
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Token-bucket rate limiting for API clients, for asyncio tasks or threads.
+Limits requests per minute and tokens per minute, and honours server
+Retry-After hints by pausing every request that shares the limiter.
+"""
+
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at rate_per_minute.
+    The bucket holds at most burst_seconds worth of tokens, so a fresh
+    limiter does not fire a whole minute of requests at once.
+    """
+
+    def __init__(self, rate_per_minute, burst_seconds=10):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """
+        Seconds until amount tokens are available (0 if they are available now).
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        """
+        Remove tokens; the balance may go negative to record a debt.
+        """
+        self._refill()
+        self.tokens -= amount
+
+class RateLimiter:
+    """
+    Combined requests/minute and tokens/minute limiter for asyncio tasks.
+    Either limit can be None to disable it. Waiters are served in FIFO order.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, burst_seconds=10):
+        self.request_bucket = TokenBucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens=0):
+        """
+        Wait until one request using an estimated number of tokens may be sent.
+        """
+        async with self._lock:
+            while True:
+                delay = max(0.0, self.paused_until - time.monotonic())
+                if self.request_bucket:
+                    delay = max(delay, self.request_bucket.wait_time(1))
+                if self.token_bucket and tokens:
+                    delay = max(delay, self.token_bucket.wait_time(tokens))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            if self.request_bucket:
+                self.request_bucket.take(1)
+            if self.token_bucket and tokens:
+                self.token_bucket.take(tokens)
+
+    def adjust(self, token_delta):
+        """
+        Correct the token bucket once the actual usage of a request is known.
+        """
+        if self.token_bucket and token_delta:
+            self.token_bucket.take(token_delta)
+
+    def pause(self, seconds):
+        """
+        Hold back all requests for the given number of seconds, e.g. after a 429.
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class BlockingRateLimiter:
+    """
+    Thread-safe counterpart of RateLimiter for worker threads.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, burst_seconds=10):
+        self.request_bucket = TokenBucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=0):
+        """
+        Block until one request using an estimated number of tokens may be sent.
+        """
+        with self._lock:
+            while True:
+                delay = max(0.0, self.paused_until - time.monotonic())
+                if self.request_bucket:
+                    delay = max(delay, self.request_bucket.wait_time(1))
+                if self.token_bucket and tokens:
+                    delay = max(delay, self.token_bucket.wait_time(tokens))
+                if delay <= 0:
+                    break
+                time.sleep(delay)
+            if self.request_bucket:
+                self.request_bucket.take(1)
+            if self.token_bucket and tokens:
+                self.token_bucket.take(tokens)
+
+    def pause(self, seconds):
+        """
+        Hold back all requests for the given number of seconds, e.g. after a 429.
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+def parse_retry_after(headers):
+    """
+    Return the delay in seconds requested by retry-after-ms / Retry-After
+    response headers, or None if there is no usable hint.
+    """
+    if not headers:
+        return None
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, headers=None, base=1.0, cap=60.0):
+    """
+    Delay before retry number attempt (0-based): the server's Retry-After hint
+    if present, otherwise exponential backoff with full jitter.
+    """
+    retry_after = parse_retry_after(headers)
+    if retry_after is not None:
+        return min(retry_after, cap)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -5,22 +5,29 @@ Script to reorganize processed images into train folder with new naming scheme.
 - Vanishing point images: N_end.jpg
 - Both in the same folder
 - Start counting from 1
+Re-runs only touch pairs that changed; files can be linked instead of copied.
 """
 
-import os
-import shutil
+import argparse
 from pathlib import Path
+import metrics
+from file_sync import sync_files, LINK_MODES
 
-def reorganize_images():
+def reorganize_images(images_dir="/Users/Jasper/Projects/kontext_hack/processed_images/images",
+                      vp_only_dir="/Users/Jasper/Projects/kontext_hack/processed_images/vanishing_points_only",
+                      train_dir="/Users/Jasper/Projects/kontext_hack/train",
+                      link_mode='copy', compare='mtime'):
     """
     Reorganize images into train folder with new naming scheme.
+    link_mode is one of file_sync.LINK_MODES; compare is 'mtime' or 'hash'.
+    Numbered pairs that no longer exist are removed from the train folder.
     """
     # Source directories
-    images_dir = Path("/Users/Jasper/Projects/kontext_hack/processed_images/images")
-    vp_only_dir = Path("/Users/Jasper/Projects/kontext_hack/processed_images/vanishing_points_only")
+    images_dir = Path(images_dir)
+    vp_only_dir = Path(vp_only_dir)
     
     # Target directory
-    train_dir = Path("/Users/Jasper/Projects/kontext_hack/train")
+    train_dir = Path(train_dir)
     
     # Ensure train directory exists
     train_dir.mkdir(parents=True, exist_ok=True)
@@ -32,6 +39,7 @@ def reorganize_images():
     print(f"Found {len(original_images)} original images")
     
     counter = 1
+    pairs = []
     
     for original_image in original_images:
         # Get the image ID from filename
@@ -41,25 +49,41 @@ def reorganize_images():
         vp_image = vp_only_dir / f"{image_id}_vp_only.jpg"
         
         if vp_image.exists():
-            # Copy original image as N_end.jpg
-            end_name = f"{counter}_end.jpg"
-            end_path = train_dir / end_name
-            shutil.copy2(original_image, end_path)
-            print(f"Copied: {original_image.name} -> {end_name}")
-            
-            # Copy vanishing point image as N_start.jpg
-            start_name = f"{counter}_start.jpg"
-            start_path = train_dir / start_name
-            shutil.copy2(vp_image, start_path)
-            print(f"Copied: {vp_image.name} -> {start_name}")
-            
+            # Original image as N_end.jpg, vanishing point image as N_start.jpg
+            pairs.append((original_image, f"{counter}_end.jpg"))
+            pairs.append((vp_image, f"{counter}_start.jpg"))
             counter += 1
         else:
             print(f"Warning: No vanishing point image found for {original_image.name}")
     
+    counts = sync_files(pairs, train_dir, mode=link_mode, compare=compare,
+                        prune_patterns=("*_start.jpg", "*_end.jpg"))
+    
     print(f"\nReorganization complete!")
     print(f"Created {counter - 1} pairs of images in {train_dir}")
     print(f"Files: 1_start.jpg, 1_end.jpg, 2_start.jpg, 2_end.jpg, ...")
+    print(f"Added {counts['added']}, updated {counts['updated']}, unchanged {counts['unchanged']}, "
+          f"removed {counts['removed']} files ({link_mode} mode)")
+
+def main():
+    parser = argparse.ArgumentParser(description='Reorganize processed images into numbered train pairs')
+    parser.add_argument('--images-dir', default='/Users/Jasper/Projects/kontext_hack/processed_images/images',
+                       help='Directory containing the original images')
+    parser.add_argument('--vp-only-dir', default='/Users/Jasper/Projects/kontext_hack/processed_images/vanishing_points_only',
+                       help='Directory containing the vanishing point only images')
+    parser.add_argument('--train-dir', default='/Users/Jasper/Projects/kontext_hack/train',
+                       help='Target train directory')
+    parser.add_argument('--link-mode', choices=LINK_MODES, default='copy',
+                       help='How to place files: auto tries reflink, hardlink, symlink, then copy')
+    parser.add_argument('--compare', choices=('mtime', 'hash'), default='mtime',
+                       help='How to detect changed files on re-runs')
+    metrics.add_arguments(parser)
+    
+    args = parser.parse_args()
+    metrics.setup(args)
+    
+    with metrics.stage('reorganize'):
+        reorganize_images(args.images_dir, args.vp_only_dir, args.train_dir, args.link_mode, args.compare)
 
 if __name__ == "__main__":
-    reorganize_images()
+    main()
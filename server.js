@@ -5,16 +5,52 @@ require('dotenv').config();
 
 const app = express();
 const PORT = process.env.PORT || 3000;
+// Python control image service (control_server.py); optional, the browser renders the control image without it
+const CONTROL_SERVICE_URL = process.env.CONTROL_SERVICE_URL;
 
 // Middleware
 app.use(cors());
 app.use(express.json());
 app.use(express.static('.'));
 
+// Fetch a control image from the control image service as a data URI
+async function fetchControlImageDataUri(control) {
+    const query = new URLSearchParams({
+        w: control.w,
+        h: control.h,
+        vx: control.vx,
+        vy: control.vy,
+        step: control.step ?? 20
+    });
+    const response = await fetch(`${CONTROL_SERVICE_URL}/control?${query}`);
+
+    if (!response.ok) {
+        throw new Error(`Control service error: ${response.status} ${response.statusText}`);
+    }
+
+    const png = Buffer.from(await response.arrayBuffer());
+    return `data:image/png;base64,${png.toString('base64')}`;
+}
+
 // API endpoint to generate image
 app.post('/api/generate', async (req, res) => {
     try {
-        const { image_url, prompt, num_inference_steps, guidance_scale, num_images, enable_safety_checker, output_format, acceleration, resolution_mode, loras } = req.body;
+        const { control, prompt, num_inference_steps, guidance_scale, num_images, enable_safety_checker, output_format, acceleration, resolution_mode, loras } = req.body;
+        let { image_url } = req.body;
+
+        // Render the control image server-side when only the vanishing point was sent
+        if (!image_url && control) {
+            if (!CONTROL_SERVICE_URL) {
+                return res.status(503).json({ error: 'Control image service not configured' });
+            }
+            // Any control service failure is a 503, so the browser falls back to sending the canvas
+            try {
+                image_url = await fetchControlImageDataUri(control);
+            } catch (error) {
+                console.error('Error fetching control image:', error);
+                return res.status(503).json({ error: `Control image service unavailable: ${error.message}` });
+            }
+        }
 
         const response = await fetch('https://queue.fal.run/fal-ai/flux-kontext-lora', {
             method: 'POST',
@@ -94,6 +130,34 @@ app.get('/api/result/:requestId', async (req, res) => {
     }
 });
 
+// API endpoint to proxy control images from the control image service
+app.get('/api/control', async (req, res) => {
+    if (!CONTROL_SERVICE_URL) {
+        return res.status(503).json({ error: 'Control image service not configured' });
+    }
+
+    try {
+        const query = new URLSearchParams(req.query);
+        const headers = {};
+        if (req.headers['if-none-match']) {
+            headers['If-None-Match'] = req.headers['if-none-match'];
+        }
+
+        const response = await fetch(`${CONTROL_SERVICE_URL}/control?${query}`, { headers });
+
+        for (const name of ['content-type', 'etag', 'cache-control', 'x-vanishing-point']) {
+            const value = response.headers.get(name);
+            if (value) {
+                res.set(name, value);
+            }
+        }
+        res.status(response.status).send(Buffer.from(await response.arrayBuffer()));
+    } catch (error) {
+        console.error('Error fetching control image:', error);
+        res.status(502).json({ error: error.message });
+    }
+});
+
 // Serve the main HTML file
 app.get('/', (req, res) => {
     res.sendFile(path.join(__dirname, 'index.html'));
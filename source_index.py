@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Cached listing of the image ids in a source image directory.
+The directory is scanned once with os.scandir and its sorted {image_id}.jpg
+ids are written to a small file next to it together with the directory mtime,
+so matching labels against a large (e.g. network mounted) image dump is a
+set intersection instead of one stat per label. Selections can take the first
+N matches, a seeded random sample, or a sample stratified by vanishing point
+position.
+
+Layout: a 32-byte header followed by the sorted ids as fixed-size records.
+"""
+
+import os
+import struct
+import argparse
+from pathlib import Path
+import numpy as np
+
+SOURCE_MAGIC = b'VPSRC\x00\x00\x01'
+SOURCE_VERSION = 1
+HEADER_FORMAT = '<8sIIqq'
+HEADER_SIZE = 32
+MAX_ID_LENGTH = 32
+ID_DTYPE = np.dtype(f'S{MAX_ID_LENGTH}')
+
+SAMPLING_STRATEGIES = ('first', 'random', 'stratified')
+
+def default_source_index_path(source_dir):
+    """
+    Return the default cache location: a sibling of the source directory,
+    so writing the cache does not change the directory's own mtime.
+    """
+    source_path = Path(source_dir).resolve()
+    return source_path.parent / f"{source_path.name}.vpsrc"
+
+def scan_source_ids(source_dir):
+    """
+    List the ids of all .jpg files in source_dir as a sorted array of
+    UTF-8 encoded ids. Ids longer than the label index allows are left out,
+    since they can never match a label.
+    """
+    ids = []
+    with os.scandir(source_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.jpg'):
+                encoded_id = entry.name[:-4].encode('utf-8')
+                if len(encoded_id) <= MAX_ID_LENGTH:
+                    ids.append(encoded_id)
+    source_ids = np.array(ids, dtype=ID_DTYPE)
+    source_ids.sort()
+    return source_ids
+
+def write_source_index(source_dir, index_path=None):
+    """
+    Scan source_dir and write its ids to the cache. Returns the id array.
+    """
+    index_path = Path(index_path) if index_path else default_source_index_path(source_dir)
+    
+    # Take the mtime before scanning so files added during the scan trigger a rescan
+    dir_mtime_ns = os.stat(source_dir).st_mtime_ns
+    source_ids = scan_source_ids(source_dir)
+    
+    header = struct.pack(HEADER_FORMAT, SOURCE_MAGIC, SOURCE_VERSION, ID_DTYPE.itemsize, len(source_ids), dir_mtime_ns)
+    tmp_path = index_path.with_name(index_path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\x00'))
+        f.write(source_ids.tobytes())
+    os.replace(tmp_path, index_path)
+    return source_ids
+
+def _read_source_index(index_path):
+    """
+    Read a cache file. Returns (dir_mtime_ns, ids), or None if it is missing or invalid.
+    """
+    try:
+        with open(index_path, 'rb') as f:
+            raw = f.read()
+    except OSError:
+        return None
+    if len(raw) < HEADER_SIZE:
+        return None
+    magic, version, id_size, count, dir_mtime_ns = struct.unpack_from(HEADER_FORMAT, raw)
+    if (magic != SOURCE_MAGIC or version != SOURCE_VERSION or id_size != ID_DTYPE.itemsize
+            or len(raw) != HEADER_SIZE + count * id_size):
+        return None
+    return dir_mtime_ns, np.frombuffer(raw, dtype=ID_DTYPE, count=count, offset=HEADER_SIZE)
+
+def load_source_ids(source_dir, index_path=None, rebuild=False, cache=True):
+    """
+    Return the sorted id array of source_dir, from the cache when it is as
+    new as the directory, otherwise from a fresh scan (written back to the
+    cache if possible).
+    """
+    if not cache:
+        return scan_source_ids(source_dir)
+    index_path = Path(index_path) if index_path else default_source_index_path(source_dir)
+    cached = None if rebuild else _read_source_index(index_path)
+    if cached is not None and cached[0] == os.stat(source_dir).st_mtime_ns:
+        return cached[1]
+    try:
+        source_ids = write_source_index(source_dir, index_path)
+    except OSError as e:
+        print(f"Could not write source index {index_path}: {e}")
+        return scan_source_ids(source_dir)
+    print(f"Indexed {len(source_ids)} source images: {index_path}")
+    return source_ids
+
+def match_image_ids(label_ids, source_ids):
+    """
+    Return a mask of the label ids that have a source image.
+    """
+    label_ids = np.asarray(label_ids, dtype=ID_DTYPE)
+    if not len(source_ids):
+        return np.zeros(len(label_ids), dtype=bool)
+    pos = np.minimum(np.searchsorted(source_ids, label_ids), len(source_ids) - 1)
+    return source_ids[pos] == label_ids
+
+def rank_positions(count, sampling='first', seed=0, strata=None):
+    """
+    Return the positions of count matched items in the order sampling picks
+    them, so the first k positions are the sample of size k. Items that
+    stratified sampling leaves out are not included.
+    """
+    if sampling not in SAMPLING_STRATEGIES:
+        raise ValueError(f"Unknown sampling strategy: {sampling}")
+    if sampling == 'first':
+        return np.arange(count)
+    
+    rng = np.random.default_rng(seed)
+    if sampling == 'random':
+        return rng.permutation(count)
+    
+    if strata is None:
+        raise ValueError("Stratified sampling needs a stratum for every item")
+    strata = np.asarray(strata)
+    order = rng.permutation(count)
+    order = order[strata[order] >= 0]
+    # Rank of every item within its cell in shuffled order, then take rank 0 of every cell, rank 1, ...
+    cells = strata[order]
+    by_cell = np.argsort(cells, kind='stable')
+    sorted_cells = cells[by_cell]
+    starts = np.searchsorted(sorted_cells, sorted_cells)
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[by_cell] = np.arange(len(order)) - starts
+    cell_order = rng.permutation(int(cells.max()) + 1) if len(cells) else np.zeros(0, dtype=np.int64)
+    return order[np.lexsort((cell_order[cells], ranks))]
+
+def select_positions(count, max_images=None, sampling='first', seed=0, strata=None):
+    """
+    Pick up to max_images of count matched items and return their positions
+    in ascending order. 'first' keeps the leading items, 'random' draws a
+    seeded sample, and 'stratified' needs strata (one cell number per item,
+    negative for items to leave out) and draws round-robin from the cells in
+    seeded random order, so every cell is represented before any repeats.
+    """
+    ranked = rank_positions(count, sampling, seed, strata)
+    limit = count if max_images is None else min(max_images, count)
+    return np.sort(ranked[:limit])
+
+def vp_strata(points, sizes, grid=3):
+    """
+    Assign vanishing points to the cells of a grid x grid partition of the
+    frame. points and sizes are (N, 2) arrays; points outside the frame get -1.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    sizes = np.asarray(sizes, dtype=np.float64).reshape(-1, 2)
+    relative = points / sizes
+    inside = ((relative >= 0) & (relative < 1)).all(axis=1)
+    cells = np.clip((np.where(inside[:, None], relative, 0) * grid).astype(np.int64), 0, grid - 1)
+    return np.where(inside, cells[:, 1] * grid + cells[:, 0], -1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Index the image ids of a source image directory')
+    parser.add_argument('--source-dir', default='/Users/Jasper/Downloads/archive (2)/images',
+                       help='Source directory containing original images')
+    parser.add_argument('--index-path',
+                       help='Where to write the index (default: <source-dir>.vpsrc next to the directory)')
+    
+    args = parser.parse_args()
+    
+    index_path = args.index_path or default_source_index_path(args.source_dir)
+    source_ids = write_source_index(args.source_dir, index_path)
+    print(f"Indexed {len(source_ids)} source images into {index_path}")
+
+if __name__ == "__main__":
+    main()
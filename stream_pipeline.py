@@ -0,0 +1,552 @@
+#!/usr/bin/env python3
+"""
+Single-pass streaming pipeline from vanishing point labels to the final
+training layout (train_control/N.jpg, train_end/N.jpg and train_end/N.txt).
+Control images can also be written as lossless palette PNGs, or stored only as
+their drawing parameters in a control_params file. Each source image is read
+once and every output byte is written once, without the processed_images and
+train intermediate folders. The stages
+
+    labels -> read/render -> caption -> write
+
+are generators and worker pools connected by bounded queues, so file reads,
+rendering, caption requests and disk writes overlap while memory stays bounded
+by the queue sizes instead of the dataset size.
+"""
+
+import io
+import os
+import json
+import queue
+import shutil
+import hashlib
+import argparse
+import threading
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from dotenv import load_dotenv
+import numpy as np
+import cv2
+import caption
+from caption_store import CaptionStore
+from dataset_shards import ShardWriter
+from control_params import ControlParamsWriter, make_params, encode_palette_png
+from augment import sample_variants, render_variants
+from buckets import (make_buckets, assign_bucket, crop_geometry, resize_to_bucket, map_point, BucketManifestWriter,
+                     DEFAULT_RESOLUTIONS, DEFAULT_ASPECT_RATIOS, DEFAULT_MULTIPLE)
+from rate_limit import BlockingRateLimiter
+from vp_index import load_vp_index
+from source_index import SAMPLING_STRATEGIES
+from process_vanishing_points import (select_relevant_images, distinct_images, prefilter_labels, read_jpeg_size,
+                                      _scale_vp_data)
+from vp_rasterizer import render_control_image, DEFAULT_ANGLE_STEP, DEFAULT_LINE_WIDTH, DEFAULT_DOT_RADIUS
+
+CONTROL_FORMATS = ('jpg', 'png', 'params')
+
+# Labels solved per vectorized prefilter pass
+PREFILTER_CHUNK = 256
+
+_STOP = object()
+
+def iter_candidates(source_dir, vp_labels_dir, vp_index=None, max_images=None, sampling='first', sample_seed=0,
+                    dedup_threshold=None, dedup_cache=None, dedup_report=None):
+    """
+    Yield (image_id, image_path, vp_data, candidate) for the labeled source
+    images whose vanishing point lies inside the frame, in the order
+    process_all_images numbers them. Labels are solved in vectorized chunks
+    from the JPEG headers; vp_data is None when the header could not be
+    probed, and candidate is the (image_file, vp_file, label) prefilter input.
+    With dedup_threshold, near duplicates are dropped (dedup.dedup_image_ids)
+    and replaced by further candidates before anything is rendered or
+    captioned.
+    """
+    source_dir = Path(source_dir)
+    vp_labels_dir = Path(vp_labels_dir)
+    
+    # Same selection as copy_relevant_images, with duplicates replaced by the next candidates
+    distinct = None
+    if dedup_threshold is not None:
+        distinct = distinct_images(source_dir, dedup_threshold, cache_path=dedup_cache, report_path=dedup_report)
+    selected = sorted(select_relevant_images(source_dir, vp_labels_dir, max_images, vp_index, sampling, sample_seed,
+                                             distinct=distinct))
+    
+    for start in range(0, len(selected), PREFILTER_CHUNK):
+        chunk = selected[start:start + PREFILTER_CHUNK]
+        candidates = [(str(source_dir / f"{image_id}.jpg"), str(vp_labels_dir / f"{image_id}.txt"),
+                       vp_index.lookup(image_id) if vp_index is not None else None) for image_id in chunk]
+        for image_id, candidate, (status, value) in zip(chunk, candidates, prefilter_labels(candidates)):
+            if status == 'rejected':
+                print(f"Skipped {image_id}: {value}")
+            else:
+                yield image_id, candidate[0], value, candidate
+
+def _render_failed(message):
+    return None, message, None, None, []
+
+def _encode_control(control, control_format):
+    if control_format == 'png':
+        return encode_palette_png(control)
+    ok, encoded = cv2.imencode('.jpg', control)
+    return encoded.tobytes() if ok else None
+
+def render_item(image_path, vp_data, candidate, render_options=None, control_format='jpg', buckets=None,
+                target_quality=95, augment=0, augment_seed=0):
+    """
+    Read one source image and render its control image.
+    Returns (source_bytes, control_bytes, target_bytes, metadata, variants),
+    or (None, message, None, None, []) on failure. control_bytes is a JPEG or
+    palette PNG depending on control_format, and None for 'params', where
+    nothing is rasterized. Without buckets the target is the source file
+    itself and the size comes from the JPEG header in memory, so the pixels
+    are only decoded when the header cannot be parsed. With buckets the
+    target is resized and cropped to the nearest bucket, with the crop shifted
+    to keep the vanishing point inside it, and the control image is drawn at
+    the bucket resolution; metadata is in output coordinates.
+    With augment, variants holds that many (params, control_bytes) augmented
+    control images seeded by (augment_seed, image id, variant), rendered in
+    one batch from the same size and vanishing point.
+    """
+    with open(image_path, 'rb') as f:
+        data = f.read()
+    
+    image = None
+    size = read_jpeg_size(io.BytesIO(data)) if not buckets else None
+    if size is None:
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return _render_failed(f"Could not read image: {image_path}")
+        size = image.shape[1], image.shape[0]
+    width, height = size
+    
+    if vp_data is None:
+        with contextlib.redirect_stdout(io.StringIO()):
+            vp_data = _scale_vp_data(candidate[1], width, height, label=candidate[2])
+        if vp_data is None:
+            return _render_failed(f"Vanishing point for {image_path} is degenerate or outside the image")
+    vp_x, vp_y, line1, line2 = vp_data
+    
+    metadata = {}
+    target = data
+    if buckets:
+        bucket = assign_bucket(width, height, buckets)
+        focus = (vp_x, vp_y)
+        scale, _, _, crop_x, crop_y = crop_geometry(width, height, bucket, focus)
+        vp_x, vp_y = map_point(vp_x, vp_y, width, height, bucket, focus)
+        if not (0 <= vp_x < bucket[0] and 0 <= vp_y < bucket[1]):
+            return _render_failed(f"Vanishing point for {image_path} falls outside the {bucket[0]}x{bucket[1]} bucket crop")
+        ok, encoded = cv2.imencode('.jpg', resize_to_bucket(image, bucket, focus),
+                                   [cv2.IMWRITE_JPEG_QUALITY, target_quality])
+        if not ok:
+            return _render_failed(f"Could not encode target image for {image_path}")
+        target = encoded.tobytes()
+        metadata.update({'source_width': width, 'source_height': height, 'crop': [crop_x, crop_y, scale]})
+        line1, line2 = ([line[0] * scale - crop_x, line[1] * scale - crop_y, line[2] * scale - crop_x,
+                         line[3] * scale - crop_y] for line in (line1, line2))
+        width, height = bucket
+    
+    control_bytes = None
+    if control_format != 'params':
+        control_bytes = _encode_control(render_control_image(width, height, vp_x, vp_y, **(render_options or {})),
+                                        control_format)
+        if control_bytes is None:
+            return _render_failed(f"Could not encode control image for {image_path}")
+    
+    variants = []
+    if augment:
+        params = sample_variants(Path(image_path).stem, width, height, vp_x, vp_y, augment, seed=augment_seed)
+        if control_format == 'params':
+            variants = [(variant, None) for variant in params]
+        else:
+            variants = [(variant, _encode_control(image, control_format))
+                        for variant, image in zip(params, render_variants(width, height, params))]
+        metadata['augment'] = params
+    metadata.update({
+        'width': width,
+        'height': height,
+        'vanishing_point': [int(vp_x), int(vp_y)],
+        'line1': [float(v) for v in line1],
+        'line2': [float(v) for v in line2],
+    })
+    return data, control_bytes, target, metadata, variants
+
+def iter_rendered(candidates, workers=4, render_options=None, control_format='jpg', buckets=None, target_quality=95,
+                  augment=0, augment_seed=0):
+    """
+    Yield (image_id, source_bytes, control_bytes, target_bytes, metadata,
+    variants) in candidate order, with source_bytes None and a message
+    instead of control_bytes on failure.
+    Items are rendered in a thread pool with at most two per worker in flight.
+    """
+    max_pending = max(1, workers) * 2
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = deque()
+        for image_id, image_path, vp_data, candidate in candidates:
+            pending.append((image_id, executor.submit(render_item, image_path, vp_data, candidate, render_options,
+                                                      control_format, buckets, target_quality, augment,
+                                                      augment_seed)))
+            if len(pending) >= max_pending:
+                image_id, future = pending.popleft()
+                yield (image_id,) + future.result()
+        while pending:
+            image_id, future = pending.popleft()
+            yield (image_id,) + future.result()
+
+LAYOUT_DIRS = ("train_control", "train_control_aug", "train_end")
+
+class LayoutWriter:
+    """
+    Sample sink writing the organize_final_files layout: control images to
+    train_control/N.jpg (or N.png), augmented controls to
+    train_control_aug/N_K.jpg, target images and captions to train_end/N.jpg
+    and N.txt. The layout is built in a hidden staging directory under
+    output_dir and commit() swaps its folders in for the previous ones, so an
+    interrupted run (abort()) leaves the previous layout untouched and no file
+    of an earlier run survives next to the new ones.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = Path(output_dir)
+        self.staging_dir = self.output_dir / ".train_staging"
+        # Left over from an aborted run
+        if self.staging_dir.exists():
+            shutil.rmtree(self.staging_dir)
+        self.control_dir = self.staging_dir / "train_control"
+        self.augment_dir = self.staging_dir / "train_control_aug"
+        self.end_dir = self.staging_dir / "train_end"
+        self.control_dir.mkdir(parents=True)
+        self.end_dir.mkdir()
+
+    def write(self, sample):
+        n = int(sample['__key__'])
+        for ext in ('jpg', 'png'):
+            if sample.get(f'control.{ext}') is not None:
+                (self.control_dir / f"{n}.{ext}").write_bytes(sample[f'control.{ext}'])
+        for name, data in sample.items():
+            if name.startswith('control_aug') and data is not None:
+                variant, ext = name[len('control_aug'):].split('.')
+                self.augment_dir.mkdir(exist_ok=True)
+                (self.augment_dir / f"{n}_{variant}.{ext}").write_bytes(data)
+        (self.end_dir / f"{n}.jpg").write_bytes(sample['end.jpg'])
+        if sample.get('txt') is not None:
+            (self.end_dir / f"{n}.txt").write_bytes(sample['txt'].encode('utf-8'))
+
+    def close(self):
+        pass
+
+    def commit(self):
+        """
+        Replace the layout folders in output_dir with the staged ones. Folders
+        this run did not produce (e.g. train_control_aug without augment) are
+        removed. Call only after a complete run.
+        """
+        for name in LAYOUT_DIRS:
+            staged, target = self.staging_dir / name, self.output_dir / name
+            previous = self.staging_dir / f"{name}.previous"
+            if target.exists():
+                os.replace(target, previous)
+            if staged.exists():
+                os.replace(staged, target)
+            if previous.exists():
+                shutil.rmtree(previous)
+        shutil.rmtree(self.staging_dir)
+
+    def abort(self):
+        """
+        Discard the staged layout and keep the previous one.
+        """
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+class BackgroundWriter:
+    """
+    Feed samples to a sink (LayoutWriter or dataset_shards.ShardWriter) from
+    a background thread through a bounded queue. An OSError fails only its
+    sample (listed in errors); any other sink error stops the writing and is
+    raised to the producer by the next write() or by close().
+    """
+
+    def __init__(self, sink, queue_size=32):
+        self.sink = sink
+        self.samples = queue.Queue(maxsize=queue_size)
+        self.errors = []
+        self.failure = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            sample = self.samples.get()
+            if sample is _STOP:
+                return
+            # After a failure keep draining the queue, so the producer never blocks on a full one
+            if self.failure is not None:
+                continue
+            try:
+                self.sink.write(sample)
+            except OSError as e:
+                self.errors.append(f"{sample['__key__']}: {e}")
+            except Exception as e:
+                self.failure = e
+
+    def write(self, sample):
+        """
+        Queue a sample; blocks while the queue is full. Raises the error the
+        sink failed with, if any.
+        """
+        if self.failure is not None:
+            raise self.failure
+        self.samples.put(sample)
+
+    def close(self, commit=True):
+        """
+        Stop the writer thread and finish the sink. With commit the sink's
+        output replaces the previous one, otherwise it is discarded. Raises
+        the error the sink failed with when committing.
+        """
+        self.samples.put(_STOP)
+        self.thread.join()
+        if not commit or self.failure is not None:
+            self.sink.abort()
+            if commit:
+                raise self.failure
+            return
+        try:
+            self.sink.close()
+            self.sink.commit()
+        except BaseException:
+            self.sink.abort()
+            raise
+
+def stream_dataset(source_dir, vp_labels_dir, output_dir, vp_index=None, max_images=None, workers=4,
+                   render_options=None, api_key=None, base_url=None, concurrency=8, requests_per_minute=50,
+                   payload_options=None, store=None, queue_size=32, sink=None, control_format='jpg',
+                   control_params=None, buckets=None, target_quality=95, bucket_manifest=None, augment=0,
+                   augment_seed=0, sampling='first', sample_seed=0, dedup_threshold=None):
+    """
+    Build the training set in one streaming pass. Samples (control image,
+    target image, caption and VP metadata) are handed in order to sink, by
+    default a LayoutWriter for train_control and train_end under output_dir.
+    control_format is one of CONTROL_FORMATS; with 'params' the control
+    images are not rasterized and their parameters are added to
+    control_params, a control_params.ControlParamsWriter. With a list of
+    (width, height) buckets every sample is resized to its nearest bucket
+    and recorded in bucket_manifest, a buckets.BucketManifestWriter.
+    Captions are always requested for the full source image. augment adds
+    that many seeded control variants per sample (augment.sample_variants).
+    sampling and sample_seed pick the source images as in
+    select_relevant_images. With dedup_threshold, near duplicates are dropped
+    first and listed in output_dir/dedup_report.jsonl.
+    Without api_key, captions are only taken from the caption store.
+    Returns a dict of counts.
+    """
+    counts = {'written': 0, 'failed': 0, 'captions_reused': 0, 'captions_generated': 0, 'captions_missing': 0}
+    limiter = BlockingRateLimiter(requests_per_minute)
+    writer = BackgroundWriter(sink if sink is not None else LayoutWriter(output_dir), queue_size)
+    # Samples wait here, in order, until their caption request has finished
+    pending = deque()
+
+    def emit(sample, digest, future):
+        if future is not None:
+            text = future.result()
+            if text:
+                if store is not None:
+                    store.put(digest, caption.PROMPT, caption.MODEL, caption.MAX_TOKENS, text,
+                              source_path=Path(source_dir) / f"{sample['json']['image_id']}.jpg")
+                sample['txt'] = text
+                counts['captions_generated'] += 1
+            else:
+                counts['captions_missing'] += 1
+        sample['json'] = json.dumps(sample['json'])
+        writer.write(sample)
+        counts['written'] += 1
+    
+    candidates = iter_candidates(source_dir, vp_labels_dir, vp_index, max_images, sampling, sample_seed, dedup_threshold,
+                                 Path(output_dir) / ".dedup_hashes", Path(output_dir) / "dedup_report.jsonl")
+    caption_pool = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    finished = False
+    try:
+        n = 0
+        for image_id, data, control, target, metadata, variants in iter_rendered(
+                candidates, workers, render_options, control_format, buckets, target_quality, augment, augment_seed):
+            if data is None:
+                print(f"Failed {image_id}: {control}")
+                counts['failed'] += 1
+                continue
+            n += 1
+            sample = {'__key__': f"{n:06d}", 'end.jpg': target, 'txt': None,
+                      'json': {'image_id': image_id, **metadata}}
+            if bucket_manifest is not None:
+                bucket_manifest.add(sample['__key__'], image_id, (metadata['width'], metadata['height']),
+                                    metadata['crop'], metadata['vanishing_point'])
+            if control_format == 'params':
+                control_params.add(make_params(sample['__key__'], image_id, metadata['width'], metadata['height'],
+                                               *metadata['vanishing_point'], **(render_options or {})))
+            else:
+                sample[f'control.{control_format}'] = control
+            for variant, (params, variant_bytes) in enumerate(variants):
+                if control_format == 'params':
+                    control_params.add(make_params(f"{sample['__key__']}_aug{variant}", image_id, metadata['width'],
+                                                   metadata['height'], **params))
+                else:
+                    sample[f'control_aug{variant}.{control_format}'] = variant_bytes
+            
+            digest = hashlib.sha256(data).hexdigest()
+            future = None
+            if store is not None:
+                sample['txt'] = store.get(digest, caption.PROMPT, caption.MODEL, caption.MAX_TOKENS)
+            if sample['txt'] is not None:
+                counts['captions_reused'] += 1
+            elif api_key:
+                base64_image = caption.encode_payload(data, **(payload_options or {}))
+                future = caption_pool.submit(caption.request_caption, base64_image, api_key, base_url=base_url,
+                                             limiter=limiter)
+            else:
+                counts['captions_missing'] += 1
+            pending.append((sample, digest, future))
+            
+            # Store writes stay on this thread; only block once the caption queue is full
+            while pending and (pending[0][2] is None or pending[0][2].done() or len(pending) >= concurrency * 2):
+                emit(*pending.popleft())
+        
+        while pending:
+            emit(*pending.popleft())
+        finished = True
+    finally:
+        caption_pool.shutdown(wait=True)
+        if control_params is not None:
+            control_params.close()
+        if bucket_manifest is not None:
+            bucket_manifest.close()
+        # Only a complete run replaces the previous outputs; an aborted one is discarded
+        writer.close(commit=finished)
+    
+    for error in writer.errors:
+        print(f"Write failed: {error}")
+    counts['written'] -= len(writer.errors)
+    counts['failed'] += len(writer.errors)
+    return counts
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Stream labeled images straight into the final training layout')
+    parser.add_argument('--source-dir', default='/Users/Jasper/Downloads/archive (2)/images',
+                       help='Source directory containing original images')
+    parser.add_argument('--vp-labels-dir', default='/Users/Jasper/Projects/kontext_hack/exp/download_ava/vp-labels/AVA_landscape',
+                       help='Directory containing vanishing point label files')
+    parser.add_argument('--verify-labels', action='store_true',
+                       help='Also stat every label file to catch labels edited in place since the index was compiled')
+    parser.add_argument('--output-dir', default='/Users/Jasper/Projects/kontext_hack',
+                       help='Base directory for train_control and train_end')
+    parser.add_argument('--max-images', type=int, default=50,
+                       help='Maximum number of images to process')
+    parser.add_argument('--sampling', choices=SAMPLING_STRATEGIES, default='first',
+                       help='How to pick max-images of the labeled images: first, random or stratified by vanishing point position')
+    parser.add_argument('--sample-seed', type=int, default=0,
+                       help='Seed for random and stratified sampling')
+    parser.add_argument('--dedup-threshold', type=int,
+                       help='Drop near-duplicate images within this perceptual hash distance (of 64 bits) before rendering')
+    parser.add_argument('--workers', type=int, default=4,
+                       help='Number of threads reading and rendering images')
+    parser.add_argument('--queue-size', type=int, default=32,
+                       help='Maximum number of samples waiting to be written')
+    parser.add_argument('--shard-dir',
+                       help='Write WebDataset-style tar shards to this directory instead of train_control/train_end')
+    parser.add_argument('--shard-size', type=int, default=512,
+                       help='Maximum shard size in MB')
+    parser.add_argument('--shard-samples', type=int,
+                       help='Maximum number of samples per shard')
+    parser.add_argument('--control-format', choices=CONTROL_FORMATS, default='jpg',
+                       help='Store control images as JPEG, lossless palette PNG, or only their drawing parameters')
+    parser.add_argument('--control-params',
+                       help='Control parameter file for --control-format params (default: <output-dir>/train_control.vpctl)')
+    parser.add_argument('--buckets', action='store_true',
+                       help='Resize every sample to its nearest aspect-ratio bucket and write a bucket manifest')
+    parser.add_argument('--resolutions', default=','.join(map(str, DEFAULT_RESOLUTIONS)),
+                       help='Comma separated bucket base resolutions')
+    parser.add_argument('--aspect-ratios', default=','.join(DEFAULT_ASPECT_RATIOS),
+                       help='Comma separated bucket aspect ratios, e.g. 1:1,4:3,3:4')
+    parser.add_argument('--bucket-multiple', type=int, default=DEFAULT_MULTIPLE,
+                       help='Round bucket sides to a multiple of this')
+    parser.add_argument('--target-quality', type=int, default=95,
+                       help='JPEG quality of resized target images in --buckets mode')
+    parser.add_argument('--bucket-manifest',
+                       help='Bucket manifest path (default: <output-dir>/bucket_manifest.jsonl)')
+    parser.add_argument('--augment', type=int, default=0,
+                       help='Number of augmented control variants per image (VP jitter, ray spacing, widths, rotation)')
+    parser.add_argument('--augment-seed', type=int, default=0,
+                       help='Base seed of the control augmentations')
+    parser.add_argument('--angle-step', type=float, default=DEFAULT_ANGLE_STEP,
+                       help='Angle in degrees between the rays of the vanishing point images')
+    parser.add_argument('--line-width', type=int, default=DEFAULT_LINE_WIDTH,
+                       help='Stroke width of the rays in the vanishing point images')
+    parser.add_argument('--dot-radius', type=int, default=DEFAULT_DOT_RADIUS,
+                       help='Radius of the vanishing point dot')
+    parser.add_argument('--api-key',
+                       help='Anthropic API key (or set ANTHROPIC_API_KEY); without it captions are only taken from the store')
+    parser.add_argument('--skip-captions', action='store_true',
+                       help='Do not request captions, only reuse stored ones')
+    parser.add_argument('--base-url',
+                       help='Alternative API base URL, e.g. a local stub server')
+    parser.add_argument('--concurrency', type=int, default=8,
+                       help='Maximum number of caption requests in flight')
+    parser.add_argument('--rpm', type=int, default=50,
+                       help='Caption requests per minute limit')
+    parser.add_argument('--caption-store',
+                       help='SQLite caption store keyed by image content (default: <output-dir>/.caption_store.sqlite)')
+    parser.add_argument('--max-edge', type=int,
+                       help='Downscale images so the longest edge is at most this many pixels before upload')
+    parser.add_argument('--jpeg-quality', type=int, default=90,
+                       help='JPEG quality used when re-encoding downscaled images')
+    
+    args = parser.parse_args()
+    
+    api_key = None if args.skip_captions else args.api_key or os.getenv('ANTHROPIC_API_KEY')
+    payload_options = {'max_edge': args.max_edge, 'quality': args.jpeg_quality} if args.max_edge else None
+    render_options = {'angle_step': args.angle_step, 'line_width': args.line_width, 'dot_radius': args.dot_radius}
+    
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    store = CaptionStore(args.caption_store or Path(args.output_dir) / ".caption_store.sqlite")
+    control_params = None
+    if args.control_format == 'params':
+        control_params = ControlParamsWriter(args.control_params or Path(args.output_dir) / "train_control.vpctl")
+    buckets = None
+    bucket_manifest = None
+    if args.buckets:
+        buckets = make_buckets([int(r) for r in args.resolutions.split(',')], args.aspect_ratios.split(','),
+                               args.bucket_multiple)
+        bucket_manifest = BucketManifestWriter(args.bucket_manifest
+                                               or Path(args.output_dir) / "bucket_manifest.jsonl")
+    sink = None
+    if args.shard_dir:
+        sink = ShardWriter(args.shard_dir, max_size=args.shard_size * 1024 * 1024, max_samples=args.shard_samples)
+    try:
+        counts = stream_dataset(args.source_dir, args.vp_labels_dir, args.output_dir,
+                                vp_index=load_vp_index(args.vp_labels_dir, verify=args.verify_labels),
+                                max_images=args.max_images, workers=args.workers, render_options=render_options,
+                                api_key=api_key,
+                                base_url=args.base_url, concurrency=args.concurrency, requests_per_minute=args.rpm,
+                                payload_options=payload_options, store=store, queue_size=args.queue_size,
+                                sink=sink, control_format=args.control_format, control_params=control_params,
+                                buckets=buckets, target_quality=args.target_quality, bucket_manifest=bucket_manifest,
+                                augment=args.augment, augment_seed=args.augment_seed, sampling=args.sampling,
+                                sample_seed=args.sample_seed, dedup_threshold=args.dedup_threshold)
+    finally:
+        store.close()
+    
+    print(f"\nSummary:")
+    print(f"- Wrote {counts['written']} training pairs to {args.shard_dir or args.output_dir}")
+    if sink is not None:
+        print(f"- Shards: {len(sink.shards)}")
+    if control_params is not None:
+        print(f"- Control parameters: {control_params.path}")
+    if bucket_manifest is not None:
+        buckets_used = ', '.join(f"{w}x{h}: {count}" for (w, h), count in sorted(bucket_manifest.counts.items()))
+        print(f"- Buckets ({bucket_manifest.path}): {buckets_used}")
+    print(f"- Captions: {counts['captions_reused']} reused, {counts['captions_generated']} generated, "
+          f"{counts['captions_missing']} missing")
+    if counts['failed']:
+        print(f"- Failed: {counts['failed']}")
+
+if __name__ == "__main__":
+    main()
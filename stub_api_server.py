@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Anthropic Messages API, for testing caption.py
+throughput and retry handling without paying for API calls.
+Also fakes the Message Batches endpoints used by caption.py --batch.
+Point caption.py at it with --base-url http://127.0.0.1:PORT.
+"""
+
+import json
+import time
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timezone, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class StubState:
+    """
+    Shared counters and settings of a running stub server.
+    """
+
+    def __init__(self, latency=0.2, rate_limit_every=0, retry_after=1, batch_delay=2.0):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.batch_delay = batch_delay
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.batches = {}
+        self.batch_requests = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "rate_limited": self.rate_limited,
+                "max_in_flight": self.max_in_flight,
+                "batches": len(self.batches),
+                "batch_requests": self.batch_requests,
+            }
+
+def fake_caption(image_data):
+    """
+    Deterministic caption for an image, so results can be checked.
+    """
+    digest = hashlib.sha256(image_data.encode('utf-8')).hexdigest()[:12]
+    return f"A stub caption for image {digest}. It was generated locally."
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _not_found(self):
+        self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+
+    def _batch_object(self, batch_id, batch):
+        ended = time.time() >= batch['created'] + self.server.state.batch_delay
+        created = datetime.fromtimestamp(batch['created'], timezone.utc)
+        count = len(batch['requests'])
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else count,
+                "succeeded": count if ended else 0,
+                "errored": 0,
+                "canceled": 0,
+                "expired": 0,
+            },
+            "created_at": created.isoformat(),
+            "expires_at": (created + timedelta(days=1)).isoformat(),
+            "ended_at": (created + timedelta(seconds=self.server.state.batch_delay)).isoformat() if ended else None,
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": (f"http://{self.headers.get('Host')}/v1/messages/batches/{batch_id}/results"
+                            if ended else None),
+        }
+
+    def _send_batch_results(self, batch_id, batch):
+        lines = []
+        for number, request in enumerate(batch['requests'], 1):
+            lines.append(json.dumps({
+                "custom_id": request['custom_id'],
+                "result": {"type": "succeeded", "message": build_message_response(request['params'], number)},
+            }))
+        body = ('\n'.join(lines) + '\n').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/binary')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        state = self.server.state
+        if self.path == '/stats':
+            self._send_json(200, state.stats())
+            return
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if parts[:3] == ['v1', 'messages', 'batches'] and len(parts) in (4, 5):
+            with state.lock:
+                batch = state.batches.get(parts[3])
+            if batch is None:
+                self._not_found()
+            elif len(parts) == 4:
+                self._send_json(200, self._batch_object(parts[3], batch))
+            elif parts[4] == 'results' and self._batch_object(parts[3], batch)['processing_status'] == 'ended':
+                self._send_batch_results(parts[3], batch)
+            else:
+                self._not_found()
+            return
+        self._not_found()
+
+    def do_POST(self):
+        path = self.path.split('?')[0].rstrip('/')
+        state = self.server.state
+        if path == '/v1/messages/batches':
+            body = self._read_json()
+            with state.lock:
+                batch_id = f"msgbatch_stub_{len(state.batches) + 1}"
+                batch = {'created': time.time(), 'requests': body.get('requests', [])}
+                state.batches[batch_id] = batch
+                state.batch_requests += len(batch['requests'])
+            self._send_json(200, self._batch_object(batch_id, batch))
+            return
+        if path != '/v1/messages':
+            self._not_found()
+            return
+        request = self._read_json()
+        
+        with state.lock:
+            state.requests += 1
+            request_number = state.requests
+            limited = state.rate_limit_every and request_number % state.rate_limit_every == 0
+            if limited:
+                state.rate_limited += 1
+            else:
+                state.in_flight += 1
+                state.max_in_flight = max(state.max_in_flight, state.in_flight)
+        
+        if limited:
+            self._send_json(429, {"type": "error", "error": {"type": "rate_limit_error", "message": "stub rate limit"}},
+                            headers={"retry-after": str(state.retry_after)})
+            return
+        
+        try:
+            time.sleep(state.latency)
+            self._send_json(200, build_message_response(request, request_number))
+        finally:
+            with state.lock:
+                state.in_flight -= 1
+
+def build_message_response(request, request_number):
+    """
+    Build a Messages API response for a request body.
+    """
+    image_data = ''
+    for message in request.get('messages', []):
+        for block in message.get('content', []):
+            if isinstance(block, dict) and block.get('type') == 'image':
+                image_data = block['source'].get('data', '')
+    return {
+        "id": f"msg_stub_{request_number}",
+        "type": "message",
+        "role": "assistant",
+        "model": request.get('model', 'stub'),
+        "content": [{"type": "text", "text": fake_caption(image_data)}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": len(image_data) // 1000 + 20, "output_tokens": 20},
+    }
+
+def start_stub_server(port=0, latency=0.2, rate_limit_every=0, retry_after=1, batch_delay=2.0):
+    """
+    Start the stub server in a background thread.
+    Returns (server, base_url); call server.shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState(latency, rate_limit_every, retry_after, batch_delay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local stub of the Anthropic Messages API')
+    parser.add_argument('--port', type=int, default=8766,
+                       help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.2,
+                       help='Seconds each request takes')
+    parser.add_argument('--rate-limit-every', type=int, default=0,
+                       help='Answer every Nth request with 429 (0 = never)')
+    parser.add_argument('--retry-after', type=int, default=1,
+                       help='Retry-After seconds sent with 429 responses')
+    parser.add_argument('--batch-delay', type=float, default=2.0,
+                       help='Seconds until a submitted message batch ends')
+    
+    args = parser.parse_args()
+    
+    server, base_url = start_stub_server(args.port, args.latency, args.rate_limit_every, args.retry_after,
+                                         args.batch_delay)
+    print(f"Stub API running on {base_url} (stats at {base_url}/stats)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print(f"\nStats: {server.state.stats()}")
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Measure whether generated images converge on their requested vanishing point.
+Line segments are detected in every image (LSD, or Canny + Hough where
+OpenCV lacks LSD), and the dominant vanishing point is estimated with a
+vectorized RANSAC: random segment pairs are intersected in homogeneous
+coordinates like calculate_vanishing_point, every hypothesis is scored at once
+by the length of the segments pointing at it, and the best one is refined by
+least squares over its inliers. Hypotheses more than MAX_VP_DISTANCE image
+diagonals from the center are ignored, so the verticals and horizontals of a
+one-point perspective scene (vanishing points at infinity) do not win.
+
+Requests are JSON lines with the image file and the requested vanishing
+point, either as {"image": ..., "vanishing_point": [x, y], "size": [w, h]} or
+as the /api/generate body with "control": {"w", "h", "vx", "vy"}; the point
+is scaled from size to the generated image size. Images are evaluated in a
+process pool and the per-image errors are written as JSON lines.
+"""
+
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import cv2
+from process_vanishing_points import homogeneous_lines
+
+DEFAULT_ITERATIONS = 512
+DEFAULT_THRESHOLD = 2.0
+# Images are evaluated with their longest side at most MAX_SIDE pixels
+MAX_SIDE = 1024
+MIN_SEGMENT_LENGTH = 20
+MAX_SEGMENTS = 1000
+MAX_VP_DISTANCE = 2.0
+ERROR_THRESHOLDS = (0.02, 0.05, 0.1)
+
+def detect_segments(gray, min_length=MIN_SEGMENT_LENGTH):
+    """
+    Detect line segments in a grayscale image. Returns an (N, 4) array of
+    [x1, y1, x2, y2], the longest MAX_SEGMENTS segments of at least min_length.
+    """
+    try:
+        lines = cv2.createLineSegmentDetector().detect(gray)[0]
+    except cv2.error:
+        # OpenCV builds between 3.4.6 and 4.5.0 ship without LSD
+        edges = cv2.Canny(gray, 50, 150)
+        lines = cv2.HoughLinesP(edges, 1, np.pi / 360, 50, minLineLength=min_length, maxLineGap=5)
+    if lines is None:
+        return np.zeros((0, 4))
+    segments = lines.reshape(-1, 4).astype(np.float64)
+    lengths = np.hypot(segments[:, 2] - segments[:, 0], segments[:, 3] - segments[:, 1])
+    order = np.argsort(-lengths, kind='stable')
+    order = order[lengths[order] >= min_length][:MAX_SEGMENTS]
+    return segments[order]
+
+def segment_angles(segments, points):
+    """
+    Angle in degrees between every segment and the line from its midpoint to
+    every homogeneous point [x, y, w]; points at infinity (w = 0) are
+    directions. segments is (N, 4), points (K, 3); returns a (K, N) array.
+    """
+    midpoints = (segments[:, :2] + segments[:, 2:]) / 2
+    directions = segments[:, 2:] - segments[:, :2]
+    directions /= np.maximum(np.linalg.norm(directions, axis=1, keepdims=True), 1e-12)
+    towards = points[:, None, :2] - midpoints[None] * points[:, None, 2:]
+    norms = np.linalg.norm(towards, axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos = np.abs((towards * directions[None]).sum(axis=2)) / norms
+    # A point on the midpoint lies on the segment's line
+    cos = np.where(norms > 1e-9, cos, 1.0)
+    return np.degrees(np.arccos(np.clip(cos, 0.0, 1.0)))
+
+def _within(points, width, height):
+    """
+    Mask of homogeneous points within MAX_VP_DISTANCE diagonals of the image center.
+    """
+    finite = np.abs(points[:, 2]) > 1e-12
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xy = points[:, :2] / np.where(finite, points[:, 2], 1.0)[:, None]
+    distance = np.hypot(xy[:, 0] - width / 2, xy[:, 1] - height / 2)
+    return finite & (distance <= MAX_VP_DISTANCE * np.hypot(width, height))
+
+def ransac_vanishing_point(segments, width, height, iterations=DEFAULT_ITERATIONS, threshold=DEFAULT_THRESHOLD,
+                           rng=None):
+    """
+    Estimate the dominant vanishing point of the segments.
+    Returns (vp, inliers): vp as (x, y) floats, or None if no hypothesis is
+    supported by at least three segments, and the inlier mask of the segments.
+    """
+    count = len(segments)
+    inliers = np.zeros(count, dtype=bool)
+    if count < 3:
+        return None, inliers
+    rng = rng if rng is not None else np.random.default_rng(0)
+    lines = homogeneous_lines(segments)
+    lines /= np.maximum(np.hypot(lines[:, 0], lines[:, 1]), 1e-12)[:, None]
+    lengths = np.hypot(segments[:, 2] - segments[:, 0], segments[:, 3] - segments[:, 1])
+    
+    # Hypotheses from length-weighted random pairs, all scored in one pass
+    pairs = rng.choice(count, size=(iterations, 2), p=lengths / lengths.sum())
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    hypotheses = np.cross(lines[pairs[:, 0]], lines[pairs[:, 1]])
+    hypotheses = hypotheses[_within(hypotheses, width, height)]
+    if not len(hypotheses):
+        return None, inliers
+    scores = (segment_angles(segments, hypotheses) < threshold) @ lengths
+    best = hypotheses[np.argmax(scores)]
+    inliers = segment_angles(segments, best[None])[0] < threshold
+    if inliers.sum() < 3:
+        return None, inliers
+    
+    # Least squares refinement: the point closest to all inlier lines, weighted by length
+    weighted = lines[inliers] * np.sqrt(lengths[inliers])[:, None]
+    refined = np.linalg.svd(weighted)[2][-1]
+    if _within(refined[None], width, height)[0]:
+        refined_inliers = segment_angles(segments, refined[None])[0] < threshold
+        if refined_inliers.sum() >= inliers.sum():
+            best, inliers = refined, refined_inliers
+    return (float(best[0] / best[2]), float(best[1] / best[2])), inliers
+
+def evaluate_image(image_path, requested_vp, requested_size=None, iterations=DEFAULT_ITERATIONS,
+                   threshold=DEFAULT_THRESHOLD, seed=0):
+    """
+    Compare the dominant vanishing point of one image with the requested one.
+    requested_vp is in the pixels of requested_size (default: the image size).
+    Returns a dict with the detected point, the pixel error, the error
+    relative to the image diagonal, the angle error (median angle between the
+    detected inlier segments and the lines to the requested point) and the
+    requested support (length fraction of all segments pointing at the
+    requested point within the threshold).
+    """
+    gray = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return {'error': 'unreadable'}
+    height, width = gray.shape
+    scale = min(1.0, MAX_SIDE / max(width, height))
+    if scale < 1.0:
+        gray = cv2.resize(gray, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    segments = detect_segments(gray) / scale
+    
+    if requested_size is not None:
+        requested_vp = (requested_vp[0] * width / requested_size[0], requested_vp[1] * height / requested_size[1])
+    requested = np.array([[requested_vp[0], requested_vp[1], 1.0]])
+    result = {'width': width, 'height': height, 'requested_vp': [round(v, 2) for v in requested_vp],
+              'segments': len(segments)}
+    if len(segments):
+        lengths = np.hypot(segments[:, 2] - segments[:, 0], segments[:, 3] - segments[:, 1])
+        support = segment_angles(segments, requested)[0] < threshold
+        result['requested_support'] = round(float(lengths[support].sum() / lengths.sum()), 4)
+    
+    vp, inliers = ransac_vanishing_point(segments, width, height, iterations, threshold, np.random.default_rng(seed))
+    result['inliers'] = int(inliers.sum())
+    if vp is None:
+        result['error'] = 'no_vanishing_point'
+        return result
+    pixel_error = float(np.hypot(vp[0] - requested_vp[0], vp[1] - requested_vp[1]))
+    result.update({
+        'detected_vp': [round(v, 2) for v in vp],
+        'pixel_error': round(pixel_error, 2),
+        'relative_error': round(pixel_error / np.hypot(width, height), 5),
+        'angle_error_deg': round(float(np.median(segment_angles(segments[inliers], requested)[0])), 3),
+    })
+    return result
+
+def parse_request(record):
+    """
+    Return (image, (vp_x, vp_y), (width, height) or None) for one request record.
+    """
+    image = record.get('image') or record.get('file')
+    if 'control' in record:
+        control = record['control']
+        return image, (float(control['vx']), float(control['vy'])), (float(control['w']), float(control['h']))
+    if 'vanishing_point' in record:
+        size = record.get('size')
+        return image, tuple(map(float, record['vanishing_point'])), tuple(map(float, size)) if size else None
+    return image, (float(record['vx']), float(record['vy'])), (
+        (float(record['w']), float(record['h'])) if 'w' in record else None)
+
+def load_requests(requests_path, images_dir=None):
+    """
+    Read a JSON lines request file. Image paths are relative to images_dir
+    (default: the request file's directory). Returns a list of
+    (image_path, requested_vp, requested_size) tuples.
+    """
+    images_dir = Path(images_dir) if images_dir else Path(requests_path).parent
+    requests = []
+    with open(requests_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            image, vp, size = parse_request(json.loads(line))
+            requests.append((str(images_dir / image), vp, size))
+    return requests
+
+def _evaluate_chunk(work):
+    requests, iterations, threshold, seed, start = work
+    return [evaluate_image(image_path, vp, size, iterations, threshold, [seed, start + i])
+            for i, (image_path, vp, size) in enumerate(requests)]
+
+def evaluate_requests(requests, workers=4, iterations=DEFAULT_ITERATIONS, threshold=DEFAULT_THRESHOLD, seed=0,
+                      chunk_size=16):
+    """
+    Evaluate (image_path, requested_vp, requested_size) requests, spread
+    over a process pool with more than one worker. Every image has its own
+    RANSAC seed, so results do not depend on the number of workers.
+    Returns one result dict per request, in order.
+    """
+    work = [(requests[i:i + chunk_size], iterations, threshold, seed, i) for i in range(0, len(requests), chunk_size)]
+    if workers <= 1:
+        chunks = [_evaluate_chunk(item) for item in work]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(_evaluate_chunk, work))
+    results = [result for chunk in chunks for result in chunk]
+    for (image_path, _, _), result in zip(requests, results):
+        result['image'] = image_path
+    return results
+
+def summarize(results, thresholds=ERROR_THRESHOLDS):
+    """
+    Aggregate per-image results: error statistics over the images with a
+    detected vanishing point, and the fraction of all images whose relative
+    error is within each threshold.
+    """
+    detected = [result for result in results if 'pixel_error' in result]
+    summary = {'images': len(results), 'detected': len(detected),
+               'unreadable': sum(result.get('error') == 'unreadable' for result in results)}
+    for name in ('pixel_error', 'relative_error', 'angle_error_deg'):
+        values = np.array([result[name] for result in detected], dtype=np.float64)
+        if len(values):
+            summary[name] = {'mean': round(float(values.mean()), 5), 'median': round(float(np.median(values)), 5),
+                             'p90': round(float(np.percentile(values, 90)), 5)}
+    relative = np.array([result['relative_error'] for result in detected], dtype=np.float64)
+    for threshold in thresholds:
+        summary[f"within_{threshold:g}"] = round(float((relative <= threshold).sum() / max(1, len(results))), 4)
+    support = [result['requested_support'] for result in results if 'requested_support' in result]
+    if support:
+        summary['requested_support'] = round(float(np.mean(support)), 4)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure how well generated images follow their requested vanishing points')
+    parser.add_argument('--requests', default='/Users/Jasper/Projects/kontext_hack/generated/requests.jsonl',
+                       help='JSON lines file with the image and requested vanishing point of every generation')
+    parser.add_argument('--images-dir',
+                       help='Directory the image paths are relative to (default: the requests file directory)')
+    parser.add_argument('--output', default='vp_adherence.jsonl',
+                       help='Where to write the per-image results')
+    parser.add_argument('--summary',
+                       help='Also write the aggregate results to this JSON file')
+    parser.add_argument('--workers', type=int, default=4,
+                       help='Number of worker processes')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS,
+                       help='RANSAC hypotheses per image')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                       help='Maximum angle in degrees between an inlier segment and the line to the vanishing point')
+    parser.add_argument('--seed', type=int, default=0,
+                       help='RANSAC seed')
+    
+    args = parser.parse_args()
+    
+    requests = load_requests(args.requests, args.images_dir)
+    print(f"Evaluating {len(requests)} images...")
+    results = evaluate_requests(requests, args.workers, args.iterations, args.threshold, args.seed)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+    
+    summary = summarize(results)
+    print(f"Detected a vanishing point in {summary['detected']} of {summary['images']} images")
+    for name in ('pixel_error', 'relative_error', 'angle_error_deg'):
+        if name in summary:
+            stats = summary[name]
+            print(f"  {name}: mean {stats['mean']:g}, median {stats['median']:g}, p90 {stats['p90']:g}")
+    for threshold in ERROR_THRESHOLDS:
+        print(f"  within {threshold:.0%} of the diagonal: {summary[f'within_{threshold:g}']:.1%}")
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Compact binary index for a directory of vanishing point label files.
+Packs every {image_id}.txt label (width height / line1 / line2) into a single
+memory-mappable file so the pipeline does not open one file per label.
+
+Layout: a 64-byte header followed by fixed-size records sorted by image id.
+The header stores the label directory mtime and the number of label files,
+so the index is rebuilt automatically when label files are added, removed or
+renamed without touching the labels themselves. It also stores a fingerprint
+of every label file's size and mtime; checking that (verify, or
+--verify-labels in the pipeline scripts) costs one stat per label but also
+catches labels rewritten in place.
+"""
+
+import os
+import struct
+import hashlib
+import argparse
+from pathlib import Path
+import numpy as np
+
+INDEX_MAGIC = b'VPIDX\x00\x00\x01'
+INDEX_VERSION = 2
+HEADER_FORMAT = '<8sIIqqqq'
+HEADER_SIZE = 64
+MAX_ID_LENGTH = 32
+
+RECORD_DTYPE = np.dtype([
+    ('image_id', f'S{MAX_ID_LENGTH}'),
+    ('width', '<i4'),
+    ('height', '<i4'),
+    ('line1', '<f8', (4,)),
+    ('line2', '<f8', (4,)),
+])
+
+def default_index_path(vp_labels_dir):
+    """
+    Return the default index location: a sibling of the labels directory,
+    so writing the index does not change the directory's own mtime.
+    """
+    labels_path = Path(vp_labels_dir).resolve()
+    return labels_path.parent / f"{labels_path.name}.vpidx"
+
+def _parse_label(text):
+    """
+    Parse the contents of a label file, mirroring read_vp_data.
+    """
+    lines = text.splitlines()
+    width, height = map(int, lines[0].strip().split())
+    line1 = list(map(float, lines[1].strip().split()))
+    line2 = list(map(float, lines[2].strip().split()))
+    if len(line1) != 4 or len(line2) != 4:
+        raise ValueError("expected four coordinates per line")
+    return width, height, line1, line2
+
+def _fingerprint(stats):
+    """
+    Combine (name, size, mtime_ns) tuples of label files into a signed 64-bit value.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for name, size, mtime_ns in sorted(stats):
+        digest.update(f"{name}\0{size}\0{mtime_ns}\n".encode('utf-8'))
+    return int.from_bytes(digest.digest(), 'little', signed=True)
+
+def count_labels(vp_labels_dir):
+    """
+    Count the .txt entries of vp_labels_dir from the directory listing alone.
+    """
+    return sum(1 for name in os.listdir(vp_labels_dir) if name.endswith('.txt'))
+
+def labels_fingerprint(vp_labels_dir):
+    """
+    Return the fingerprint of the label files in vp_labels_dir.
+    Costs one stat per file, but never opens the labels.
+    """
+    stats = []
+    with os.scandir(vp_labels_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.txt') and entry.is_file():
+                stat = entry.stat()
+                stats.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return _fingerprint(stats)
+
+def compile_vp_index(vp_labels_dir, index_path=None):
+    """
+    Pack all label files in vp_labels_dir into a binary index.
+    Malformed labels are reported and left out. Returns the number of records.
+    """
+    labels_path = Path(vp_labels_dir)
+    index_path = Path(index_path) if index_path else default_index_path(vp_labels_dir)
+    
+    # Take the mtime before scanning so changes made during the scan trigger a rebuild
+    dir_mtime_ns = os.stat(labels_path).st_mtime_ns
+    
+    records = []
+    stats = []
+    file_count = 0
+    with os.scandir(labels_path) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.txt'):
+                continue
+            # Counted like count_labels, from names only
+            file_count += 1
+            if not entry.is_file():
+                continue
+            # Stat before reading, so a rewrite during the scan changes the fingerprint
+            stat = entry.stat()
+            stats.append((entry.name, stat.st_size, stat.st_mtime_ns))
+            image_id = entry.name[:-4]
+            encoded_id = image_id.encode('utf-8')
+            if len(encoded_id) > MAX_ID_LENGTH:
+                print(f"Skipping label with too long id: {entry.path}")
+                continue
+            try:
+                with open(entry.path, 'r') as f:
+                    width, height, line1, line2 = _parse_label(f.read())
+            except (ValueError, IndexError, UnicodeDecodeError) as e:
+                print(f"Skipping malformed label {entry.path}: {e}")
+                continue
+            records.append((encoded_id, width, height, line1, line2))
+    
+    table = np.array(records, dtype=RECORD_DTYPE)
+    table.sort(order='image_id')
+    
+    header = struct.pack(HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION, RECORD_DTYPE.itemsize,
+                         len(table), dir_mtime_ns, file_count, _fingerprint(stats))
+    
+    # Write to a temporary file and swap it in, so readers never see a partial index
+    tmp_path = index_path.with_name(index_path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\x00'))
+        f.write(table.tobytes())
+    os.replace(tmp_path, index_path)
+    return len(table)
+
+def _read_header(index_path):
+    """
+    Read the index header. Returns a dict, or None if the file is not a valid index.
+    """
+    try:
+        with open(index_path, 'rb') as f:
+            raw = f.read(HEADER_SIZE)
+    except OSError:
+        return None
+    if len(raw) < HEADER_SIZE:
+        return None
+    magic, version, record_size, count, dir_mtime_ns, file_count, fingerprint = struct.unpack_from(HEADER_FORMAT, raw)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION or record_size != RECORD_DTYPE.itemsize:
+        return None
+    return {'count': count, 'dir_mtime_ns': dir_mtime_ns, 'file_count': file_count,
+            'fingerprint': fingerprint}
+
+class VPIndex:
+    """
+    Read-only, memory-mapped view of a compiled label index.
+    """
+
+    def __init__(self, index_path):
+        header = _read_header(index_path)
+        if header is None:
+            raise ValueError(f"Not a vanishing point index: {index_path}")
+        self.index_path = Path(index_path)
+        self.dir_mtime_ns = header['dir_mtime_ns']
+        if header['count']:
+            self.records = np.memmap(index_path, dtype=RECORD_DTYPE, mode='r',
+                                     offset=HEADER_SIZE, shape=(header['count'],))
+        else:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def _position(self, image_id):
+        key = np.array(str(image_id).encode('utf-8'), dtype=self.records.dtype['image_id'])
+        pos = int(np.searchsorted(self.records['image_id'], key))
+        if pos < len(self.records) and self.records['image_id'][pos] == key:
+            return pos
+        return None
+
+    def __contains__(self, image_id):
+        return self._position(image_id) is not None
+
+    def image_ids(self):
+        """
+        Return all image ids in sorted order.
+        """
+        return [image_id.decode('utf-8') for image_id in self.records['image_id']]
+
+    def lookup(self, image_id):
+        """
+        Return (width, height, line1, line2) like read_vp_data, or None if unknown.
+        """
+        pos = self._position(image_id)
+        if pos is None:
+            return None
+        record = self.records[pos]
+        return int(record['width']), int(record['height']), record['line1'].tolist(), record['line2'].tolist()
+
+def load_vp_index(vp_labels_dir, index_path=None, rebuild=False, verify=False):
+    """
+    Open the index for vp_labels_dir, compiling it first if it is missing,
+    invalid or out of date with the label files.
+    Freshness is checked from the directory mtime and listing, without any
+    per-label I/O; with verify the label fingerprint is compared as well
+    (one stat per label), which also catches labels rewritten in place.
+    Returns None if the labels directory does not exist or the index cannot
+    be written (e.g. read-only location).
+    """
+    index_path = Path(index_path) if index_path else default_index_path(vp_labels_dir)
+    header = _read_header(index_path)
+    try:
+        dir_mtime_ns = os.stat(vp_labels_dir).st_mtime_ns
+        stale = (header is None or header['dir_mtime_ns'] != dir_mtime_ns
+                 or header['file_count'] != count_labels(vp_labels_dir))
+        if not stale and not rebuild and verify:
+            stale = header['fingerprint'] != labels_fingerprint(vp_labels_dir)
+    except FileNotFoundError:
+        print(f"Label directory not found: {vp_labels_dir}")
+        return None
+    
+    if rebuild or stale:
+        try:
+            count = compile_vp_index(vp_labels_dir, index_path)
+        except OSError as e:
+            print(f"Could not write label index {index_path}: {e}")
+            return None
+        print(f"Compiled label index with {count} entries: {index_path}")
+    
+    return VPIndex(index_path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile vanishing point label files into a binary index')
+    parser.add_argument('--vp-labels-dir', default='/Users/Jasper/Projects/kontext_hack/exp/download_ava/vp-labels/AVA_landscape',
+                       help='Directory containing vanishing point label files')
+    parser.add_argument('--index-path',
+                       help='Where to write the index (default: <vp-labels-dir>.vpidx next to the directory)')
+    
+    args = parser.parse_args()
+    
+    index_path = args.index_path or default_index_path(args.vp_labels_dir)
+    count = compile_vp_index(args.vp_labels_dir, index_path)
+    print(f"Compiled {count} labels into {index_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Vectorized rasterizer for vanishing point control images.
+Draws the red dot with equi-angular rays that create_vanishing_point_only
+produces, computing all ray/boundary intersections in one NumPy operation and
+drawing the rays with a single polyline call. Rendered images are kept in a
+bounded LRU cache keyed by their parameters.
+"""
+
+import math
+from functools import lru_cache
+import numpy as np
+import cv2
+
+DEFAULT_ANGLE_STEP = 20
+DEFAULT_LINE_WIDTH = 2
+DEFAULT_DOT_RADIUS = 8
+DEFAULT_RING_RADIUS = 12
+DEFAULT_RING_WIDTH = 2
+DEFAULT_COLOR = (0, 0, 255)
+CACHE_SIZE = 64
+
+@lru_cache(maxsize=32)
+def _ray_directions(angle_step, angle_offset=0.0):
+    """
+    Return (cos, sin) arrays for rays every angle_step degrees starting at
+    angle_offset. math.cos/math.sin are used so the values match the
+    original per-angle loop.
+    """
+    count = int(math.ceil(360 / angle_step))
+    angles = [math.radians(i * angle_step + angle_offset) for i in range(count)]
+    cos_angles = np.array([math.cos(a) for a in angles])
+    sin_angles = np.array([math.sin(a) for a in angles])
+    return cos_angles, sin_angles
+
+def ray_endpoints(width, height, vp_x, vp_y, angle_step=DEFAULT_ANGLE_STEP, angle_offset=0.0):
+    """
+    Compute where the rays from (vp_x, vp_y) leave the image.
+    Returns an (M, 2) int32 array of boundary points, one per ray that hits
+    the image border, identical to the closest intersection picked by the
+    original per-angle loop.
+    """
+    cos_angles, sin_angles = _ray_directions(angle_step, angle_offset)
+    points, has_hit = boundary_hits(width, height, vp_x, vp_y, cos_angles, sin_angles)
+    return points[has_hit]
+
+def boundary_hits(width, height, vp_x, vp_y, cos_angles, sin_angles):
+    """
+    Intersect rays with the image border. vp_x and vp_y are scalars or arrays
+    with one origin per ray, so rays from many vanishing points can be solved
+    in one pass. Returns (points, has_hit): an (R, 2) int32 array of border
+    points and a mask of the rays that hit the border.
+    """
+    # Ray parameter t for the top, bottom, left and right edges, shape (4, R)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.stack([
+            np.where(sin_angles != 0, -vp_y / sin_angles, np.nan),
+            np.where(sin_angles != 0, (height - vp_y) / sin_angles, np.nan),
+            np.where(cos_angles != 0, -vp_x / cos_angles, np.nan),
+            np.where(cos_angles != 0, (width - vp_x) / cos_angles, np.nan),
+        ])
+        x_on_horizontal = vp_x + t[:2] * cos_angles
+        y_on_vertical = vp_y + t[2:] * sin_angles
+    
+    valid = np.concatenate([
+        (t[:2] > 0) & (x_on_horizontal >= 0) & (x_on_horizontal <= width),
+        (t[2:] > 0) & (y_on_vertical >= 0) & (y_on_vertical <= height),
+    ])
+    
+    # Candidate points, truncated to integers like the original int() calls
+    xs = np.concatenate([
+        np.where(valid[:2], x_on_horizontal, 0),
+        np.broadcast_to(np.array([[0], [width]]), y_on_vertical.shape),
+    ]).astype(np.int64)
+    ys = np.concatenate([
+        np.broadcast_to(np.array([[0], [height]]), x_on_horizontal.shape),
+        np.where(valid[2:], y_on_vertical, 0),
+    ]).astype(np.int64)
+    
+    distances = np.where(valid, np.sqrt((xs - vp_x) ** 2 + (ys - vp_y) ** 2), np.inf)
+    # argmin returns the first minimum, matching min() over top, bottom, left, right
+    closest = np.argmin(distances, axis=0)
+    has_hit = valid.any(axis=0)
+    
+    rays = np.arange(len(cos_angles))
+    points = np.stack([xs[closest, rays], ys[closest, rays]], axis=1).astype(np.int32)
+    return points, has_hit
+
+def draw_control_image(image, vp_x, vp_y, angle_step=DEFAULT_ANGLE_STEP, line_width=DEFAULT_LINE_WIDTH,
+                       dot_radius=DEFAULT_DOT_RADIUS, ring_radius=DEFAULT_RING_RADIUS,
+                       ring_width=DEFAULT_RING_WIDTH, color=DEFAULT_COLOR, angle_offset=0.0, endpoints=None):
+    """
+    Draw the vanishing point rays, dot and ring onto image in place.
+    Precomputed ray endpoints can be passed to skip the intersection step.
+    """
+    height, width = image.shape[:2]
+    if endpoints is None:
+        endpoints = ray_endpoints(width, height, vp_x, vp_y, angle_step, angle_offset)
+    
+    if len(endpoints):
+        segments = np.empty((len(endpoints), 2, 2), dtype=np.int32)
+        segments[:, 0] = (vp_x, vp_y)
+        segments[:, 1] = endpoints
+        cv2.polylines(image, list(segments.reshape(-1, 2, 1, 2)), False, color, line_width)
+    
+    # Draw the vanishing point as a red dot
+    if dot_radius > 0:
+        cv2.circle(image, (vp_x, vp_y), dot_radius, color, -1)
+    if ring_radius > 0 and ring_width > 0:
+        cv2.circle(image, (vp_x, vp_y), ring_radius, color, ring_width)
+    return image
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _render_cached(width, height, vp_x, vp_y, angle_step, line_width, dot_radius, ring_radius, ring_width, color,
+                   angle_offset):
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    draw_control_image(image, vp_x, vp_y, angle_step, line_width, dot_radius, ring_radius, ring_width, color,
+                       angle_offset)
+    # Cached arrays are shared between callers, so they must not be modified
+    image.flags.writeable = False
+    return image
+
+def render_control_image(width, height, vp_x, vp_y, angle_step=DEFAULT_ANGLE_STEP, line_width=DEFAULT_LINE_WIDTH,
+                         dot_radius=DEFAULT_DOT_RADIUS, ring_radius=DEFAULT_RING_RADIUS,
+                         ring_width=DEFAULT_RING_WIDTH, color=DEFAULT_COLOR, angle_offset=0.0):
+    """
+    Render a control image: black background with the vanishing point and rays.
+    angle_offset rotates the whole ray fan by that many degrees.
+    Results are cached; the returned array is read-only, copy it before drawing on it.
+    """
+    return _render_cached(int(width), int(height), int(vp_x), int(vp_y), angle_step, int(line_width),
+                          int(dot_radius), int(ring_radius), int(ring_width), tuple(int(c) for c in color),
+                          float(angle_offset))
+
+def cache_info():
+    """
+    Return hit/miss statistics of the control image cache.
+    """
+    return _render_cached.cache_info()
+
+def clear_cache():
+    """
+    Drop all cached control images.
+    """
+    _render_cached.cache_clear()